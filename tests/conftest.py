@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the ViT and BERT code imports modules.* and baselines.* from the package directory, TinyViT imports
+# transformer_explainability.* from the repository root
+for path in (ROOT, os.path.join(ROOT, 'transformer_explainability')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def no_cuda(monkeypatch):
+    # the explanation generators move the one hot vector with .cuda(), a no-op here without a GPU
+    if not torch.cuda.is_available():
+        monkeypatch.setattr(torch.Tensor, 'cuda', lambda self, *args, **kwargs: self)
+
+
+@pytest.fixture
+def vit():
+    from baselines.ViT.ViT_LRP import VisionTransformer
+    torch.manual_seed(0)
+    return VisionTransformer(depth=3, num_heads=4, embed_dim=64, num_classes=10, qkv_bias=True).eval()
@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+import torch
+
+from baselines.ViT.ViT_explanation_generator import LRP
+from modules import layers_ours
+from modules.layers_ours import autograd_lrp
+
+METHODS = ['transformer_attribution', 'full', 'rollout', 'last_layer', 'last_layer_attn', 'second_layer']
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_autograd_matches_relprop(no_cuda, vit, method):
+    generator = LRP(vit)
+    image = torch.randn(1, 3, 224, 224)
+    reference = generator.generate_LRP(image, index=3, method=method)
+    cam = generator.generate_LRP_autograd(image, index=3, method=method)
+    # the two differ in summation order only
+    torch.testing.assert_close(cam, reference, rtol=1e-4, atol=max(3e-8, 1e-6 * reference.abs().max().item()))
+
+
+def test_recording_flag_is_off_outside_the_context(vit):
+    assert layers_ours._recording == 0
+    with autograd_lrp():
+        assert layers_ours._recording == 1
+        with autograd_lrp():
+            assert layers_ours._recording == 2
+    assert layers_ours._recording == 0
+    vit(torch.randn(1, 3, 224, 224))
+    assert vit.head.Y.grad_fn is None
+
+
+def test_autograd_lrp_is_per_thread(no_cuda, vit):
+    from baselines.ViT.ViT_LRP import VisionTransformer
+    torch.manual_seed(1)
+    other = VisionTransformer(depth=2, num_heads=4, embed_dim=64, num_classes=10, qkv_bias=True).eval()
+    image = torch.randn(1, 3, 224, 224)
+    generator = LRP(vit)
+    reference_cam = generator.generate_LRP_autograd(image, index=3, method='full').detach()
+
+    def gradient():
+        x = image.clone().requires_grad_(True)
+        out = other(x)
+        out[0, 3].backward()
+        return x.grad
+
+    reference_grad = gradient()
+    failures = {'relevance': 0, 'gradient': 0}
+    started = threading.Barrier(2)
+
+    def explain():
+        started.wait()
+        for _ in range(5):
+            cam = generator.generate_LRP_autograd(image, index=3, method='full')
+            failures['relevance'] += not torch.allclose(cam, reference_cam,
+                                                        atol=1e-6 * reference_cam.abs().max().item())
+
+    def backward():
+        # a plain forward and backward in another thread, while the first records RelProp layers
+        started.wait()
+        for _ in range(10):
+            failures['gradient'] += not torch.allclose(gradient(), reference_grad, rtol=1e-4, atol=1e-7)
+
+    threads = [threading.Thread(target=explain), threading.Thread(target=backward)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert failures == {'relevance': 0, 'gradient': 0}
@@ -0,0 +1,118 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from BERT_rationale_benchmark.models.pipeline.bert_pipeline import (
+    scores_per_word_from_scores_per_token,
+    word_ids_from_tokens,
+)
+from BERT_rationale_benchmark.models.pipeline.faithfulness import AOPCScorer
+
+CLS, SEP, PAD = 101, 102, 0
+THRESHOLDS = [0.01, 0.2, 0.5, 1.0]
+
+
+class CountClassifier(nn.Module):
+    """Logits from the counts of two token ids, ignoring the padding"""
+
+    def __init__(self):
+        super().__init__()
+        self.scale = nn.Parameter(torch.tensor(.3))
+
+    def forward(self, input_ids, attention_mask):
+        counts = torch.stack([(input_ids == 7), (input_ids == 9)], dim=-1).float() * attention_mask.unsqueeze(-1)
+        return (counts.sum(dim=1) * self.scale + attention_mask.sum(dim=1, keepdim=True) * .01,)
+
+
+def documents():
+    torch.manual_seed(0)
+    ret = []
+    for length in [3, 9, 17, 30, 8]:
+        ids = torch.cat([torch.tensor([CLS]), torch.randint(3, 12, (length,)), torch.tensor([SEP])])
+        ret.append((ids, torch.rand(len(ids))))
+    return ret
+
+
+def reference(classifier, ids, scores, thresholds, word_ids=None):
+    """One classifier call per variant, choosing the rationale word by word"""
+    special = [int(i) in (CLS, SEP, PAD) for i in ids]
+    if word_ids is None:
+        word_ids = [-1 if s else i for i, s in enumerate(special)]
+    else:
+        word_ids = [-1 if s else int(w) for w, s in zip(word_ids, special)]
+    words = sorted(set(w for w in word_ids if w >= 0), key=lambda w: -float(scores[w]))
+
+    def probs(kept):
+        kept = torch.tensor(kept, dtype=torch.long).unsqueeze(0)
+        return torch.softmax(classifier(input_ids=kept, attention_mask=torch.ones_like(kept))[0][0], dim=-1)
+
+    ret = [probs(ids.tolist())]
+    for threshold in thresholds:
+        rationale = set(words[:int(threshold * len(words))])
+        ret.append(probs([int(i) for i, w in zip(ids, word_ids) if w not in rationale]))
+        ret.append(probs([int(i) for i, w, s in zip(ids, word_ids, special) if w in rationale or s]))
+    return ret
+
+
+def flatten(instance):
+    ret = [instance['classification_scores']]
+    for thresholded in instance['thresholded_scores']:
+        ret.append(thresholded['comprehensiveness_classification_scores'])
+        ret.append(thresholded['sufficiency_classification_scores'])
+    return [torch.tensor([scores[k] for k in ('neg', 'pos')]) for scores in ret]
+
+
+@pytest.mark.parametrize('batch_size', [1, 4, 64])
+def test_wordpiece_scores_match_one_by_one_classification(batch_size):
+    classifier = CountClassifier()
+    scorer = AOPCScorer(classifier, ['neg', 'pos'], [CLS, SEP, PAD], PAD, batch_size=batch_size)
+    docs = documents()
+    results = scorer.score([ids for ids, _ in docs], [scores for _, scores in docs], THRESHOLDS)
+    for (ids, scores), instance in zip(docs, results):
+        expected = reference(classifier, ids, scores, THRESHOLDS)
+        for a, b in zip(flatten(instance), expected):
+            torch.testing.assert_close(a, b)
+        assert [t['threshold'] for t in instance['thresholded_scores']] == THRESHOLDS
+        assert instance['classification'] == ['neg', 'pos'][int(expected[0].argmax())]
+
+
+def test_word_rationales_keep_words_together():
+    classifier = CountClassifier()
+    scorer = AOPCScorer(classifier, ['neg', 'pos'], [CLS, SEP, PAD], PAD, batch_size=3)
+    docs, word_scores, word_ids = [], [], []
+    for ids, _ in documents():
+        # every word is two wordpieces, except the last
+        ids_word = torch.arange(len(ids)).sub(1).div(2, rounding_mode='floor')
+        docs.append(ids)
+        word_ids.append(ids_word)
+        word_scores.append(torch.rand(int(ids_word.max()) + 1))
+    fractions = [.3, .6, .2, .5, .9]
+    results = scorer.score(docs, word_scores, THRESHOLDS, fractions, word_ids=word_ids)
+    for ids, scores, ids_word, fraction, instance in zip(docs, word_scores, word_ids, fractions, results):
+        expected = reference(classifier, ids, scores, THRESHOLDS + [fraction], ids_word)
+        got = flatten(instance) + [torch.tensor([instance[f'{kind}_classification_scores'][k] for k in ('neg', 'pos')])
+                                   for kind in ('comprehensiveness', 'sufficiency')]
+        for a, b in zip(got, expected):
+            torch.testing.assert_close(a, b)
+
+
+class WordPieces:
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def convert_ids_to_tokens(self, input_ids):
+        return [self.tokens[int(i)] for i in input_ids]
+
+
+def test_word_ids_follow_the_score_alignment():
+    words = ['the', 'unbelievable', 'movie', "didn't", 'work']
+    pieces = ['[CLS]', 'the', 'un', '##believ', '##able', 'movie', 'didn', "'", 't', '[UNK]', '[SEP]']
+    tokenizer = WordPieces(pieces)
+    input_ids = torch.arange(len(pieces))
+    word_ids = word_ids_from_tokens(words, tokenizer, input_ids)
+    assert word_ids.tolist() == [-1, 0, 1, 1, 1, 2, 3, 3, 3, -1, -1]
+    # a word scores as the best of its wordpieces
+    token_scores = torch.rand(len(pieces))
+    word_scores = scores_per_word_from_scores_per_token(words, tokenizer, input_ids, token_scores)
+    for w, score in enumerate(word_scores):
+        assert score == token_scores[word_ids == w].max()
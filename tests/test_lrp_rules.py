@@ -0,0 +1,53 @@
+import pytest
+import torch
+
+from modules.lrp_rules import safe_divide, stabilizer
+
+
+def baseline_safe_divide(a, b):
+    den = b.clamp(min=1e-9) + b.clamp(max=1e-9)
+    den = den + den.eq(0).type(den.type()) * 1e-9
+    return a / den * b.ne(0).type(b.type())
+
+
+def operands(dtype):
+    torch.manual_seed(0)
+    b = torch.randn(1000, dtype=dtype)
+    b[::7] = 0
+    b[1::11] = 1e-12
+    b[2::13] = -1e-12
+    return torch.randn(1000, dtype=dtype), b
+
+
+def test_matches_baseline_away_from_zero():
+    a, b = operands(torch.float32)
+    large = b.abs() > 1e-6
+    torch.testing.assert_close(safe_divide(a, b)[large], baseline_safe_divide(a, b)[large], rtol=1e-5, atol=0)
+
+
+def test_zero_and_tiny_denominators():
+    a, b = operands(torch.float32)
+    result = safe_divide(a, b)
+    assert result.isfinite().all()
+    assert (result[b == 0] == 0).all()
+    # the stabilizer keeps the sign of the denominator
+    tiny = (b != 0) & (b.abs() < 1e-6)
+    assert (result[tiny].sign() == (a[tiny] * b[tiny]).sign()).all()
+    assert (result[tiny].abs() <= a[tiny].abs() / 1e-9).all()
+
+
+@pytest.mark.parametrize('dtype', [torch.float16, torch.bfloat16])
+def test_low_precision_stabilizer(dtype):
+    a, b = operands(dtype)
+    result = safe_divide(a, b)
+    assert stabilizer(dtype) == max(1e-9, torch.finfo(dtype).tiny)
+    assert result.isfinite().all()
+    assert (result[b == 0] == 0).all()
+
+
+def test_out_may_be_the_denominator():
+    a, b = operands(torch.float32)
+    expected = safe_divide(a, b)
+    result = safe_divide(a, b, out=b)
+    assert result.data_ptr() == b.data_ptr()
+    torch.testing.assert_close(result, expected, rtol=0, atol=0)
@@ -0,0 +1,214 @@
+from collections import defaultdict
+from itertools import chain
+
+import numpy as np
+import pytest
+from sklearn.metrics import auc, average_precision_score, precision_recall_curve, roc_auc_score, roc_curve
+
+from BERT_rationale_benchmark.metrics import (
+    PositionScoredDocument,
+    Rationale,
+    TokenBitmaps,
+    _best_ious,
+    _f1,
+    _ranked_curves,
+    _rationale_spans,
+    partial_match_score,
+    score_hard_rationale_predictions,
+    score_soft_tokens,
+    score_token_rationale_predictions,
+)
+
+
+def synthetic_rationales(seed, num_keys=8, max_length=60):
+    """Overlapping, nested, empty and repeated spans over keys that are only partly shared"""
+    rng = np.random.RandomState(seed)
+    ret = []
+    for k in range(num_keys):
+        if rng.rand() < .2:
+            continue
+        for _ in range(rng.randint(1, 6)):
+            start = rng.randint(max_length)
+            ret.append(Rationale(f'ann{k % 3}', f'doc{k}', start, min(start + rng.randint(0, 12), max_length)))
+        if rng.rand() < .3:
+            ret.append(ret[-1])
+    return ret
+
+
+SEEDS = [(0, 1), (2, 3), (4, 5), (6, 6)]
+
+
+def baseline_partial_match_score(truth, pred, thresholds):
+    """partial_match_score before interval arithmetic, verbatim"""
+    ann_to_rat = defaultdict(set)
+    for r in truth:
+        ann_to_rat[(r.ann_id, r.docid)].add(r)
+    pred_to_rat = defaultdict(set)
+    for r in pred:
+        pred_to_rat[(r.ann_id, r.docid)].add(r)
+
+    num_classifications = {k: len(v) for k, v in pred_to_rat.items()}
+    num_truth = {k: len(v) for k, v in ann_to_rat.items()}
+    ious = defaultdict(dict)
+    for k in set(ann_to_rat.keys()) | set(pred_to_rat.keys()):
+        for p in pred_to_rat.get(k, []):
+            best_iou = 0.0
+            for t in ann_to_rat.get(k, []):
+                num = len(set(range(p.start_token, p.end_token)) & set(range(t.start_token, t.end_token)))
+                denom = len(set(range(p.start_token, p.end_token)) | set(range(t.start_token, t.end_token)))
+                iou = 0 if denom == 0 else num / denom
+                if iou > best_iou:
+                    best_iou = iou
+            ious[k][p] = best_iou
+    scores = []
+    for threshold in thresholds:
+        threshold_tps = dict()
+        for k, vs in ious.items():
+            threshold_tps[k] = sum(int(x >= threshold) for x in vs.values())
+        micro_r = sum(threshold_tps.values()) / sum(num_truth.values()) if sum(num_truth.values()) > 0 else 0
+        micro_p = sum(threshold_tps.values()) / sum(num_classifications.values()) if sum(num_classifications.values()) > 0 else 0
+        micro_f1 = _f1(micro_r, micro_p)
+        macro_rs = list(threshold_tps.get(k, 0.0) / n if n > 0 else 0 for k, n in num_truth.items())
+        macro_ps = list(threshold_tps.get(k, 0.0) / n if n > 0 else 0 for k, n in num_classifications.items())
+        macro_r = sum(macro_rs) / len(macro_rs) if len(macro_rs) > 0 else 0
+        macro_p = sum(macro_ps) / len(macro_ps) if len(macro_ps) > 0 else 0
+        macro_f1 = _f1(macro_r, macro_p)
+        scores.append({'threshold': threshold,
+                       'micro': {'p': micro_p, 'r': micro_r, 'f1': micro_f1},
+                       'macro': {'p': macro_p, 'r': macro_r, 'f1': macro_f1}})
+    return scores
+
+
+def assert_scores_equal(actual, expected):
+    if isinstance(expected, dict):
+        assert actual.keys() == expected.keys()
+        for k in expected:
+            assert_scores_equal(actual[k], expected[k])
+    elif isinstance(expected, list):
+        assert len(actual) == len(expected)
+        for a, e in zip(actual, expected):
+            assert_scores_equal(a, e)
+    else:
+        assert actual == pytest.approx(expected, rel=1e-12, abs=1e-12)
+
+
+@pytest.mark.parametrize('seeds', SEEDS)
+def test_partial_match_score_matches_baseline(seeds):
+    truth, pred = synthetic_rationales(seeds[0]), synthetic_rationales(seeds[1])
+    thresholds = [0.0, 0.1, 0.25, 0.5, 0.75, 1.0]
+    assert_scores_equal(partial_match_score(truth, pred, thresholds), baseline_partial_match_score(truth, pred, thresholds))
+
+
+def test_partial_match_score_without_truth_or_predictions():
+    pred = synthetic_rationales(1)
+    assert_scores_equal(partial_match_score([], pred, [.5]), baseline_partial_match_score([], pred, [.5]))
+    assert_scores_equal(partial_match_score(pred, [], [.5]), baseline_partial_match_score(pred, [], [.5]))
+
+
+@pytest.mark.parametrize('seeds', SEEDS)
+def test_best_ious_match_brute_force(seeds):
+    key_to_id = dict()
+    truth_spans = _rationale_spans(synthetic_rationales(seeds[0]), key_to_id)
+    pred_spans = _rationale_spans(synthetic_rationales(seeds[1]), key_to_id)
+    expected = []
+    for key, start, end in pred_spans:
+        p = set(range(start, end))
+        best = 0.0
+        for t_key, t_start, t_end in truth_spans:
+            t = set(range(t_start, t_end))
+            if t_key == key and len(p | t) > 0:
+                best = max(best, len(p & t) / len(p | t))
+        expected.append(best)
+    np.testing.assert_array_equal(_best_ious(truth_spans, pred_spans), expected)
+
+
+@pytest.mark.parametrize('seeds', SEEDS)
+def test_token_scores_match_token_level_expansion(seeds):
+    truth, pred = synthetic_rationales(seeds[0]), synthetic_rationales(seeds[1])
+    # as metrics.main scored tokens before TokenBitmaps
+    token_level_truth = list(chain.from_iterable(rat.to_token_level() for rat in truth))
+    token_level_pred = list(chain.from_iterable(rat.to_token_level() for rat in pred))
+    assert_scores_equal(score_token_rationale_predictions(truth, pred),
+                        score_hard_rationale_predictions(token_level_truth, token_level_pred))
+
+
+def test_token_bitmaps_hold_the_token_sets():
+    rationales = synthetic_rationales(0, max_length=40)
+    key_to_id = dict()
+    spans = _rationale_spans(rationales, key_to_id)
+    lengths = np.zeros(len(key_to_id), dtype=np.int64)
+    np.maximum.at(lengths, spans[:, 0], spans[:, 2])
+    byte_offsets = np.concatenate([[0], np.cumsum(np.maximum((lengths + 7) // 8, 1))])
+    bitmaps = TokenBitmaps.from_spans(spans, key_to_id, byte_offsets)
+    tokens = defaultdict(set)
+    for rat in rationales:
+        tokens[(rat.ann_id, rat.docid)].update(range(rat.start_token, rat.end_token))
+    for key, i in key_to_id.items():
+        assert set(np.flatnonzero(bitmaps[key]).tolist()) == tokens[key]
+        assert bitmaps.counts()[i] == len(tokens[key])
+    np.testing.assert_array_equal(bitmaps.intersection_counts(bitmaps), bitmaps.counts())
+
+
+def baseline_score_soft_tokens(paired_scores):
+    """score_soft_tokens before the single pass, verbatim"""
+    truth = {(ps.ann_id, ps.docid): ps.truths for ps in paired_scores}
+    preds = {(ps.ann_id, ps.docid): ps.scores for ps in paired_scores}
+
+    def auprc():
+        if len(preds) == 0:
+            return 0.0
+        aucs = []
+        for k, true in truth.items():
+            precision, recall, _ = precision_recall_curve([int(t) for t in true], preds[k])
+            aucs.append(auc(recall, precision))
+        return np.average(aucs)
+
+    def aggregate(score_function):
+        if len(preds) == 0:
+            return 0.0
+        scores = []
+        for k, true in truth.items():
+            if all(true) or all(not x for x in true):
+                continue
+            scores.append(score_function([int(t) for t in true], preds[k]))
+        return np.average(scores)
+
+    return {
+        'auprc': auprc(),
+        'average_precision': aggregate(average_precision_score),
+        'roc_auc_score': aggregate(roc_auc_score),
+    }
+
+
+def synthetic_soft_scores(seed):
+    """Documents with tied scores, and some with a single class"""
+    rng = np.random.RandomState(seed)
+    ret = []
+    for i in range(12):
+        length = rng.randint(1, 40)
+        truths = rng.rand(length) < rng.choice([0, .2, .5, 1])
+        scores = np.round(rng.rand(length), rng.choice([1, 2, 6]))
+        ret.append(PositionScoredDocument(f'ann{i}', f'doc{i}', tuple(scores.tolist()), tuple(truths.tolist())))
+    return ret
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_soft_token_scores_match_baseline(seed):
+    paired_scores = synthetic_soft_scores(seed)
+    assert_scores_equal(score_soft_tokens(paired_scores), baseline_score_soft_tokens(paired_scores))
+
+
+def test_ranked_curves_match_sklearn():
+    paired_scores = synthetic_soft_scores(0)
+    truth = {(ps.ann_id, ps.docid): ps.truths for ps in paired_scores}
+    preds = {(ps.ann_id, ps.docid): ps.scores for ps in paired_scores}
+    doc, tps, fps, positives, negatives = _ranked_curves(truth, preds)
+    for i, key in enumerate(truth):
+        true = np.array(truth[key])
+        assert positives[i] == true.sum() and negatives[i] == (~true).sum()
+        if true.all() or not true.any():
+            continue
+        fpr, tpr, _ = roc_curve(true, preds[key], drop_intermediate=False)
+        # sklearn prepends the (0, 0) point
+        np.testing.assert_allclose(fps[doc == i] / negatives[i], fpr[1:])
+        np.testing.assert_allclose(tps[doc == i] / positives[i], tpr[1:])
@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from BERT_rationale_benchmark.models.model_utils import extract_embeddings, load_embedding_cache
+
+
+def write_embeddings(path, rows, mtime_ns):
+    with open(path, 'w') as of:
+        for word, vector in rows:
+            of.write(' '.join([word] + [repr(float(v)) for v in vector]) + '\n')
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def random_rows(seed, words):
+    rng = np.random.RandomState(seed)
+    return [(word, rng.randn(5).astype(np.float32)) for word in words]
+
+
+def test_txt_embeddings_match_the_file(tmp_path):
+    path = str(tmp_path / 'vectors.txt')
+    rows = random_rows(0, ['the', 'cat', 'PAD', 'sat', 'cat', 'mat'])
+    write_embeddings(path, rows, 10 ** 18)
+    embedding, interner, deinterner = extract_embeddings({'cat', 'sat', 'dog'}, path)
+    # as the dict the embeddings used to be parsed into: a repeated word keeps its last vector
+    by_word = dict(rows)
+    assert deinterner == ['PAD', 'UNK', 'cat', 'sat']
+    assert interner == {word: i for i, word in enumerate(deinterner)}
+    torch.testing.assert_close(embedding.weight[interner['cat']], torch.from_numpy(by_word['cat']))
+    torch.testing.assert_close(embedding.weight[interner['sat']], torch.from_numpy(by_word['sat']))
+    torch.testing.assert_close(embedding.weight[interner['PAD']], torch.from_numpy(by_word['PAD']))
+    torch.testing.assert_close(embedding.weight[interner['UNK']],
+                               torch.from_numpy(np.stack([v for _, v in rows]).mean(axis=0)))
+
+
+def test_cache_is_rebuilt_when_the_file_changes(tmp_path):
+    path = str(tmp_path / 'vectors.txt')
+    write_embeddings(path, random_rows(0, ['a', 'b']), 10 ** 18)
+    matrix, word_rows, _ = load_embedding_cache(path)
+    assert word_rows == {'a': 0, 'b': 1}
+    assert sorted(os.listdir(tmp_path)) == ['vectors.txt', 'vectors.txt.mean.npy', 'vectors.txt.npy',
+                                           'vectors.txt.stamp', 'vectors.txt.vocab']
+    built = os.stat(path + '.npy').st_mtime_ns
+
+    # unchanged, the cache is reused
+    load_embedding_cache(path)
+    assert os.stat(path + '.npy').st_mtime_ns == built
+
+    rows = random_rows(1, ['a', 'b', 'c'])
+    write_embeddings(path, rows, 2 * 10 ** 18)
+    matrix, word_rows, mean_vector = load_embedding_cache(path)
+    assert word_rows == {'a': 0, 'b': 1, 'c': 2}
+    np.testing.assert_array_equal(matrix, np.stack([v for _, v in rows]))
+    np.testing.assert_allclose(mean_vector, np.stack([v for _, v in rows]).mean(axis=0), rtol=1e-6)
+
+
+def test_interrupted_build_is_redone(tmp_path):
+    path = str(tmp_path / 'vectors.txt')
+    rows = random_rows(0, ['a', 'b'])
+    write_embeddings(path, rows, 10 ** 18)
+    load_embedding_cache(path)
+    os.remove(path + '.stamp')
+    with open(path + '.vocab', 'w') as of:
+        of.write('a\n')
+    _, word_rows, _ = load_embedding_cache(path)
+    assert word_rows == {'a': 0, 'b': 1}
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        extract_embeddings({'a'}, 'vectors.csv')
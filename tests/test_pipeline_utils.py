@@ -0,0 +1,77 @@
+import random
+import sys
+
+import pytest
+import torch
+import torch.nn as nn
+
+import BERT_rationale_benchmark
+
+# the pipeline modules import the benchmark under its upstream package name
+sys.modules.setdefault('rationale_benchmark', BERT_rationale_benchmark)
+
+from BERT_rationale_benchmark.models.pipeline.pipeline_utils import (  # noqa: E402
+    SentenceEvidence,
+    make_preds_epoch,
+    make_token_preds_epoch,
+)
+
+
+class SumClassifier(nn.Module):
+    """Per element logits that do not depend on what else is in the batch"""
+
+    def forward(self, queries, ids, sentences, aggregate_spans=None):
+        return torch.stack([torch.stack([(q.sum() + s.sum()).float().sin(), (q.float() @ torch.ones(len(q))).cos()
+                                         + len(s)]) for q, s in zip(queries, sentences)])
+
+
+class SumTagger(nn.Module):
+    """Per token probabilities, zero padded to the longest sentence of the batch"""
+
+    def forward(self, queries, ids, sentences, aggregate_spans):
+        width = max(len(s) for s in sentences)
+        return torch.stack([nn.functional.pad(torch.sigmoid(s.float() - 5 + q.sum() % 3), (0, width - len(s)))
+                            for q, s in zip(queries, sentences)])
+
+
+def _data(token_targets):
+    rng = random.Random(0)
+    data = []
+    for i in range(23):
+        query = tuple(rng.randrange(10) for _ in range(rng.randint(1, 4)))
+        sentence = tuple(rng.randrange(10) for _ in range(rng.randint(1, 9)))
+        kls = tuple(rng.randrange(2) for _ in sentence) if token_targets else rng.randrange(2)
+        data.append(SentenceEvidence(kls=kls, query=query, ann_id=f'a{i}', docid=f'd{i % 4}', index=i, sentence=sentence))
+    return data
+
+
+@pytest.mark.parametrize('batch_size', [1, 4, 7])
+def test_packed_preds_match_default(batch_size):
+    data = _data(token_targets=False)
+    criterion = nn.CrossEntropyLoss(reduction='none')
+    loss, soft, hard, truth = make_preds_epoch(SumClassifier(), data, batch_size, criterion=criterion)
+    p_loss, p_soft, p_hard, p_truth = make_preds_epoch(SumClassifier(), data, batch_size, criterion=criterion,
+                                                       packed=True)
+    assert p_loss == pytest.approx(loss)
+    assert len(p_soft) == len(soft)
+    for a, b in zip(p_soft, soft):
+        torch.testing.assert_close(a, b)
+    assert p_hard == hard
+    assert p_truth == truth
+
+
+@pytest.mark.parametrize('batch_size', [3, 4, 7])
+def test_packed_token_preds_match_default(batch_size):
+    data = _data(token_targets=True)
+    token_mapping = {f'd{d}': [[(0, 1)]] * len(data) for d in range(4)}
+    criterion = nn.BCELoss(reduction='none')
+    loss, soft, hard, truth = make_token_preds_epoch(SumTagger(), data, token_mapping, batch_size,
+                                                     criterion=criterion)
+    p_loss, p_soft, p_hard, p_truth = make_token_preds_epoch(SumTagger(), data, token_mapping, batch_size,
+                                                             criterion=criterion, packed=True)
+    assert p_loss == pytest.approx(loss)
+    for s, a, b in zip(data, p_soft, soft):
+        # each path pads to the longest sentence of its own batch
+        assert a[:len(s.sentence)] == b[:len(s.sentence)]
+    assert [x.tolist() for x in p_hard] == [x.tolist() for x in hard]
+    assert p_truth == truth
@@ -0,0 +1,271 @@
+import json
+import os
+from itertools import chain
+
+import numpy as np
+import pytest
+import torch
+
+from BERT_rationale_benchmark.metrics import Rationale, partial_match_score, score_hard_rationale_predictions
+from BERT_rationale_benchmark.utils import (
+    AnnotationTable,
+    HardRationaleWriter,
+    InternedDocuments,
+    PackedDocuments,
+    annotations_from_jsonl,
+    build_packed_documents,
+    intern_annotations,
+    intern_documents,
+    iter_documents,
+    load_documents,
+    load_hard_rationales,
+    scan_annotations,
+)
+
+THRESHOLDS = range(5, 85, 5)
+
+
+def baseline_hard_rationale_files(documents, directory):
+    """The per threshold jsonl files bert_pipeline wrote before HardRationaleWriter, verbatim"""
+    result_files = []
+    for i in THRESHOLDS:
+        result_files.append(open(directory / f'identifier_results_{i}.json', 'w'))
+    for doc_name, cam in documents:
+        hard_rationales = []
+        for res, i in enumerate(THRESHOLDS):
+            _, indices = cam.topk(k=i)
+            for index in indices.tolist():
+                hard_rationales.append({
+                    "start_token": index,
+                    "end_token": index + 1
+                })
+            result_dict = {
+                "annotation_id": doc_name,
+                "rationales": [{
+                    "docid": doc_name,
+                    "hard_rationale_predictions": hard_rationales
+                }],
+            }
+            result_files[res].write(json.dumps(result_dict) + "\n")
+    for f in result_files:
+        f.close()
+
+
+def synthetic_documents():
+    torch.manual_seed(0)
+    # distinct scores, so that topk and the stable ranking agree on the order
+    return [(f'doc{i}', torch.randperm(length).float() / length) for i, length in enumerate([90, 120, 85, 200])]
+
+
+def synthetic_truth(documents):
+    rng = np.random.RandomState(0)
+    truth = []
+    for docid, cam in documents:
+        for _ in range(3):
+            start = rng.randint(len(cam) - 10)
+            truth.append(Rationale(docid, docid, start, start + rng.randint(1, 10)))
+    return truth
+
+
+def rationales(instances):
+    return [r for instance in instances for r in Rationale.from_instance(instance)]
+
+
+def test_hard_rationales_round_trip_to_baseline_scores(tmp_path):
+    documents = synthetic_documents()
+    baseline_hard_rationale_files(documents, tmp_path)
+    with HardRationaleWriter(str(tmp_path / 'identifier_results.tsv'), thresholds=THRESHOLDS) as writer:
+        for docid, cam in documents:
+            writer.write(docid, cam)
+    truth = synthetic_truth(documents)
+    truth_tokens = [t for r in truth for t in r.to_token_level()]
+    for k in THRESHOLDS:
+        with open(tmp_path / f'identifier_results_{k}.json') as inf:
+            baseline = [json.loads(line) for line in inf]
+        loaded = load_hard_rationales(str(tmp_path / 'identifier_results.tsv'), k)
+        assert [i['annotation_id'] for i in loaded] == [i['annotation_id'] for i in baseline]
+        # the baseline files accumulate the rationales of the lower thresholds as duplicates
+        assert set(rationales(loaded)) == set(rationales(baseline))
+        assert len(rationales(loaded)) == k * len(documents)
+        assert score_hard_rationale_predictions(truth_tokens, rationales(loaded)) == \
+            score_hard_rationale_predictions(truth_tokens, rationales(baseline))
+        assert partial_match_score(truth, rationales(loaded), [.1, .5]) == \
+            partial_match_score(truth, rationales(baseline), [.1, .5])
+
+
+def test_rankings_are_prefixes(tmp_path):
+    path = str(tmp_path / 'rationales.tsv')
+    scores = np.array([.1, .9, .5, .9, .3])
+    with HardRationaleWriter(path, thresholds=[3, 1, 2]) as writer:
+        writer.write('a', scores)
+    # ties keep document order
+    assert [[p['start_token'] for p in i['rationales'][0]['hard_rationale_predictions']]
+            for k in (1, 2, 3) for i in load_hard_rationales(path, k)] == [[1], [1, 3], [1, 3, 2]]
+    assert load_hard_rationales(path, 4) == []
+
+
+def test_more_thresholds_than_tokens(tmp_path):
+    path = str(tmp_path / 'rationales.tsv')
+    with HardRationaleWriter(path, thresholds=[1, 10]) as writer:
+        writer.write('a', [.2, .7])
+    # where cam.topk(k=10) raised, a short document keeps all of its tokens
+    assert [p['start_token'] for p in load_hard_rationales(path, 10)[0]['rationales'][0]['hard_rationale_predictions']] == [1, 0]
+
+
+DOCUMENTS = {
+    'negR_000.txt': 'the film is dull\nand far too long .',
+    'posR_001.txt': 'a warm , funny movie\nwith a great cast\n',
+    'posR_002.txt': 'caf\u00e9 na\u00efve \u2013 r\u00e9sum\u00e9\nsecond line',
+    'negR_003.txt': 'single',
+    'unused.txt': 'never referenced by an annotation',
+}
+
+ANNOTATIONS = {
+    'train': [
+        {'annotation_id': 'negR_000.txt', 'classification': 'NEG', 'query': 'what is the sentiment ?',
+         'query_type': None, 'docids': None,
+         'evidences': [[{'docid': 'negR_000.txt', 'text': 'dull', 'start_token': 3, 'end_token': 4,
+                         'start_sentence': 0, 'end_sentence': 1}],
+                       [{'docid': 'negR_000.txt', 'text': 'far too long', 'start_token': 5, 'end_token': 8,
+                         'start_sentence': 1, 'end_sentence': 2}],
+                       # a repeated group, which the set of groups keeps once
+                       [{'docid': 'negR_000.txt', 'text': 'dull', 'start_token': 3, 'end_token': 4,
+                         'start_sentence': 0, 'end_sentence': 1}]]},
+        {'annotation_id': 'posR_001.txt', 'classification': 'POS', 'query': 'what is the sentiment ?',
+         'query_type': 'sentiment', 'docids': None,
+         'evidences': [[{'docid': 'posR_001.txt', 'text': 'warm , funny', 'start_token': 1, 'end_token': 4,
+                         'start_sentence': 0, 'end_sentence': 1},
+                        {'docid': 'posR_001.txt', 'text': 'great cast', 'start_token': 7, 'end_token': 9,
+                         'start_sentence': 1, 'end_sentence': 2}],
+                       []]},
+    ],
+    'val': [
+        {'annotation_id': 'posR_002.txt', 'classification': 'POS', 'query': 'na\u00efve query',
+         'query_type': None, 'docids': None,
+         'evidences': [[{'docid': 'posR_002.txt', 'text': 'r\u00e9sum\u00e9', 'start_token': 3, 'end_token': 4,
+                         'start_sentence': 0, 'end_sentence': 1}]]},
+    ],
+    'test': [
+        {'annotation_id': 'negR_003.txt', 'classification': 'NEG', 'query': 'unknown words here',
+         'query_type': None, 'docids': None,
+         'evidences': [[{'docid': 'negR_003.txt', 'text': 'single', 'start_token': 0, 'end_token': 1,
+                         'start_sentence': 0, 'end_sentence': 1}]]},
+    ],
+}
+
+
+@pytest.fixture(params=['docs', 'docs.jsonl'])
+def data_dir(request, tmp_path):
+    if request.param == 'docs':
+        os.makedirs(tmp_path / 'docs')
+        for docid, text in DOCUMENTS.items():
+            with open(tmp_path / 'docs' / docid, 'w') as of:
+                of.write(text)
+    else:
+        with open(tmp_path / 'docs.jsonl', 'w') as of:
+            for docid, text in DOCUMENTS.items():
+                of.write(json.dumps({'docid': docid, 'document': text}) + '\n')
+    for split, annotations in ANNOTATIONS.items():
+        with open(tmp_path / f'{split}.jsonl', 'w') as of:
+            for annotation in annotations:
+                of.write(json.dumps(annotation) + '\n')
+    return str(tmp_path)
+
+
+def baseline_load_documents(data_dir, docids=None):
+    """load_documents before the packed store, verbatim"""
+    if os.path.exists(os.path.join(data_dir, 'docs.jsonl')):
+        with open(os.path.join(data_dir, 'docs.jsonl'), 'r') as inf:
+            return {doc['docid']: doc['document'] for doc in map(json.loads, inf)}
+    docs_dir = os.path.join(data_dir, 'docs')
+    res = dict()
+    if docids is None:
+        docids = sorted(os.listdir(docs_dir))
+    else:
+        docids = sorted(set(str(d) for d in docids))
+    for d in docids:
+        with open(os.path.join(docs_dir, d), 'r') as inf:
+            res[d] = inf.read()
+    return res
+
+
+def test_packed_documents_match_the_files(data_dir):
+    subset = {'posR_002.txt', 'negR_000.txt'}
+    unpacked = load_documents(data_dir), load_documents(data_dir, subset)
+    assert unpacked == (baseline_load_documents(data_dir), baseline_load_documents(data_dir, subset))
+
+    path = build_packed_documents(data_dir)
+    with PackedDocuments(path) as store:
+        assert list(store) == sorted(DOCUMENTS)
+        assert dict(store) == DOCUMENTS
+        with pytest.raises(KeyError):
+            store['missing.txt']
+    assert load_documents(data_dir) == DOCUMENTS
+    assert load_documents(data_dir, subset) == {d: DOCUMENTS[d] for d in subset}
+    assert dict(iter_documents(data_dir)) == DOCUMENTS
+    assert dict(iter_documents(data_dir, subset)) == {d: DOCUMENTS[d] for d in subset}
+
+
+def test_empty_packed_store(tmp_path):
+    os.makedirs(tmp_path / 'docs')
+    with PackedDocuments(build_packed_documents(str(tmp_path))) as store:
+        assert len(store) == 0
+
+
+def test_scan_annotations_matches_loaded_annotations(data_dir):
+    for split in ANNOTATIONS:
+        path = os.path.join(data_dir, f'{split}.jsonl')
+        annotations = annotations_from_jsonl(path)
+        # as pipeline_train collected them from the loaded annotations
+        docids = set(e.docid for e in chain.from_iterable(chain.from_iterable(ann.evidences for ann in annotations)))
+        vocab = set(chain.from_iterable(e.query.split() for e in annotations))
+        assert scan_annotations(path) == (docids, vocab)
+
+
+def word_interner():
+    words = sorted(set(chain.from_iterable(text.split() for text in DOCUMENTS.values())) - {'long', 'cast'})
+    return {word: i for i, word in enumerate(['UNK'] + words)}
+
+
+def sentences(text):
+    return [line.split() for line in text.split('\n')]
+
+
+def as_lists(interned_document):
+    return [sentence.tolist() for sentence in interned_document]
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_interned_documents_match_intern_documents(data_dir, packed, tmp_path_factory):
+    if packed:
+        build_packed_documents(data_dir)
+    interner = word_interner()
+    docids = {'negR_000.txt', 'posR_001.txt', 'posR_002.txt', 'negR_003.txt'}
+    expected = intern_documents({d: sentences(DOCUMENTS[d]) for d in docids}, interner, 'UNK')
+    table = InternedDocuments.from_data_dir(data_dir, interner, 'UNK', docids)
+    assert sorted(table) == sorted(docids)
+    for docid in docids:
+        assert as_lists(table[docid]) == expected[docid]
+        assert table.flattened(docid).tolist() == list(chain.from_iterable(expected[docid]))
+    directory = str(tmp_path_factory.mktemp('interned'))
+    table.save(directory)
+    loaded = InternedDocuments.load(directory)
+    assert {d: as_lists(loaded[d]) for d in loaded} == expected
+    from_documents = InternedDocuments.from_documents({d: sentences(DOCUMENTS[d]) for d in docids}, interner, 'UNK')
+    assert {d: as_lists(from_documents[d]) for d in from_documents} == expected
+
+
+def test_annotation_table_matches_intern_annotations(data_dir, tmp_path_factory):
+    interner = word_interner()
+    for split in ANNOTATIONS:
+        path = os.path.join(data_dir, f'{split}.jsonl')
+        expected = intern_annotations(annotations_from_jsonl(path), interner, 'UNK')
+        from_jsonl = AnnotationTable.from_jsonl(path, interner, 'UNK')
+        from_annotations = AnnotationTable.from_annotations(annotations_from_jsonl(path), interner, 'UNK')
+        assert list(from_jsonl) == expected
+        assert list(from_annotations) == expected
+        assert from_jsonl[-1] == expected[-1]
+        assert from_jsonl[:1] == expected[:1]
+        directory = str(tmp_path_factory.mktemp(split))
+        from_jsonl.save(directory)
+        assert list(AnnotationTable.load(directory)) == expected
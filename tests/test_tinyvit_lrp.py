@@ -0,0 +1,61 @@
+import pytest
+import torch
+
+from transformer_explainability.baselines.ViT.TinyVIT_LRP import TinyViT
+
+
+def tiny_vit(low, high):
+    torch.manual_seed(0)
+    model = TinyViT(embed_dims=[16, 32, 48, 64], depths=[1, 2, 2, 1], num_heads=[2, 2, 3, 4],
+                    window_sizes=[7, 7, 7, 7], num_classes=10)
+    for m in model.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.uniform_(-.1, .1)
+            m.running_var.uniform_(.5, 2)
+            torch.nn.init.uniform_(m.weight, low, high)
+            torch.nn.init.uniform_(m.bias, -.1, .1)
+    return model.eval()
+
+
+def explain(model, image, method):
+    output = model(image)
+    one_hot = torch.zeros_like(output)
+    one_hot[0, output.argmax()] = 1
+    (output * one_hot).sum().backward()
+    return output.detach(), model.relprop(one_hot, method=method, alpha=1)
+
+
+@pytest.mark.parametrize('bn_weights', [(.5, 1.5), (-1.5, 1.5)])
+@pytest.mark.parametrize('method', ['full', 'transformer_attribution'])
+def test_fused_relprop_matches_unfused(bn_weights, method):
+    model = tiny_vit(*bn_weights)
+    image = torch.randn(1, 3, 224, 224)
+    output, cam = explain(model, image, method)
+    model.set_fused(True)
+    fused_output, fused_cam = explain(model, image, method)
+    torch.testing.assert_close(fused_output, output, rtol=1e-4, atol=1e-5)
+    # the folded forward rounds differently, which moves a few pixels of the full maps by as much as an input
+    # perturbation of 1e-6 does
+    assert torch.nn.functional.cosine_similarity(fused_cam.flatten(), cam.flatten(), dim=0) > 0.9999
+    torch.testing.assert_close(fused_cam, cam, rtol=0, atol=5e-3 * cam.abs().max().item())
+
+
+def test_pretrained_checkpoint_is_memory_mapped(tmp_path, monkeypatch):
+    from transformer_explainability.baselines.ViT import helpers
+    from transformer_explainability.baselines.ViT.TinyVIT_LRP import _create_tiny_vit
+    small = dict(embed_dims=[16, 32, 48, 64], depths=[1, 2, 2, 1], num_heads=[2, 2, 3, 4], window_sizes=[7, 7, 7, 7])
+    source = tiny_vit(.5, 1.5)
+    checkpoint = tmp_path / 'tiny_vit.pth'
+    torch.save({'model': source.state_dict()}, checkpoint)
+    loads = []
+    torch_load = torch.load
+    monkeypatch.setattr(helpers, '_load_url', lambda url: helpers._torch_load(str(checkpoint)))
+    monkeypatch.setattr(helpers.torch, 'load', lambda *args, **kwargs: loads.append(kwargs) or torch_load(*args, **kwargs))
+    model = _create_tiny_vit('tiny_vit_21m_224', True, num_classes=10, **small)
+    if helpers._LOAD_MMAP:
+        assert loads == [dict(map_location='cpu', mmap=True)]
+    # the checkpoint's head is for the 1000 classes of the config, so it is dropped
+    for name, tensor in source.state_dict().items():
+        if not name.startswith('head.') and not name.endswith('attention_bias_idxs'):
+            assert torch.equal(model.state_dict()[name], tensor)
+    assert model.head.weight.shape == (10, 64)
@@ -0,0 +1,46 @@
+import warnings
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from baselines.ViT.ViT_explanation_generator import LRP
+from modules.lrp_rules import Policy
+
+METHODS = ['transformer_attribution', 'full', 'rollout', 'last_layer', 'last_layer_attn', 'second_layer']
+
+
+def cosine(a, b):
+    return F.cosine_similarity(a.flatten().float(), b.flatten().float(), dim=0).item()
+
+
+@pytest.mark.parametrize('generate', ['generate_LRP', 'generate_LRP_autograd'])
+@pytest.mark.parametrize('method', METHODS)
+def test_bfloat16_relprop_matches_float32(no_cuda, vit, generate, method):
+    generator = LRP(vit)
+    image = torch.randn(1, 3, 224, 224)
+    reference = getattr(generator, generate)(image, index=3, method=method)
+    cam = getattr(generator, generate)(image, index=3, method=method, policy=Policy(compute_dtype=torch.bfloat16))
+    assert cosine(reference, cam) > 0.999
+
+
+@pytest.mark.parametrize('method', ['transformer_attribution', 'full'])
+def test_float32_policy_does_not_autocast(no_cuda, vit, method):
+    generator = LRP(vit)
+    image = torch.randn(1, 3, 224, 224)
+    reference = generator.generate_LRP(image, index=3, method=method)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        cam = generator.generate_LRP(image, index=3, method=method, policy=Policy(compute_dtype=torch.float32),
+                                     autocast_forward=True)
+    torch.testing.assert_close(cam, reference)
+
+
+def test_autocast_forward_is_opt_in(no_cuda, vit):
+    generator = LRP(vit)
+    image = torch.randn(1, 3, 224, 224)
+    policy = Policy(compute_dtype=torch.bfloat16)
+    generator.generate_LRP(image, index=3, method='full', policy=policy)
+    assert vit.blocks[0].mlp.fc2.X.dtype == torch.float32
+    generator.generate_LRP(image, index=3, method='full', policy=policy, autocast_forward=True)
+    assert vit.blocks[0].mlp.fc2.X.dtype == torch.bfloat16
@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from baselines.ViT.ViT_LRP_functional import explain
+from modules.layers_ours import GELU
+
+
+def relprop(model, image, target, method):
+    output = model(image)
+    one_hot = torch.zeros_like(output)
+    one_hot[0, target] = 1
+    model.zero_grad()
+    (output * one_hot).sum().backward(retain_graph=True)
+    return model.relprop(one_hot, method=method, alpha=1)
+
+
+@pytest.mark.parametrize('method', ['transformer_attribution', 'rollout', 'full'])
+def test_explain_matches_relprop(vit, method):
+    torch.manual_seed(1)
+    images = torch.randn(2, 3, 224, 224)
+    targets = torch.tensor([3, 7])
+    cams = explain(vit, images, targets, method)
+    for image, target, cam in zip(images, targets.tolist(), cams):
+        reference = relprop(vit, image[None], target, method)[0]
+        torch.testing.assert_close(cam, reference, rtol=1e-4, atol=1e-5 * reference.abs().max().item())
+
+
+def test_explain_rejects_models_it_does_not_replay(vit):
+    images = torch.randn(1, 3, 224, 224)
+    targets = torch.tensor([3])
+    vit.blocks[1].mlp.act = GELU(approximate='tanh')
+    with pytest.raises(AssertionError, match='GELU'):
+        explain(vit, images, targets)
+    vit.blocks[1].mlp.act = GELU()
+    vit.head = torch.nn.Sequential(vit.head)
+    with pytest.raises(AssertionError, match='Linear head'):
+        explain(vit, images, targets)
+
+
+def test_explain_rejects_other_pooling(vit):
+    class MeanPooled(type(vit)):
+        def forward(self, x):
+            return super().forward(x)
+
+    vit.__class__ = MeanPooled
+    with pytest.raises(AssertionError, match='overrides'):
+        explain(vit, torch.randn(1, 3, 224, 224), torch.tensor([3]))
@@ -3,6 +3,8 @@ import numpy as np
 import torch
 import glob
 
+from modules.layers_ours import attention_backward
+
 # compute rollout between attention layers
 def compute_rollout_attention(all_layer_matrices, start_layer=0):
     # adding residual consideration- code adapted from https://github.com/samiraabnar/attention_flow
@@ -39,13 +41,12 @@ class Generator:
         one_hot = torch.from_numpy(one_hot).requires_grad_(True)
         one_hot = torch.sum(one_hot.cuda() * output)
 
-        self.model.zero_grad()
-        one_hot.backward(retain_graph=True)
+        blocks = self.model.bert.encoder.layer
+        attention_backward(one_hot, [blk.attention.self.get_attn() for blk in blocks])
 
         self.model.relprop(torch.tensor(one_hot_vector).to(input_ids.device), **kwargs)
 
         cams = []
-        blocks = self.model.bert.encoder.layer
         for blk in blocks:
             grad = blk.attention.self.get_attn_gradients()
             cam = blk.attention.self.get_attn_cam()
@@ -69,11 +70,7 @@ class Generator:
         one_hot = np.zeros((1, output.size()[-1]), dtype=np.float32)
         one_hot[0, index] = 1
         one_hot_vector = one_hot
-        one_hot = torch.from_numpy(one_hot).requires_grad_(True)
-        one_hot = torch.sum(one_hot.cuda() * output)
-
-        self.model.zero_grad()
-        one_hot.backward(retain_graph=True)
+        # relprop reads no attention gradients here, so there is no backward
 
         self.model.relprop(torch.tensor(one_hot_vector).to(input_ids.device), **kwargs)
 
@@ -93,11 +90,7 @@ class Generator:
         one_hot = np.zeros((1, output.size()[-1]), dtype=np.float32)
         one_hot[0, index] = 1
         one_hot_vector = one_hot
-        one_hot = torch.from_numpy(one_hot).requires_grad_(True)
-        one_hot = torch.sum(one_hot.cuda() * output)
-
-        self.model.zero_grad()
-        one_hot.backward(retain_graph=True)
+        # relprop reads no attention gradients here, so there is no backward
 
         cam = self.model.relprop(torch.tensor(one_hot_vector).to(input_ids.device), **kwargs)
         cam = cam.sum(dim=2)
@@ -138,8 +131,7 @@ class Generator:
         one_hot = torch.from_numpy(one_hot).requires_grad_(True)
         one_hot = torch.sum(one_hot.cuda() * output)
 
-        self.model.zero_grad()
-        one_hot.backward(retain_graph=True)
+        attention_backward(one_hot, [self.model.bert.encoder.layer[-1].attention.self.get_attn()])
 
         self.model.relprop(torch.tensor(one_hot_vector).to(input_ids.device), **kwargs)
 
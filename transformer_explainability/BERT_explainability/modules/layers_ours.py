@@ -1,18 +1,14 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from modules.lrp_rules import (AlphaBetaRule, ZBRule, compute_dtype_of, einsum_grad_equations, einsum_gradients,
+                               linear_gradprop, rule_for, safe_divide)
 
 __all__ = ['forward_hook', 'Clone', 'Add', 'Cat', 'ReLU', 'GELU', 'Dropout', 'BatchNorm2d', 'Linear', 'MaxPool2d',
            'AdaptiveAvgPool2d', 'AvgPool2d', 'Conv2d', 'Sequential', 'safe_divide', 'einsum', 'Softmax', 'IndexSelect',
            'LayerNorm', 'AddEye', 'Tanh', 'MatMul', 'Mul']
 
 
-def safe_divide(a, b):
-    den = b.clamp(min=1e-9) + b.clamp(max=1e-9)
-    den = den + den.eq(0).type(den.type()) * 1e-9
-    return a / den * b.ne(0).type(b.type())
-
-
 def forward_hook(self, input, output):
     if type(input[0]) in (list, tuple):
         self.X = []
@@ -24,7 +20,8 @@ def forward_hook(self, input, output):
         self.X = input[0].detach()
         self.X.requires_grad = True
 
-    self.Y = output
+    # detached, so that Y does not keep the forward graph alive
+    self.Y = output.detach() if torch.is_tensor(output) else [y.detach() for y in output]
 
 
 def backward_hook(self, grad_input, grad_output):
@@ -42,15 +39,20 @@ class RelProp(nn.Module):
         C = torch.autograd.grad(Z, X, S, retain_graph=True)
         return C
 
-    def relprop(self, R, alpha):
+    def relprop(self, R, alpha, policy=None):
         return R
 
 
 class RelPropSimple(RelProp):
-    def relprop(self, R, alpha):
+    def relevance_gradients(self, R):
+        # gradients of <Z, R / Z> with respect to the inputs, by differentiating a recomputed forward.
+        # Layers with a closed form override this and reuse the output captured by forward_hook.
         Z = self.forward(self.X)
         S = safe_divide(R, Z)
-        C = self.gradprop(Z, self.X, S)
+        return self.gradprop(Z, self.X, S)
+
+    def relprop(self, R, alpha, policy=None):
+        C = self.relevance_gradients(R)
 
         if torch.is_tensor(self.X) == False:
             outputs = []
@@ -65,6 +67,9 @@ class AddEye(RelPropSimple):
     def forward(self, input):
         return input + torch.eye(input.shape[2]).expand_as(input).to(input.device)
 
+    def relevance_gradients(self, R):
+        return (safe_divide(R, self.Y.detach()),)
+
 class ReLU(nn.ReLU, RelProp):
     pass
 
@@ -78,6 +83,11 @@ class Mul(RelPropSimple):
     def forward(self, inputs):
         return torch.mul(*inputs)
 
+    def relevance_gradients(self, R):
+        a, b = self.X
+        S = safe_divide(R, self.Y.detach())
+        return (S * b).sum_to_size(a.shape), (S * a).sum_to_size(b.shape)
+
 class Tanh(nn.Tanh, RelProp):
     pass
 class LayerNorm(nn.LayerNorm, RelProp):
@@ -90,6 +100,14 @@ class MatMul(RelPropSimple):
     def forward(self, inputs):
         return torch.matmul(*inputs)
 
+    def relevance_gradients(self, R):
+        a, b = self.X
+        if a.dim() < 2 or b.dim() < 2 or a.shape[:-2] != b.shape[:-2]:
+            # vector or broadcasting matmul
+            return super().relevance_gradients(R)
+        S = safe_divide(R, self.Y.detach())
+        return torch.matmul(S, b.transpose(-1, -2)), torch.matmul(a.transpose(-1, -2), S)
+
 class MaxPool2d(nn.MaxPool2d, RelPropSimple):
     pass
 
@@ -108,10 +126,12 @@ class Add(RelPropSimple):
     def forward(self, inputs):
         return torch.add(*inputs)
 
-    def relprop(self, R, alpha):
-        Z = self.forward(self.X)
-        S = safe_divide(R, Z)
-        C = self.gradprop(Z, self.X, S)
+    def relevance_gradients(self, R):
+        S = safe_divide(R, self.Y.detach())
+        return S.sum_to_size(self.X[0].shape), S.sum_to_size(self.X[1].shape)
+
+    def relprop(self, R, alpha, policy=None):
+        C = self.relevance_gradients(R)
 
         a = self.X[0] * C[0]
         b = self.X[1] * C[1]
@@ -133,9 +153,17 @@ class einsum(RelPropSimple):
     def __init__(self, equation):
         super().__init__()
         self.equation = equation
+        self.grad_equations = einsum_grad_equations(equation)
     def forward(self, *operands):
         return torch.einsum(self.equation, *operands)
 
+    def relevance_gradients(self, R):
+        if self.grad_equations is None or torch.is_tensor(self.X) or len(self.X) != 2:
+            return super().relevance_gradients(R)
+        a, b = self.X
+        S = safe_divide(R, self.Y.detach())
+        return einsum_gradients(self.grad_equations, a, b, S)
+
 class IndexSelect(RelProp):
     def forward(self, inputs, dim, indices):
         self.__setattr__('dim', dim)
@@ -143,10 +171,9 @@ class IndexSelect(RelProp):
 
         return torch.index_select(inputs, dim, indices)
 
-    def relprop(self, R, alpha):
-        Z = self.forward(self.X, self.dim, self.indices)
-        S = safe_divide(R, Z)
-        C = self.gradprop(Z, self.X, S)
+    def relprop(self, R, alpha, policy=None):
+        S = safe_divide(R, self.Y.detach())
+        C = (torch.zeros_like(self.X).index_add_(self.dim, self.indices, S),)
 
         if torch.is_tensor(self.X) == False:
             outputs = []
@@ -167,12 +194,10 @@ class Clone(RelProp):
 
         return outputs
 
-    def relprop(self, R, alpha):
-        Z = []
-        for _ in range(self.num):
-            Z.append(self.X)
-        S = [safe_divide(r, z) for r, z in zip(R, Z)]
-        C = self.gradprop(Z, self.X, S)[0]
+    def relprop(self, R, alpha, policy=None):
+        # every output is X itself, so the gradient is the sum of the S
+        S = [safe_divide(r, self.X) for r in R]
+        C = sum(S)
 
         R = self.X * C
 
@@ -184,10 +209,9 @@ class Cat(RelProp):
         self.__setattr__('dim', dim)
         return torch.cat(inputs, dim)
 
-    def relprop(self, R, alpha):
-        Z = self.forward(self.X, self.dim)
-        S = safe_divide(R, Z)
-        C = self.gradprop(Z, self.X, S)
+    def relprop(self, R, alpha, policy=None):
+        S = safe_divide(R, self.Y.detach())
+        C = S.split([x.shape[self.dim] for x in self.X], dim=self.dim)
 
         outputs = []
         for x, c in zip(self.X, C):
@@ -197,14 +221,14 @@ class Cat(RelProp):
 
 
 class Sequential(nn.Sequential):
-    def relprop(self, R, alpha):
+    def relprop(self, R, alpha, policy=None):
         for m in reversed(self._modules.values()):
-            R = m.relprop(R, alpha)
+            R = m.relprop(R, alpha, policy=policy)
         return R
 
 
 class BatchNorm2d(nn.BatchNorm2d, RelProp):
-    def relprop(self, R, alpha):
+    def relprop(self, R, alpha, policy=None):
         X = self.X
         beta = 1 - alpha
         weight = self.weight.unsqueeze(0).unsqueeze(2).unsqueeze(3) / (
@@ -217,76 +241,29 @@ class BatchNorm2d(nn.BatchNorm2d, RelProp):
 
 
 class Linear(nn.Linear, RelProp):
-    def relprop(self, R, alpha):
-        beta = alpha - 1
-        pw = torch.clamp(self.weight, min=0)
-        nw = torch.clamp(self.weight, max=0)
-        px = torch.clamp(self.X, min=0)
-        nx = torch.clamp(self.X, max=0)
-
-        def f(w1, w2, x1, x2):
-            Z1 = F.linear(x1, w1)
-            Z2 = F.linear(x2, w2)
-            S1 = safe_divide(R, Z1 + Z2)
-            S2 = safe_divide(R, Z1 + Z2)
-            C1 = x1 * self.gradprop(Z1, x1, S1)[0]
-            C2 = x2 * self.gradprop(Z2, x2, S2)[0]
+    def rule_forward(self, x, w):
+        return F.linear(x, w)
 
-            return C1 + C2
+    def rule_gradprop(self, S, w):
+        return linear_gradprop(S, w)
 
-        activator_relevances = f(pw, nw, px, nx)
-        inhibitor_relevances = f(nw, pw, px, nx)
-
-        R = alpha * activator_relevances - beta * inhibitor_relevances
-
-        return R
+    @torch.no_grad()
+    def relprop(self, R, alpha, policy=None):
+        return rule_for(self, policy, AlphaBetaRule(alpha, joint=True))(self, R, compute_dtype_of(policy))
 
 
 class Conv2d(nn.Conv2d, RelProp):
-    def gradprop2(self, DY, weight):
-        Z = self.forward(self.X)
-
-        output_padding = self.X.size()[2] - (
-                (Z.size()[2] - 1) * self.stride[0] - 2 * self.padding[0] + self.kernel_size[0])
-
-        return F.conv_transpose2d(DY, weight, stride=self.stride, padding=self.padding, output_padding=output_padding)
-
-    def relprop(self, R, alpha):
-        if self.X.shape[1] == 3:
-            pw = torch.clamp(self.weight, min=0)
-            nw = torch.clamp(self.weight, max=0)
-            X = self.X
-            L = self.X * 0 + \
-                torch.min(torch.min(torch.min(self.X, dim=1, keepdim=True)[0], dim=2, keepdim=True)[0], dim=3,
-                          keepdim=True)[0]
-            H = self.X * 0 + \
-                torch.max(torch.max(torch.max(self.X, dim=1, keepdim=True)[0], dim=2, keepdim=True)[0], dim=3,
-                          keepdim=True)[0]
-            Za = torch.conv2d(X, self.weight, bias=None, stride=self.stride, padding=self.padding) - \
-                 torch.conv2d(L, pw, bias=None, stride=self.stride, padding=self.padding) - \
-                 torch.conv2d(H, nw, bias=None, stride=self.stride, padding=self.padding) + 1e-9
-
-            S = R / Za
-            C = X * self.gradprop2(S, self.weight) - L * self.gradprop2(S, pw) - H * self.gradprop2(S, nw)
-            R = C
-        else:
-            beta = alpha - 1
-            pw = torch.clamp(self.weight, min=0)
-            nw = torch.clamp(self.weight, max=0)
-            px = torch.clamp(self.X, min=0)
-            nx = torch.clamp(self.X, max=0)
-
-            def f(w1, w2, x1, x2):
-                Z1 = F.conv2d(x1, w1, bias=None, stride=self.stride, padding=self.padding)
-                Z2 = F.conv2d(x2, w2, bias=None, stride=self.stride, padding=self.padding)
-                S1 = safe_divide(R, Z1)
-                S2 = safe_divide(R, Z2)
-                C1 = x1 * self.gradprop(Z1, x1, S1)[0]
-                C2 = x2 * self.gradprop(Z2, x2, S2)[0]
-                return C1 + C2
-
-            activator_relevances = f(pw, nw, px, nx)
-            inhibitor_relevances = f(nw, pw, px, nx)
-
-            R = alpha * activator_relevances - beta * inhibitor_relevances
-        return R
\ No newline at end of file
+    def rule_forward(self, x, w):
+        return F.conv2d(x, w, bias=None, stride=self.stride, padding=self.padding)
+
+    def rule_gradprop(self, S, w):
+        # the gradient of <F.conv2d(x, w), S> with respect to x, x of the size of X with the channels of w,
+        # so that weights stacked along dim 1 give the gradients for each of them at once
+        size = (S.shape[0], w.shape[1]) + self.X.shape[2:]
+        return torch.nn.grad.conv2d_input(size, w, S, stride=self.stride, padding=self.padding)
+
+    @torch.no_grad()
+    def relprop(self, R, alpha, policy=None):
+        # the z^B rule for the image input, alpha-beta elsewhere
+        default = ZBRule() if self.X.shape[1] == 3 else AlphaBetaRule(alpha)
+        return rule_for(self, policy, default)(self, R, compute_dtype_of(policy))
\ No newline at end of file
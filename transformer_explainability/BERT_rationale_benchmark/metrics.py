@@ -7,18 +7,19 @@ import pprint
 from collections import Counter, defaultdict, namedtuple
 from dataclasses import dataclass
 from itertools import chain
-from typing import Any, Callable, Dict, List, Set, Tuple
+from typing import Any, Dict, List, Set, Tuple
 
 import numpy as np
 import torch
 
 from scipy.stats import entropy
-from sklearn.metrics import accuracy_score, auc, average_precision_score, classification_report, precision_recall_curve, roc_auc_score
+from sklearn.metrics import accuracy_score, classification_report
 
 from BERT_rationale_benchmark.utils import (
     Annotation,
     Evidence,
     annotations_from_jsonl,
+    load_hard_rationales,
     load_jsonl,
     load_documents,
     load_flattened_documents
@@ -97,6 +98,42 @@ class PositionScoredDocument:
                 ret.append(PositionScoredDocument(inst['annotation_id'], docid, tuple(scores), tuple(key_to_annotation[key])))
         return ret
 
+@dataclass(eq=False, frozen=True)
+class TokenBitmaps:
+    """Token level rationales as bit-packed bitmaps, one per (ann_id, docid) key.
+
+    Each key owns the byte aligned slice bits[byte_offsets[i]:byte_offsets[i + 1]] where i = key_to_id[key].
+    Bitmaps built over the same key_to_id and byte_offsets share a layout, so token level
+    intersections are a bitwise and followed by a popcount per key.
+    """
+    key_to_id: Dict[Tuple[str, str], int]
+    byte_offsets: np.ndarray
+    bits: np.ndarray
+
+    @classmethod
+    def from_spans(cls, spans: np.ndarray, key_to_id: Dict[Tuple[str, str], int], byte_offsets: np.ndarray) -> 'TokenBitmaps':
+        """Builds bitmaps from a (key id, start, end) array as produced by _rationale_spans"""
+        marks = np.zeros(int(byte_offsets[-1]) * 8 + 1, dtype=np.int32)
+        bit_offsets = byte_offsets[spans[:, 0]] * 8
+        np.add.at(marks, bit_offsets + spans[:, 1], 1)
+        np.add.at(marks, bit_offsets + np.maximum(spans[:, 2], spans[:, 1]), -1)
+        return cls(key_to_id, byte_offsets, np.packbits(np.cumsum(marks[:-1]) > 0))
+
+    def __getitem__(self, key: Tuple[str, str]) -> np.ndarray:
+        i = self.key_to_id[key]
+        return np.unpackbits(self.bits[self.byte_offsets[i]:self.byte_offsets[i + 1]]).astype(bool)
+
+    def counts(self) -> np.ndarray:
+        return _popcounts(self.bits, self.byte_offsets)
+
+    def intersection_counts(self, other: 'TokenBitmaps') -> np.ndarray:
+        return _popcounts(self.bits & other.bits, self.byte_offsets)
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def _popcounts(bits: np.ndarray, byte_offsets: np.ndarray) -> np.ndarray:
+    return np.add.reduceat(_POPCOUNT[bits], byte_offsets[:-1], dtype=np.int64)
+
 def _f1(_p, _r):
     if _p == 0 or _r == 0:
         return 0
@@ -108,6 +145,47 @@ def _keyed_rationale_from_list(rats: List[Rationale]) -> Dict[Tuple[str, str], R
         ret[(r.ann_id, r.docid)].add(r)
     return ret
 
+def _rationale_spans(rats: List[Rationale], key_to_id: Dict[Tuple[str, str], int]) -> np.ndarray:
+    """Encodes rationales as a deduplicated (key id, start, end) int64 array, sorted by key and start"""
+    if len(rats) == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+    spans = np.array([(key_to_id.setdefault((r.ann_id, r.docid), len(key_to_id)), r.start_token, r.end_token)
+                      for r in rats], dtype=np.int64)
+    return np.unique(spans, axis=0)
+
+def _best_ious(truth_spans: np.ndarray, pred_spans: np.ndarray) -> np.ndarray:
+    """For every predicted span, the best intersection-over-union with any true span of the same key.
+
+    Truth spans are sorted by (key, start). For a prediction, every overlapping truth lies between the
+    first truth whose running maximum end passes the prediction start and the last truth starting before
+    the prediction end, so only those candidate pairs are expanded and scored arithmetically.
+    """
+    best = np.zeros(len(pred_spans), dtype=np.float64)
+    if len(truth_spans) == 0 or len(pred_spans) == 0:
+        return best
+    t_key, t_start, t_end = truth_spans.T
+    p_key, p_start, p_end = pred_spans.T
+    t_end = np.maximum(t_end, t_start)
+    p_end = np.maximum(p_end, p_start)
+    # offsetting every key by more than the largest position lets one searchsorted cover all keys at once
+    stride = max(t_end.max(), p_end.max()) + 2
+    t_start_keyed = t_key * stride + t_start
+    t_end_keyed = np.maximum.accumulate(t_key * stride + t_end)
+    lo = np.searchsorted(t_end_keyed, p_key * stride + p_start, side='right')
+    hi = np.searchsorted(t_start_keyed, p_key * stride + p_end, side='left')
+    counts = np.maximum(hi - lo, 0)
+    if counts.sum() == 0:
+        return best
+    pair_pred = np.repeat(np.arange(len(pred_spans)), counts)
+    pair_offsets = np.cumsum(counts) - counts
+    pair_truth = np.arange(counts.sum()) - np.repeat(pair_offsets - lo, counts)
+    inter = np.maximum(np.minimum(p_end[pair_pred], t_end[pair_truth]) - np.maximum(p_start[pair_pred], t_start[pair_truth]), 0)
+    union = (p_end - p_start)[pair_pred] + (t_end - t_start)[pair_truth] - inter
+    ious = np.divide(inter, union, out=np.zeros(len(inter), dtype=np.float64), where=union > 0)
+    has_pairs = counts > 0
+    best[has_pairs] = np.maximum.reduceat(ious, pair_offsets[has_pairs])
+    return best
+
 def partial_match_score(truth: List[Rationale], pred: List[Rationale], thresholds: List[float]) -> List[Dict[str, Any]]:
     """Computes a partial match F1
 
@@ -121,46 +199,38 @@ def partial_match_score(truth: List[Rationale], pred: List[Rationale], threshold
     instance (annotation + document) precisions and recalls, averaging those,
     and finally computing an F1 of the resulting average.
     """
-
-    ann_to_rat = _keyed_rationale_from_list(truth)
-    pred_to_rat = _keyed_rationale_from_list(pred)
-
-    num_classifications = {k:len(v) for k,v in pred_to_rat.items()}
-    num_truth = {k:len(v) for k,v in ann_to_rat.items()}
-    ious = defaultdict(dict)
-    for k in set(ann_to_rat.keys()) | set(pred_to_rat.keys()):
-        for p in pred_to_rat.get(k, []):
-            best_iou = 0.0
-            for t in ann_to_rat.get(k, []):
-                num = len(set(range(p.start_token, p.end_token)) & set(range(t.start_token, t.end_token)))
-                denom = len(set(range(p.start_token, p.end_token)) | set(range(t.start_token, t.end_token)))
-                iou = 0 if denom == 0 else num / denom
-                if iou > best_iou:
-                    best_iou = iou
-            ious[k][p] = best_iou
+    key_to_id = dict()
+    truth_spans = _rationale_spans(truth, key_to_id)
+    pred_spans = _rationale_spans(pred, key_to_id)
+    num_truth = np.bincount(truth_spans[:, 0], minlength=len(key_to_id))
+    num_classifications = np.bincount(pred_spans[:, 0], minlength=len(key_to_id))
+    truth_keys = num_truth > 0
+    pred_keys = num_classifications > 0
+
+    ious = _best_ious(truth_spans, pred_spans)
+    # (thresholds x keys) true positive counts
+    hits = ious[None, :] >= np.asarray(thresholds, dtype=np.float64)[:, None]
+    threshold_tps = np.zeros((len(thresholds), len(key_to_id)), dtype=np.int64)
+    np.add.at(threshold_tps, (slice(None), pred_spans[:, 0]), hits)
+    total_tps = threshold_tps.sum(axis=1)
+    total_truth = num_truth.sum()
+    total_classifications = num_classifications.sum()
+    micro_rs = total_tps / total_truth if total_truth > 0 else np.zeros(len(thresholds))
+    micro_ps = total_tps / total_classifications if total_classifications > 0 else np.zeros(len(thresholds))
+    macro_rs = (threshold_tps[:, truth_keys] / num_truth[truth_keys]).mean(axis=1) if truth_keys.any() else np.zeros(len(thresholds))
+    macro_ps = (threshold_tps[:, pred_keys] / num_classifications[pred_keys]).mean(axis=1) if pred_keys.any() else np.zeros(len(thresholds))
     scores = []
-    for threshold in thresholds:
-        threshold_tps = dict()
-        for k, vs in ious.items():
-            threshold_tps[k] = sum(int(x >= threshold) for x in vs.values())
-        micro_r = sum(threshold_tps.values()) / sum(num_truth.values()) if sum(num_truth.values()) > 0 else 0
-        micro_p = sum(threshold_tps.values()) / sum(num_classifications.values()) if sum(num_classifications.values()) > 0 else 0
-        micro_f1 = _f1(micro_r, micro_p)
-        macro_rs = list(threshold_tps.get(k, 0.0) / n if n > 0 else 0 for k, n in num_truth.items())
-        macro_ps = list(threshold_tps.get(k, 0.0) / n if n > 0 else 0 for k, n in num_classifications.items())
-        macro_r = sum(macro_rs) / len(macro_rs) if len(macro_rs) > 0 else 0
-        macro_p = sum(macro_ps) / len(macro_ps) if len(macro_ps) > 0 else 0
-        macro_f1 = _f1(macro_r, macro_p)
+    for threshold, micro_r, micro_p, macro_r, macro_p in zip(thresholds, micro_rs.tolist(), micro_ps.tolist(), macro_rs.tolist(), macro_ps.tolist()):
         scores.append({'threshold': threshold,
                        'micro': {
                             'p': micro_p,
                             'r': micro_r,
-                            'f1': micro_f1
+                            'f1': _f1(micro_r, micro_p)
                        },
                        'macro': {
                             'p': macro_p,
                             'r': macro_r,
-                            'f1': macro_f1
+                            'f1': _f1(macro_r, macro_p)
                        },
                        })
     return scores
@@ -214,42 +284,111 @@ def score_hard_rationale_predictions(truth: List[Rationale], pred: List[Rational
                                }
     return scores
 
-def _auprc(truth: Dict[Any, List[bool]], preds: Dict[Any, List[float]]) -> float:
-    if len(preds) == 0:
-        return 0.0
-    assert len(truth.keys() and preds.keys()) == len(truth.keys())
-    aucs = []
-    for k, true in truth.items():
-        pred = preds[k]
-        true = [int(t) for t in true]
-        precision, recall, _ = precision_recall_curve(true, pred)
-        aucs.append(auc(recall, precision))
-    return np.average(aucs)
-
-def _score_aggregator(truth: Dict[Any, List[bool]], preds: Dict[Any, List[float]], score_function: Callable[[List[float], List[float]], float ], discard_single_class_answers: bool) -> float:
-    if len(preds) == 0:
-        return 0.0
-    assert len(truth.keys() and preds.keys()) == len(truth.keys())
-    scores = []
-    for k, true in truth.items():
-        pred = preds[k]
-        if (all(true) or all(not x for x in true)) and discard_single_class_answers:
-            continue
-        true = [int(t) for t in true]
-        scores.append(score_function(true, pred))
-    return np.average(scores)
+def score_token_rationale_predictions(truth: List[Rationale], pred: List[Rationale]) -> Dict[str, Dict[str, float]]:
+    """Computes the token level equivalent of score_hard_rationale_predictions over TokenBitmaps
+
+    Gives the same scores as calling score_hard_rationale_predictions on the to_token_level()
+    expansion of every rationale, without materializing a Rationale per token.
+    """
+    key_to_id = dict()
+    truth_spans = _rationale_spans(truth, key_to_id)
+    pred_spans = _rationale_spans(pred, key_to_id)
+    lengths = np.zeros(len(key_to_id), dtype=np.int64)
+    np.maximum.at(lengths, truth_spans[:, 0], truth_spans[:, 2])
+    np.maximum.at(lengths, pred_spans[:, 0], pred_spans[:, 2])
+    byte_offsets = np.concatenate([[0], np.cumsum(np.maximum((lengths + 7) // 8, 1))])
+    truth_bits = TokenBitmaps.from_spans(truth_spans, key_to_id, byte_offsets)
+    pred_bits = TokenBitmaps.from_spans(pred_spans, key_to_id, byte_offsets)
+    num_truth = truth_bits.counts()
+    num_pred = pred_bits.counts()
+    tps = truth_bits.intersection_counts(pred_bits)
+
+    scores = dict()
+    micro_prec = tps.sum() / num_pred.sum() if num_pred.sum() > 0 else 0
+    micro_rec = tps.sum() / num_truth.sum() if num_truth.sum() > 0 else 0
+    scores['instance_micro'] = {
+                                'p': float(micro_prec),
+                                'r': float(micro_rec),
+                                'f1': float(_f1(micro_prec, micro_rec)),
+                               }
+
+    # only keys with at least one token take part, as they would in the per token sets
+    present = (num_truth > 0) | (num_pred > 0)
+    tps, num_truth, num_pred = tps[present], num_truth[present], num_pred[present]
+    instance_prec = np.divide(tps, num_pred, out=np.zeros(len(tps)), where=num_pred > 0)
+    instance_rec = np.divide(tps, num_truth, out=np.zeros(len(tps)), where=num_truth > 0)
+    denom = instance_prec + instance_rec
+    instance_f1 = np.divide(2 * instance_prec * instance_rec, denom, out=np.zeros(len(tps)), where=denom > 0)
+    scores['instance_macro'] = {
+                                'p': float(instance_prec.mean()) if len(tps) > 0 else 0,
+                                'r': float(instance_rec.mean()) if len(tps) > 0 else 0,
+                                'f1': float(instance_f1.mean()) if len(tps) > 0 else 0,
+                               }
+    return scores
+
+def _ranked_curves(truth: Dict[Any, List[bool]], preds: Dict[Any, List[float]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Computes the ranking curve of every document in one sort-and-segment pass
+
+    All documents are concatenated into ragged arrays and sorted by (document, descending score).
+    As in sklearn's _binary_clf_curve, a curve point sits at the last position of every run of
+    tied scores. Returns the document of every point, the true and false positive counts at
+    every point, and the number of positives and negatives of every document.
+    """
+    keys = [k for k, true in truth.items() if len(true) > 0]
+    lengths = np.array([len(truth[k]) for k in keys], dtype=np.int64)
+    total = int(lengths.sum())
+    doc = np.repeat(np.arange(len(keys)), lengths)
+    y_true = np.fromiter(chain.from_iterable(truth[k] for k in keys), dtype=bool, count=total)
+    y_score = np.fromiter(chain.from_iterable(preds[k] for k in keys), dtype=np.float64, count=total)
+    order = np.lexsort((-y_score, doc))
+    y_true, y_score = y_true[order], y_score[order]
+
+    starts = np.cumsum(lengths) - lengths
+    cum_true = np.cumsum(y_true)
+    tps = cum_true - np.repeat(cum_true[starts] - y_true[starts], lengths)
+    ranks = np.arange(1, total + 1) - np.repeat(starts, lengths)
+    positives = tps[starts + lengths - 1]
+    negatives = lengths - positives
+    last = np.ones(total, dtype=bool)
+    last[:-1] = (doc[1:] != doc[:-1]) | (y_score[1:] != y_score[:-1])
+    return doc[last], tps[last], ranks[last] - tps[last], positives, negatives
+
+def _segment_trapezoids(x: np.ndarray, y: np.ndarray, x_0: float, y_0: float, first: np.ndarray, starts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Per segment step areas (dx * y) and trapezoid areas of a curve that starts at (x_0, y_0)"""
+    prev_x = np.where(first, x_0, np.roll(x, 1))
+    prev_y = np.where(first, y_0, np.roll(y, 1))
+    dx = x - prev_x
+    return np.add.reduceat(dx * y, starts), np.add.reduceat(dx * (y + prev_y) / 2, starts)
 
 def score_soft_tokens(paired_scores: List[PositionScoredDocument]) -> Dict[str, float]:
+    """Computes AUPRC, average precision and ROC AUC averaged over documents
+
+    Matches calling sklearn's precision_recall_curve + auc, average_precision_score and
+    roc_auc_score per document, with average precision and ROC AUC skipping documents that
+    contain a single class, but scores every document at once.
+    """
     truth = {(ps.ann_id, ps.docid): ps.truths for ps in paired_scores}
     pred = {(ps.ann_id, ps.docid): ps.scores for ps in paired_scores}
-    auprc_score = _auprc(truth, pred)
-    ap = _score_aggregator(truth, pred, average_precision_score, True)
-    roc_auc = _score_aggregator(truth, pred, roc_auc_score, True)
-
+    if len(pred) == 0:
+        return {'auprc': 0.0, 'average_precision': 0.0, 'roc_auc_score': 0.0}
+    doc, tps, fps, positives, negatives = _ranked_curves(truth, pred)
+    first = np.ones(len(doc), dtype=bool)
+    first[1:] = doc[1:] != doc[:-1]
+    starts = np.flatnonzero(first)
+
+    precision = tps / (tps + fps)
+    # sklearn sets recall to one at every threshold when a document has no positives
+    recall = np.divide(tps, positives[doc], out=np.ones(len(tps)), where=positives[doc] > 0)
+    ap, auprc = _segment_trapezoids(recall, precision, 0.0, 1.0, first, starts)
+    fpr = np.divide(fps, negatives[doc], out=np.zeros(len(fps)), where=negatives[doc] > 0)
+    tpr = np.divide(tps, positives[doc], out=np.zeros(len(tps)), where=positives[doc] > 0)
+    _, roc_auc = _segment_trapezoids(fpr, tpr, 0.0, 0.0, first, starts)
+
+    two_classes = (positives > 0) & (negatives > 0)
     return {
-             'auprc': auprc_score,
-             'average_precision': ap,
-             'roc_auc_score': roc_auc,
+             'auprc': np.average(auprc),
+             'average_precision': np.average(ap[two_classes]),
+             'roc_auc_score': np.average(roc_auc[two_classes]),
            }
 
 def _instances_aopc(instances: List[dict], thresholds: List[float], key: str) -> Tuple[float, List[float]]:
@@ -608,8 +747,14 @@ def main():
     ''')
     parser.add_argument('--score_file', dest='score_file', required=False, default=None, help='Where to write results?')
     parser.add_argument('--aopc_thresholds', nargs='+', required=False, type=float, default=[0.01, 0.05, 0.1, 0.2, 0.5], help='Thresholds for AOPC Thresholds')
+    parser.add_argument('--top_k', dest='top_k', required=False, type=int, default=None, help='Which top-k threshold to score when --results is a .tsv written by HardRationaleWriter')
     args = parser.parse_args()
-    results = load_jsonl(args.results)
+    if args.results.endswith('.tsv'):
+        if args.top_k is None:
+            raise ValueError("--top_k must be provided when scoring a .tsv rationale file")
+        results = load_hard_rationales(args.results, args.top_k)
+    else:
+        results = load_jsonl(args.results)
     docids = set(chain.from_iterable([rat['docid'] for rat in res['rationales']] for res in results))
     docs = load_flattened_documents(args.data_dir, docids)
     verify_instances(results, docs)
@@ -634,9 +779,7 @@ def main():
         # NER style scoring
         rationale_level_prf = score_hard_rationale_predictions(truth, pred)
         scores['rationale_prf'] = rationale_level_prf
-        token_level_truth = list(chain.from_iterable(rat.to_token_level() for rat in truth))
-        token_level_pred = list(chain.from_iterable(rat.to_token_level() for rat in pred))
-        token_level_prf = score_hard_rationale_predictions(token_level_truth, token_level_pred)
+        token_level_prf = score_token_rationale_predictions(truth, pred)
         scores['token_prf'] = token_level_prf
     else:
         logging.info("No hard predictions detected, skipping rationale scoring")
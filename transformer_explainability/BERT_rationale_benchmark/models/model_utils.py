@@ -1,8 +1,10 @@
+import os
+import shutil
+
 from dataclasses import dataclass
-from typing import Dict, List, Set
+from typing import Dict, List, Set, Tuple
 
 import numpy as np
-from gensim.models import KeyedVectors
 
 import torch
 from torch import nn
@@ -89,67 +91,93 @@ class PaddedSequence:
         return PaddedSequence(self.data.transpose(0, 1), not self.batch_first, self.padding_value)
 
 
-def extract_embeddings(vocab: Set[str], embedding_file: str, unk_token: str = 'UNK', pad_token: str = 'PAD') -> (
-nn.Embedding, Dict[str, int], List[str]):
-    vocab = vocab | set([unk_token, pad_token])
+def _source_stamp(embedding_file: str) -> str:
+    stat = os.stat(embedding_file)
+    return f'{stat.st_size} {stat.st_mtime_ns}\n'
+
+
+def _build_embedding_cache(embedding_file: str, matrix_file: str, vocab_file: str, mean_file: str):
     if embedding_file.endswith('.bin'):
+        from gensim.models import KeyedVectors
         WVs = KeyedVectors.load_word2vec_format(embedding_file, binary=True)
-
-        word_to_vector = dict()
-        WV_matrix = np.matrix([WVs[v] for v in WVs.vocab.keys()])
-
-        if unk_token not in WVs:
-            mean_vector = np.mean(WV_matrix, axis=0)
-            word_to_vector[unk_token] = mean_vector
-        if pad_token not in WVs:
-            word_to_vector[pad_token] = np.zeros(WVs.vector_size)
-
-        for v in vocab:
-            if v in WVs:
-                word_to_vector[v] = WVs[v]
-
-        interner = dict()
-        deinterner = list()
-        vectors = []
-        count = 0
-        for word in [pad_token, unk_token] + sorted(list(word_to_vector.keys() - {unk_token, pad_token})):
-            vector = word_to_vector[word]
-            vectors.append(np.array(vector))
-            interner[word] = count
-            deinterner.append(word)
-            count += 1
-        vectors = torch.FloatTensor(np.array(vectors))
-        embedding = nn.Embedding.from_pretrained(vectors, padding_idx=interner[pad_token])
-        embedding.weight.requires_grad = False
-        return embedding, interner, deinterner
+        words = list(WVs.index_to_key) if hasattr(WVs, 'index_to_key') else list(WVs.index2word)
+        matrix = WVs.vectors.astype(np.float32)
+        np.save(matrix_file, matrix)
+        mean_vector = matrix.mean(axis=0)
     elif embedding_file.endswith('.txt'):
-        word_to_vector = dict()
-        vector = []
-        with open(embedding_file, 'r') as inf:
+        # a single pass over the text, writing the rows to a raw file until their number is known
+        words = []
+        total = None
+        raw_file = matrix_file + '.raw'
+        with open(embedding_file, 'r') as inf, open(raw_file, 'wb') as raw:
             for line in inf:
                 contents = line.strip().split()
-                word = contents[0]
-                vector = torch.tensor([float(v) for v in contents[1:]]).unsqueeze(0)
-                word_to_vector[word] = vector
-        embed_size = vector.size()
-        if unk_token not in word_to_vector:
-            mean_vector = torch.cat(list(word_to_vector.values()), dim=0).mean(dim=0)
-            word_to_vector[unk_token] = mean_vector.unsqueeze(0)
-        if pad_token not in word_to_vector:
-            word_to_vector[pad_token] = torch.zeros(embed_size)
-        interner = dict()
-        deinterner = list()
-        vectors = []
-        count = 0
-        for word in [pad_token, unk_token] + sorted(list(word_to_vector.keys() - {unk_token, pad_token})):
-            vector = word_to_vector[word]
-            vectors.append(vector)
-            interner[word] = count
-            deinterner.append(word)
-            count += 1
-        vectors = torch.cat(vectors, dim=0)
-        embedding = nn.Embedding.from_pretrained(vectors, padding_idx=interner[pad_token])
-        embedding.weight.requires_grad = False
-        return embedding, interner, deinterner
+                words.append(contents[0])
+                row = np.array(contents[1:], dtype=np.float32)
+                total = row.astype(np.float64) if total is None else total + row
+                row.tofile(raw)
+        with open(matrix_file, 'wb') as of, open(raw_file, 'rb') as raw:
+            np.lib.format.write_array_header_1_0(of, {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                                                      'fortran_order': False,
+                                                      'shape': (len(words), len(total))})
+            shutil.copyfileobj(raw, of)
+        os.remove(raw_file)
+        mean_vector = (total / len(words)).astype(np.float32)
     else:
         raise ValueError("Unable to open embeddings file {}".format(embedding_file))
+    np.save(mean_file, mean_vector)
+    with open(vocab_file, 'w') as of:
+        for word in words:
+            of.write(word)
+            of.write('\n')
+
+
+def load_embedding_cache(embedding_file: str) -> Tuple[np.ndarray, Dict[str, int], np.ndarray]:
+    """Returns a memory mapped float32 embedding matrix, its word to row index and the mean vector.
+
+    The first call converts the .bin/.txt embeddings file into <embedding_file>.npy (the matrix),
+    <embedding_file>.vocab (one word per matrix row) and <embedding_file>.mean.npy next to it, and
+    records the size and modification time of the embeddings file in <embedding_file>.stamp.
+    Later calls only read the vocabulary and map the matrix, unless the embeddings file changed.
+    """
+    matrix_file = embedding_file + '.npy'
+    vocab_file = embedding_file + '.vocab'
+    mean_file = embedding_file + '.mean.npy'
+    stamp_file = embedding_file + '.stamp'
+    stamp = _source_stamp(embedding_file)
+    # the stamp is written last, so an interrupted build is redone as well
+    current = all(os.path.exists(f) for f in (matrix_file, vocab_file, mean_file, stamp_file))
+    if current:
+        with open(stamp_file, 'r') as inf:
+            current = inf.read() == stamp
+    if not current:
+        _build_embedding_cache(embedding_file, matrix_file, vocab_file, mean_file)
+        with open(stamp_file, 'w') as of:
+            of.write(stamp)
+    with open(vocab_file, 'r') as inf:
+        # as with a dict built while parsing, a repeated word keeps its last vector
+        word_rows = {word.rstrip('\n'): row for row, word in enumerate(inf)}
+    return np.load(matrix_file, mmap_mode='r'), word_rows, np.load(mean_file)
+
+
+def extract_embeddings(vocab: Set[str], embedding_file: str, unk_token: str = 'UNK', pad_token: str = 'PAD') -> (
+nn.Embedding, Dict[str, int], List[str]):
+    if not (embedding_file.endswith('.bin') or embedding_file.endswith('.txt')):
+        raise ValueError("Unable to open embeddings file {}".format(embedding_file))
+    vocab = vocab | set([unk_token, pad_token])
+    matrix, word_rows, mean_vector = load_embedding_cache(embedding_file)
+
+    deinterner = [pad_token, unk_token] + sorted((vocab & word_rows.keys()) - {unk_token, pad_token})
+    interner = {word: i for i, word in enumerate(deinterner)}
+    vectors = np.zeros((len(deinterner), matrix.shape[1]), dtype=np.float32)
+    if unk_token not in word_rows:
+        vectors[interner[unk_token]] = mean_vector
+    # only the rows of the vocabulary are read from the mapped matrix, in file order
+    in_file = [word for word in deinterner if word in word_rows]
+    rows = np.array([word_rows[word] for word in in_file], dtype=np.int64)
+    order = np.argsort(rows)
+    vectors[np.array([interner[in_file[i]] for i in order], dtype=np.int64)] = matrix[rows[order]]
+
+    embedding = nn.Embedding.from_pretrained(torch.from_numpy(vectors), padding_idx=interner[pad_token])
+    embedding.weight.requires_grad = False
+    return embedding, interner, deinterner
@@ -19,6 +19,7 @@ from BERT_explainability.modules.BERT.ExplanationGenerator import Generator
 from BERT_rationale_benchmark.utils import (
     Annotation,
     Evidence,
+    HardRationaleWriter,
     write_jsonl,
     load_datasets,
     load_documents,
@@ -27,6 +28,7 @@ from BERT_explainability.modules.BERT.BertForSequenceClassification import \
     BertForSequenceClassification as BertForSequenceClassificationTest
 from BERT_explainability.modules.BERT.BERT_cls_lrp import \
     BertForSequenceClassification as BertForClsOrigLrp
+from BERT_rationale_benchmark.models.pipeline.faithfulness import AOPCScorer
 
 from transformers import BertForSequenceClassification
 
@@ -137,6 +139,25 @@ def scores_per_word_from_scores_per_token(input, tokenizer, input_ids, scores_pe
 
     return torch.tensor(score_per_word)
 
+def word_ids_from_tokens(input, tokenizer, input_ids):
+    """The index in input of the word of every wordpiece, aligned on characters as in scores_per_word_from_scores_per_token.
+
+    Special and unknown wordpieces, which that alignment skips, belong to no word (-1).
+    """
+    words = tokenizer.convert_ids_to_tokens(input_ids)
+    words = [word.replace('##', '') for word in words]
+    word_ends = np.cumsum([len(inp) for inp in input])
+    word_ids = []
+    start_idx = 0
+    for word in words:
+        if word in ['[CLS]', '[SEP]', '[UNK]', '[PAD]']:
+            word_ids.append(-1)
+            continue
+        word_ids.append(int(np.searchsorted(word_ends, start_idx, side='right')))
+        start_idx += len(word)
+    return torch.tensor(word_ids, dtype=torch.long)
+
+
 def get_input_words(input, tokenizer, input_ids):
     words = tokenizer.convert_ids_to_tokens(input_ids)
     words = [word.replace('##', '') for word in words]
@@ -201,6 +222,7 @@ def initialize_models(params: dict, batch_first: bool, use_half_precision=False)
 
 
 BATCH_FIRST = True
+AOPC_THRESHOLDS = [0.01, 0.05, 0.1, 0.2, 0.5]
 
 
 def extract_docid_from_dataset_element(element):
@@ -449,9 +471,10 @@ def main():
 
         os.makedirs(os.path.join(args.output_dir, method_folder[method]), exist_ok=True)
 
-        result_files = []
-        for i in range(5,85,5):
-            result_files.append(open(os.path.join(args.output_dir, '{0}/identifier_results_{1}.json').format(method_folder[method], i), 'w'))
+        rationale_writer = HardRationaleWriter(
+            os.path.join(args.output_dir, '{0}/identifier_results.tsv').format(method_folder[method]),
+            thresholds=range(5, 85, 5))
+        aopc_docids, aopc_input_ids, aopc_word_ids, aopc_scores, aopc_fractions = [], [], [], [], []
 
         j = 0
         for batch_start in range(0, len(test), test_batch_size):
@@ -563,27 +586,30 @@ def main():
                 cam = scores_per_word_from_scores_per_token(inp, tokenizer,input_ids[0], cam)
                 j = j + 1
                 doc_name = extract_docid_from_dataset_element(s)
-                hard_rationales = []
-                for res, i in enumerate(range(5, 85, 5)):
-                    print("calculating top ", i)
-                    _, indices = cam.topk(k=i)
-                    for index in indices.tolist():
-                        hard_rationales.append({
-                            "start_token": index,
-                            "end_token": index+1
-                        })
-                    result_dict = {
-                        "annotation_id": doc_name,
-                        "rationales": [{
-                            "docid": doc_name,
-                            "hard_rationale_predictions": hard_rationales
-                        }],
-                    }
-                    result_files[res].write(json.dumps(result_dict) + "\n")
-
-        for i in range(len(result_files)):
-            result_files[i].close()
-
+                rationale_writer.write(doc_name, cam)
+                aopc_docids.append(doc_name)
+                aopc_input_ids.append(input_ids[0])
+                # the rationales are ranked and counted in words, as the human rationale fractions are
+                aopc_word_ids.append(word_ids_from_tokens(inp, tokenizer, input_ids[0]))
+                aopc_scores.append(cam)
+                aopc_fractions.append(sum(ev.end_token - ev.start_token for ev in s.all_evidences()) / len(inp))
+
+        rationale_writer.close()
+
+        if len(aopc_docids) > 0:
+            logging.info(f'Computing AOPC scores for {len(aopc_docids)} documents')
+            class_names = [k for k, v in sorted(evidence_classes.items(), key=lambda kv: kv[1])]
+            aopc_scorer = AOPCScorer(evidence_classifier, class_names,
+                                     special_token_ids=[tokenizer.cls_token_id, tokenizer.sep_token_id,
+                                                        tokenizer.pad_token_id],
+                                     pad_token_id=tokenizer.pad_token_id,
+                                     batch_size=model_params['evidence_classifier']['batch_size'])
+            aopc_results = aopc_scorer.score(aopc_input_ids, aopc_scores, AOPC_THRESHOLDS, aopc_fractions,
+                                             word_ids=aopc_word_ids)
+            for doc_name, instance in zip(aopc_docids, aopc_results):
+                instance['annotation_id'] = doc_name
+                instance['rationales'] = [{'docid': doc_name}]
+            write_jsonl(aopc_results, os.path.join(args.output_dir, '{0}/aopc_results.jsonl').format(method_folder[method]))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,123 @@
+from typing import Dict, List, Optional, Sequence
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pad_sequence
+
+
+class AOPCScorer:
+    """Computes comprehensiveness and sufficiency classification scores in process.
+
+    For every document and every AOPC threshold t, the int(t * n) highest scoring of the n words
+    of the document form the rationale, and all the wordpieces of those words are removed or kept
+    together. Without a wordpiece to word mapping every non special wordpiece counts as a word.
+    The comprehensiveness input drops the rationale from the document, the sufficiency input keeps
+    only the rationale (plus special tokens).
+    All variants of all documents are sorted by length and classified in padded batches, and
+    the class distributions are returned in the results jsonl structure read by metrics.py
+    (classification, classification_scores and thresholded_scores).
+
+    The classifier is called under torch.no_grad as classifier(input_ids=..., attention_mask=...)[0],
+    so it should be a plain classifier such as transformers' BertForSequenceClassification rather
+    than one of the LRP models, which register gradient hooks in their forward.
+    """
+
+    def __init__(self,
+                 classifier: nn.Module,
+                 class_names: Sequence[str],
+                 special_token_ids: Sequence[int],
+                 pad_token_id: int,
+                 batch_size: int = 32):
+        self.classifier = classifier
+        self.class_names = list(class_names)
+        self.special_token_ids = torch.tensor(sorted(special_token_ids), dtype=torch.long)
+        self.pad_token_id = pad_token_id
+        self.batch_size = batch_size
+
+    def _rationale_masks(self,
+                         input_ids: torch.Tensor,
+                         scores: torch.Tensor,
+                         fractions: Sequence[float],
+                         word_ids: Optional[torch.Tensor] = None):
+        """Returns the special token mask and a (len(fractions), length) mask of rationale tokens"""
+        special = (input_ids.unsqueeze(-1) == self.special_token_ids).any(dim=-1)
+        if word_ids is None:
+            word_ids = torch.arange(len(input_ids))
+        word_ids = word_ids.masked_fill(special, -1)
+        words = word_ids[word_ids >= 0].unique()
+        ranks = torch.full((len(scores) + 1,), len(words), dtype=torch.long)
+        ranks[words[scores[words].float().argsort(descending=True)]] = torch.arange(len(words))
+        # special tokens (word -1) take the last rank, which no threshold reaches
+        token_ranks = ranks[word_ids]
+        ks = torch.tensor([int(f * len(words)) for f in fractions], dtype=torch.long)
+        return special, token_ranks.unsqueeze(0) < ks.unsqueeze(1)
+
+    def _classify(self, sequences: List[torch.Tensor]) -> torch.Tensor:
+        device = next(self.classifier.parameters()).device
+        lengths = torch.tensor([len(s) for s in sequences])
+        probs = torch.empty(len(sequences), len(self.class_names))
+        # sorting by length keeps the padding of every batch small
+        order = lengths.argsort(descending=True)
+        with torch.no_grad():
+            for batch_start in range(0, len(sequences), self.batch_size):
+                batch = order[batch_start:batch_start + self.batch_size]
+                input_ids = pad_sequence([sequences[i] for i in batch.tolist()], batch_first=True,
+                                         padding_value=self.pad_token_id).to(device)
+                attention_mask = (torch.arange(input_ids.shape[1]).unsqueeze(0) < lengths[batch].unsqueeze(1)).long()
+                logits = self.classifier(input_ids=input_ids, attention_mask=attention_mask.to(device))[0]
+                probs[batch] = torch.softmax(logits.float(), dim=-1).cpu()
+        return probs
+
+    def _as_dict(self, probs: torch.Tensor) -> Dict[str, float]:
+        return {k: v for k, v in zip(self.class_names, probs.tolist())}
+
+    def score(self,
+              input_ids: Sequence[torch.Tensor],
+              token_scores: Sequence[torch.Tensor],
+              thresholds: Sequence[float],
+              rationale_fractions: Optional[Sequence[float]] = None,
+              word_ids: Optional[Sequence[torch.Tensor]] = None) -> List[dict]:
+        """Scores every document at every threshold.
+
+        Args:
+            input_ids: per document wordpiece ids, including the special tokens
+            token_scores: per document relevance of every word, or of every wordpiece without word_ids
+            thresholds: AOPC thresholds, as fractions of the words of the document
+            rationale_fractions: optional per document fraction used for the top level
+                comprehensiveness_classification_scores and sufficiency_classification_scores,
+                e.g. the share of the document covered by the human rationale
+            word_ids: optional per document index into token_scores of the word of every wordpiece, -1 for
+                wordpieces that belong to no word. Without it the rationales are counted in wordpieces.
+        """
+        sequences = []
+        for i, (ids, scores) in enumerate(zip(input_ids, token_scores)):
+            ids = ids.cpu()
+            fractions = list(thresholds)
+            if rationale_fractions is not None:
+                fractions.append(rationale_fractions[i])
+            special, rationales = self._rationale_masks(ids, scores.detach().cpu(), fractions,
+                                                        None if word_ids is None else word_ids[i].cpu())
+            sequences.append(ids)
+            for rationale in rationales:
+                sequences.append(ids[~rationale])
+                sequences.append(ids[special | rationale])
+        probs = self._classify(sequences)
+
+        ret = []
+        variants_per_doc = 1 + 2 * (len(thresholds) + int(rationale_fractions is not None))
+        for doc_probs in probs.split(variants_per_doc):
+            comprehensiveness, sufficiency = doc_probs[1::2], doc_probs[2::2]
+            instance = {
+                'classification': self.class_names[int(doc_probs[0].argmax())],
+                'classification_scores': self._as_dict(doc_probs[0]),
+                'thresholded_scores': [{
+                    'threshold': threshold,
+                    'comprehensiveness_classification_scores': self._as_dict(comprehensiveness[t]),
+                    'sufficiency_classification_scores': self._as_dict(sufficiency[t]),
+                } for t, threshold in enumerate(thresholds)],
+            }
+            if rationale_fractions is not None:
+                instance['comprehensiveness_classification_scores'] = self._as_dict(comprehensiveness[-1])
+                instance['sufficiency_classification_scores'] = self._as_dict(sufficiency[-1])
+            ret.append(instance)
+        return ret
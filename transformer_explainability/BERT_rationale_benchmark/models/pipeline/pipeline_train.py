@@ -4,7 +4,6 @@ import logging
 import random
 import os
 
-from itertools import chain
 from typing import Set
 
 import numpy as np
@@ -12,10 +11,10 @@ import torch
 
 from rationale_benchmark.utils import (
     write_jsonl,
-    load_datasets,
-    load_documents,
-    intern_documents,
-    intern_annotations
+    iter_documents,
+    scan_annotations,
+    AnnotationTable,
+    InternedDocuments
 )
 from rationale_benchmark.models.mlp import (
     AttentiveClassifier,
@@ -106,22 +105,27 @@ def main():
     with open(args.model_params, 'r') as fp:
         logging.debug(f'Loading model parameters from {args.model_params}')
         model_params = json.load(fp)
-    train, val, test = load_datasets(args.data_dir)
-    docids = set(e.docid for e in chain.from_iterable(chain.from_iterable(map(lambda ann: ann.evidences, chain(train, val, test)))))
-    documents = load_documents(args.data_dir, docids)
-    document_vocab = set(chain.from_iterable(chain.from_iterable(documents.values())))
-    annotation_vocab = set(chain.from_iterable(e.query.split() for e in chain(train, val, test)))
-    logging.debug(f'Loaded {len(documents)} documents with {len(document_vocab)} unique words')
+    # the splits and documents are read as they are interned, into columnar tables
+    splits = [os.path.join(args.data_dir, split + '.jsonl') for split in ('train', 'val', 'test')]
+    docids = set()
+    annotation_vocab = set()
+    for split in splits:
+        split_docids, split_vocab = scan_annotations(split)
+        docids |= split_docids
+        annotation_vocab |= split_vocab
+    document_vocab = set()
+    for _, document in iter_documents(args.data_dir, docids):
+        document_vocab.update(document.split())
+    logging.debug(f'Loaded {len(docids)} documents with {len(document_vocab)} unique words')
     # this ignores the case where annotations don't align perfectly with token boundaries, but this isn't that important
     vocab = document_vocab | annotation_vocab
     unk_token = 'UNK'
     evidence_identifier, evidence_classifier, word_interner, de_interner, evidence_classes = \
         initialize_models(model_params, vocab, batch_first=BATCH_FIRST, unk_token=unk_token)
     logging.debug(f'Including annotations, we have {len(vocab)} total words in the data, with embeddings for {len(word_interner)}')
-    interned_documents = intern_documents(documents, word_interner, unk_token)
-    interned_train = intern_annotations(train, word_interner, unk_token)
-    interned_val = intern_annotations(val, word_interner, unk_token)
-    interned_test = intern_annotations(test, word_interner, unk_token)
+    interned_documents = InternedDocuments.from_data_dir(args.data_dir, word_interner, unk_token, docids)
+    interned_train, interned_val, interned_test = [AnnotationTable.from_jsonl(split, word_interner, unk_token)
+                                                   for split in splits]
     assert BATCH_FIRST # for correctness of the split  dimension for DataParallel
     evidence_identifier, evidence_ident_results = train_evidence_identifier(evidence_identifier.cuda(),
                                                                             args.output_dir, interned_train,
@@ -189,6 +189,40 @@ def annotations_to_evidence_token_identification(annotations: List[Annotation],
     return ret
 
 
+class PackedSentenceEvidence:
+    """The queries, sentences and targets of a list of SentenceEvidence, tensorized once.
+
+    Each field lives in one flat LongTensor; per element tensors are views into it, so batching
+    does not construct tensors element by element. The classifier still receives lists of these
+    views and pads them itself. batches() yields index lists of at most batch_size elements,
+    longest first, so that batches are padded to similar lengths.
+    """
+
+    def __init__(self, data: List[SentenceEvidence], token_targets: bool = False):
+        self.ids = [(s.ann_id, s.docid, s.index) for s in data]
+        self.queries = self._pack([s.query for s in data])
+        self.sentences = self._pack([s.sentence for s in data])
+        if token_targets:
+            self.targets = self._pack([s.kls for s in data])
+        else:
+            self.targets = torch.tensor([s.kls for s in data], dtype=torch.long)
+        self.lengths = torch.tensor([len(q) + len(s) for q, s in zip(self.queries, self.sentences)], dtype=torch.long)
+
+    @staticmethod
+    def _pack(sequences: List[Any]) -> Tuple[torch.Tensor, ...]:
+        lengths = [len(x) for x in sequences]
+        flat = torch.tensor(list(chain.from_iterable(sequences)), dtype=torch.long)
+        return torch.split(flat, lengths)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def batches(self, batch_size: int):
+        order = torch.argsort(self.lengths, descending=True).tolist()
+        for batch_start in range(0, len(order), batch_size):
+            yield order[batch_start:batch_start + batch_size]
+
+
 def make_preds_batch(classifier: nn.Module,
                      batch_elements: List[SentenceEvidence],
                      device=None,
@@ -227,7 +261,8 @@ def make_preds_epoch(classifier: nn.Module,
                      batch_size: int,
                      device=None,
                      criterion: nn.Module = None,
-                     tensorize_model_inputs: bool = True):
+                     tensorize_model_inputs: bool = True,
+                     packed: bool = False):
     """Predictions for more than one batch.
 
     Args:
@@ -237,7 +272,11 @@ def make_preds_epoch(classifier: nn.Module,
         device: Optional; what compute device this should run on
         criterion: Optional; a loss function
         tensorize_model_inputs: should we convert our data to tensors before passing it to the model? Useful if we have a model that performs its own tokenization
+        packed: Optional; tensorize the data once up front (see PackedSentenceEvidence) and predict over length sorted
+                batches. Outputs are returned in input order and match the default path.
     """
+    if packed and tensorize_model_inputs:
+        return _make_packed_preds_epoch(classifier, PackedSentenceEvidence(data), batch_size, device, criterion)
     epoch_loss = 0
     epoch_soft_pred = []
     epoch_hard_pred = []
@@ -258,6 +297,30 @@ def make_preds_epoch(classifier: nn.Module,
     return epoch_loss, epoch_soft_pred, epoch_hard_pred, epoch_truth
 
 
+def _make_packed_preds_epoch(classifier: nn.Module,
+                             packed: PackedSentenceEvidence,
+                             batch_size: int,
+                             device=None,
+                             criterion: nn.Module = None):
+    """make_preds_epoch over length sorted batches of pre-tensorized inputs, with outputs in input order"""
+    epoch_loss = 0
+    epoch_soft_pred = [None] * len(packed)
+    epoch_hard_pred = torch.empty(len(packed), dtype=torch.long)
+    classifier.eval()
+    for batch in packed.batches(batch_size):
+        preds = classifier([packed.queries[i] for i in batch],
+                           [packed.ids[i] for i in batch],
+                           [packed.sentences[i] for i in batch])
+        if criterion:
+            epoch_loss += criterion(preds, packed.targets[batch].to(device=preds.device)).sum().item()
+        # .float() because pytorch 1.3 introduces a bug where argmax is unsupported for float16
+        epoch_hard_pred[batch] = torch.argmax(preds.float(), dim=-1).cpu()
+        for i, soft_pred in zip(batch, preds.cpu()):
+            epoch_soft_pred[i] = soft_pred
+    epoch_loss /= len(packed)
+    return epoch_loss, epoch_soft_pred, epoch_hard_pred.tolist(), packed.targets.tolist()
+
+
 def make_token_preds_batch(classifier: nn.Module,
                            batch_elements: List[SentenceEvidence],
                            token_mapping: Dict[str, List[List[Tuple[int, int]]]],
@@ -301,7 +364,8 @@ def make_token_preds_epoch(classifier: nn.Module,
                            batch_size: int,
                            device=None,
                            criterion: nn.Module = None,
-                           tensorize_model_inputs: bool = True):
+                           tensorize_model_inputs: bool = True,
+                           packed: bool = False):
     """Predictions for more than one batch.
 
     Args:
@@ -311,7 +375,13 @@ def make_token_preds_epoch(classifier: nn.Module,
         device: Optional; what compute device this should run on
         criterion: Optional; a loss function
         tensorize_model_inputs: should we convert our data to tensors before passing it to the model? Useful if we have a model that performs its own tokenization
+        packed: Optional; tensorize the data once up front (see PackedSentenceEvidence) and predict over length sorted
+                batches. Outputs are returned in input order; they match the default path, except that each
+                soft prediction is padded to the longest sentence of its own (different) batch.
     """
+    if packed and tensorize_model_inputs:
+        return _make_packed_token_preds_epoch(classifier, PackedSentenceEvidence(data, token_targets=True),
+                                              token_mapping, batch_size, device, criterion)
     epoch_loss = 0
     epoch_soft_pred = []
     epoch_hard_pred = []
@@ -334,6 +404,35 @@ def make_token_preds_epoch(classifier: nn.Module,
     return epoch_loss, epoch_soft_pred, epoch_hard_pred, epoch_truth
 
 
+def _make_packed_token_preds_epoch(classifier: nn.Module,
+                                   packed: PackedSentenceEvidence,
+                                   token_mapping: Dict[str, List[List[Tuple[int, int]]]],
+                                   batch_size: int,
+                                   device=None,
+                                   criterion: nn.Module = None):
+    """make_token_preds_epoch over length sorted batches of pre-tensorized inputs, with outputs in input order"""
+    epoch_loss = 0
+    epoch_soft_pred = [None] * len(packed)
+    epoch_hard_pred = [None] * len(packed)
+    classifier.eval()
+    for batch in packed.batches(batch_size):
+        targets = PaddedSequence.autopad([packed.targets[i] for i in batch], batch_first=True, device=device)
+        aggregate_spans = [token_mapping[packed.ids[i][1]][packed.ids[i][2]] for i in batch]
+        preds = classifier([packed.queries[i] for i in batch],
+                           [packed.ids[i] for i in batch],
+                           [packed.sentences[i] for i in batch],
+                           aggregate_spans)
+        targets = targets.to(device=preds.device)
+        if criterion:
+            mask = targets.mask(on=1, off=0, device=preds.device, dtype=torch.float)
+            epoch_loss += criterion(preds, (targets.data * mask).squeeze()).sum().item()
+        for i, soft_pred, hard_pred in zip(batch, preds.cpu().tolist(), targets.unpad(torch.round(preds).to(dtype=torch.int).cpu())):
+            epoch_soft_pred[i] = soft_pred
+            epoch_hard_pred[i] = hard_pred
+    epoch_loss /= len(packed)
+    return epoch_loss, epoch_soft_pred, epoch_hard_pred, [t.tolist() for t in packed.targets]
+
+
 # copied from https://docs.python.org/3/library/itertools.html#itertools-recipes
 def _grouper(iterable, n, fillvalue=None):
     "Collect data into fixed-length chunks or blocks"
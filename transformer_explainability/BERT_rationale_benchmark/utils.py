@@ -1,9 +1,15 @@
 import json
+import mmap
 import os
 
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping, Sequence as SequenceABC
 from dataclasses import dataclass, asdict, is_dataclass
 from itertools import chain
-from typing import Dict, List, Set, Tuple, Union, FrozenSet
+from typing import Dict, List, Sequence, Set, Tuple, Union, FrozenSet
+
+import numpy as np
 
 
 @dataclass(eq=True, frozen=True)
@@ -106,6 +112,58 @@ def write_jsonl(jsonl, output_file):
             of.write('\n')
 
 
+class HardRationaleWriter:
+    """Writes top-k hard rationales for several thresholds to a single tab separated file.
+
+    Every row is (docid, threshold, space separated token indices). The scores of a document
+    are sorted once and the rationale for each threshold is a prefix of that ranking.
+    Use load_hard_rationales to read a threshold back as metrics.py style instances.
+    """
+
+    def __init__(self, output_file: str, thresholds: Sequence[int], buffer_size: int = 1 << 20):
+        self.thresholds = sorted(thresholds)
+        self._file = open(output_file, 'w', buffering=buffer_size)
+        self._file.write('docid\tthreshold\ttoken_indices\n')
+
+    def write(self, docid: str, scores: Sequence[float]):
+        ranking = np.argsort(-np.asarray(scores), kind='stable')[:self.thresholds[-1]]
+        ranking = [str(i) for i in ranking.tolist()]
+        self._file.writelines(f'{docid}\t{k}\t{" ".join(ranking[:k])}\n' for k in self.thresholds)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_hard_rationales(fp: str, threshold: int) -> List[dict]:
+    """Loads the rationales of a single threshold from a HardRationaleWriter file.
+
+    Each document becomes an instance in the results jsonl format expected by metrics.py,
+    with one single token hard rationale prediction per selected index.
+    """
+    ret = []
+    with open(fp, 'r') as inf:
+        next(inf)
+        for line in inf:
+            docid, k, indices = line.rstrip('\n').split('\t')
+            if int(k) != threshold:
+                continue
+            ret.append({
+                'annotation_id': docid,
+                'rationales': [{
+                    'docid': docid,
+                    'hard_rationale_predictions': [{'start_token': i, 'end_token': i + 1}
+                                                   for i in map(int, indices.split())],
+                }],
+            })
+    return ret
+
+
 def annotations_from_jsonl(fp: str) -> List[Annotation]:
     ret = []
     with open(fp, 'r') as inf:
@@ -132,12 +190,99 @@ def load_datasets(data_dir: str) -> Tuple[List[Annotation], List[Annotation], Li
     return train_data, val_data, test_data
 
 
+PACKED_DOCUMENTS = 'docs.packed'
+
+
+class PackedDocuments(Mapping):
+    """Read-only, lazily decoded view of a packed document store.
+
+    The store is a single utf-8 blob holding every document back to back, plus a '.idx' file
+    of docid, byte offset and byte length rows sorted by docid. The blob is memory mapped, so
+    opening the store reads only the index and each lookup decodes a single document.
+    Stores are written by build_packed_documents.
+    """
+
+    def __init__(self, path: str):
+        self.docids = []
+        self._offsets = []
+        self._lengths = []
+        with open(path + '.idx', 'r') as inf:
+            for line in inf:
+                docid, offset, length = line.rstrip('\n').split('\t')
+                self.docids.append(docid)
+                self._offsets.append(int(offset))
+                self._lengths.append(int(length))
+        self._file = open(path, 'rb')
+        # mmap refuses empty files
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mmap = b''
+
+    def __getitem__(self, docid: str) -> str:
+        i = bisect_left(self.docids, docid)
+        if i == len(self.docids) or self.docids[i] != docid:
+            raise KeyError(docid)
+        return self._mmap[self._offsets[i]:self._offsets[i] + self._lengths[i]].decode('utf-8')
+
+    def __iter__(self):
+        return iter(self.docids)
+
+    def __len__(self) -> int:
+        return len(self.docids)
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def build_packed_documents(data_dir: str, output_file: str = None) -> str:
+    """Packs every document under data_dir ('docs/' or 'docs.jsonl') into a PackedDocuments store.
+
+    This is a one-time conversion; afterwards load_documents reads from the store.
+    Returns the path of the store.
+    """
+    if output_file is None:
+        output_file = os.path.join(data_dir, PACKED_DOCUMENTS)
+    if os.path.exists(os.path.join(data_dir, 'docs.jsonl')):
+        documents = load_documents_from_file(data_dir)
+    else:
+        docs_dir = os.path.join(data_dir, 'docs')
+        documents = dict()
+        for d in os.listdir(docs_dir):
+            with open(os.path.join(docs_dir, d), 'r') as inf:
+                documents[d] = inf.read()
+    offset = 0
+    with open(output_file, 'wb') as blob, open(output_file + '.idx', 'w') as index:
+        for docid in sorted(documents.keys()):
+            encoded = documents[docid].encode('utf-8')
+            blob.write(encoded)
+            index.write(f'{docid}\t{offset}\t{len(encoded)}\n')
+            offset += len(encoded)
+    return output_file
+
+
 def load_documents(data_dir: str, docids: Set[str] = None) -> Dict[str, List[List[str]]]:
     """Loads a subset of available documents from disk.
 
     Each document is assumed to be serialized as newline ('\n') separated sentences.
     Each sentence is assumed to be space (' ') joined tokens.
+    Documents are read from a packed store (see build_packed_documents) when one exists.
     """
+    packed = os.path.join(data_dir, PACKED_DOCUMENTS)
+    if os.path.exists(packed):
+        with PackedDocuments(packed) as store:
+            if docids is None:
+                docids = store.keys()
+            return {d: store[d] for d in sorted(set(str(d) for d in docids))}
+
     if os.path.exists(os.path.join(data_dir, 'docs.jsonl')):
         assert not os.path.exists(os.path.join(data_dir, 'docs'))
         return load_documents_from_file(data_dir, docids)
@@ -154,6 +299,40 @@ def load_documents(data_dir: str, docids: Set[str] = None) -> Dict[str, List[Lis
     return res
 
 
+def iter_documents(data_dir: str, docids: Set[str] = None):
+    """Yields the (docid, text) pairs load_documents would return, one document at a time."""
+    wanted = None if docids is None else set(str(d) for d in docids)
+    packed = os.path.join(data_dir, PACKED_DOCUMENTS)
+    if os.path.exists(packed):
+        with PackedDocuments(packed) as store:
+            for d in (store.docids if wanted is None else sorted(wanted)):
+                yield d, store[d]
+    elif os.path.exists(os.path.join(data_dir, 'docs.jsonl')):
+        with open(os.path.join(data_dir, 'docs.jsonl'), 'r') as inf:
+            for line in inf:
+                doc = json.loads(line)
+                if wanted is None or doc['docid'] in wanted:
+                    yield doc['docid'], doc['document']
+    else:
+        docs_dir = os.path.join(data_dir, 'docs')
+        for d in (sorted(os.listdir(docs_dir)) if wanted is None else sorted(wanted)):
+            with open(os.path.join(docs_dir, d), 'r') as inf:
+                yield d, inf.read()
+
+
+def scan_annotations(fp: str) -> Tuple[Set[str], Set[str]]:
+    """The docids of the evidences and the query words of an annotations jsonl file, read line by line
+    without building the Annotation objects of annotations_from_jsonl"""
+    docids = set()
+    query_vocab = set()
+    with open(fp, 'r') as inf:
+        for line in inf:
+            content = json.loads(line)
+            docids.update(ev['docid'] for ev in chain.from_iterable(content['evidences']))
+            query_vocab.update(content['query'].split())
+    return docids, query_vocab
+
+
 def load_flattened_documents(data_dir: str, docids: Set[str]) -> Dict[str, List[str]]:
     """Loads a subset of available documents from disk.
 
@@ -202,6 +381,226 @@ def intern_annotations(annotations: List[Annotation], word_interner: Dict[str, i
     return ret
 
 
+def _save_columns(directory: str, columns: Dict[str, np.ndarray], strings: Dict[str, list]):
+    os.makedirs(directory, exist_ok=True)
+    for name, column in columns.items():
+        np.save(os.path.join(directory, name + '.npy'), column)
+    with open(os.path.join(directory, 'strings.json'), 'w') as of:
+        json.dump(strings, of)
+
+
+def _load_columns(directory: str, names: List[str], mmap_mode: str) -> Tuple[Dict[str, np.ndarray], Dict[str, list]]:
+    columns = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in names}
+    with open(os.path.join(directory, 'strings.json'), 'r') as inf:
+        strings = json.load(inf)
+    return columns, strings
+
+
+def _offsets(lengths: array) -> np.ndarray:
+    ret = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(np.frombuffer(lengths, dtype=np.int32), out=ret[1:])
+    return ret
+
+
+class InternedDocuments(Mapping):
+    """Columnar counterpart of intern_documents.
+
+    Every word id of every document is stored back to back in one int32 array. Sentence i spans
+    tokens[sentence_offsets[i]:sentence_offsets[i + 1]] and the sentences of the d-th document are
+    document_offsets[d]:document_offsets[d + 1]. Looking up a docid returns its sentences as
+    int32 array views, so the arrays can be memory mapped from disk (see save and load).
+    """
+
+    _columns = ['tokens', 'sentence_offsets', 'document_offsets']
+
+    def __init__(self, docids: List[str], tokens: np.ndarray, sentence_offsets: np.ndarray, document_offsets: np.ndarray):
+        self.docids = list(docids)
+        self.tokens = tokens
+        self.sentence_offsets = sentence_offsets
+        self.document_offsets = document_offsets
+        self._index = {d: i for i, d in enumerate(self.docids)}
+
+    @classmethod
+    def from_documents(cls, documents: Dict[str, Union[str, List[List[str]]]], word_interner: Dict[str, int], unk_token: str) -> 'InternedDocuments':
+        """Interns documents given either as sentences of words or as raw newline/space separated text"""
+        return cls._from_items(documents.items(), word_interner, unk_token)
+
+    @classmethod
+    def from_data_dir(cls, data_dir: str, word_interner: Dict[str, int], unk_token: str,
+                      docids: Set[str] = None) -> 'InternedDocuments':
+        """Interns the documents of data_dir as they are read, holding one document's text at a time"""
+        return cls._from_items(iter_documents(data_dir, docids), word_interner, unk_token)
+
+    @classmethod
+    def _from_items(cls, items, word_interner: Dict[str, int], unk_token: str) -> 'InternedDocuments':
+        unk = word_interner[unk_token]
+        docids = []
+        tokens = array('i')
+        sentence_lengths = array('i')
+        document_lengths = array('i')
+        for docid, sentences in items:
+            if isinstance(sentences, str):
+                sentences = [line.split() for line in sentences.split('\n')]
+            for s in sentences:
+                tokens.extend(word_interner.get(w, unk) for w in s)
+                sentence_lengths.append(len(s))
+            docids.append(docid)
+            document_lengths.append(len(sentences))
+        return cls(docids, np.frombuffer(tokens, dtype=np.int32), _offsets(sentence_lengths),
+                   _offsets(document_lengths))
+
+    def __getitem__(self, docid: str) -> List[np.ndarray]:
+        i = self._index[docid]
+        offsets = self.sentence_offsets[self.document_offsets[i]:self.document_offsets[i + 1] + 1]
+        return [self.tokens[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def flattened(self, docid: str) -> np.ndarray:
+        i = self._index[docid]
+        start = self.sentence_offsets[self.document_offsets[i]]
+        end = self.sentence_offsets[self.document_offsets[i + 1]]
+        return self.tokens[start:end]
+
+    def __iter__(self):
+        return iter(self.docids)
+
+    def __len__(self) -> int:
+        return len(self.docids)
+
+    def save(self, directory: str):
+        _save_columns(directory, {name: getattr(self, name) for name in self._columns}, {'docids': self.docids})
+
+    @classmethod
+    def load(cls, directory: str, mmap_mode: str = 'r') -> 'InternedDocuments':
+        columns, strings = _load_columns(directory, cls._columns, mmap_mode)
+        return cls(strings['docids'], **columns)
+
+
+class AnnotationTable(SequenceABC):
+    """Columnar counterpart of intern_annotations.
+
+    Queries and evidence texts are interned into flat int32 token arrays with offsets, and the
+    evidences are kept as a struct of int32 arrays (annotation, evidence group, docid index and
+    token/sentence spans), with the evidences of annotation i in rows
+    evidence_offsets[i]:evidence_offsets[i + 1] and its evidence groups numbered from 0 to
+    group_counts[i], empty groups included. Indexing the table builds the interned Annotation
+    (with Evidence objects) for that row only, so code written against List[Annotation] can
+    iterate it directly. from_jsonl builds the table without the Annotation objects.
+    """
+
+    _columns = ['query_tokens', 'query_offsets', 'evidence_offsets', 'group_counts', 'evidence_group',
+                'evidence_docid', 'start_token', 'end_token', 'start_sentence', 'end_sentence', 'text_tokens',
+                'text_offsets']
+    _fields = ['start_token', 'end_token', 'start_sentence', 'end_sentence']
+    _strings = ['annotation_ids', 'classifications', 'query_types', 'docids']
+
+    def __init__(self, annotation_ids: List[str], classifications: List[str], query_types: List[str], docids: List[str],
+                 **columns: np.ndarray):
+        self.annotation_ids = annotation_ids
+        self.classifications = classifications
+        self.query_types = query_types
+        self.docids = docids
+        for name in self._columns:
+            setattr(self, name, columns[name])
+
+    @classmethod
+    def from_annotations(cls, annotations: List[Annotation], word_interner: Dict[str, int], unk_token: str) -> 'AnnotationTable':
+        records = ((ann.annotation_id, ann.query, ann.classification, ann.query_type,
+                    [[(ev.text, ev.docid) + tuple(getattr(ev, field) for field in cls._fields) for ev in ev_group]
+                     for ev_group in ann.evidences])
+                   for ann in annotations)
+        return cls._from_records(records, word_interner, unk_token)
+
+    @classmethod
+    def from_jsonl(cls, fp: str, word_interner: Dict[str, int], unk_token: str) -> 'AnnotationTable':
+        """The table of the annotations of a jsonl file, as from_annotations(annotations_from_jsonl(fp), ...)
+        but read line by line into the columns"""
+        def records():
+            with open(fp, 'r') as inf:
+                for line in inf:
+                    content = json.loads(line)
+                    ev_groups = [[(ev['text'], ev['docid']) + tuple(ev.get(field, -1) for field in cls._fields)
+                                  for ev in ev_group]
+                                 for ev_group in content['evidences']]
+                    yield (content['annotation_id'], content['query'], content['classification'],
+                           content.get('query_type'), ev_groups)
+        return cls._from_records(records(), word_interner, unk_token)
+
+    @classmethod
+    def _from_records(cls, records, word_interner: Dict[str, int], unk_token: str) -> 'AnnotationTable':
+        # records of (annotation_id, query, classification, query_type, evidence groups), with each evidence
+        # a tuple of its text, docid and _fields
+        unk = word_interner[unk_token]
+        docid_index = dict()
+        strings = {name: [] for name in cls._strings}
+        arrays = {name: array('i') for name in ['query_lengths', 'evidence_counts', 'group_counts', 'evidence_group',
+                                                'evidence_docid', 'text_lengths', 'query_tokens', 'text_tokens']
+                  + cls._fields}
+        for annotation_id, query, classification, query_type, ev_groups in records:
+            strings['annotation_ids'].append(annotation_id)
+            strings['classifications'].append(classification)
+            strings['query_types'].append(query_type)
+            query = [word_interner.get(t, unk) for t in query.split()]
+            arrays['query_tokens'].extend(query)
+            arrays['query_lengths'].append(len(query))
+            # evidences is a set of groups, so equal groups count once, as in annotations_from_jsonl
+            ev_groups = list(dict.fromkeys(tuple(tuple(ev) for ev in ev_group) for ev_group in ev_groups))
+            count = 0
+            for group, ev_group in enumerate(ev_groups):
+                for text, docid, *spans in ev_group:
+                    text = [word_interner.get(t, unk) for t in text.split()]
+                    arrays['text_tokens'].extend(text)
+                    arrays['text_lengths'].append(len(text))
+                    arrays['evidence_group'].append(group)
+                    arrays['evidence_docid'].append(docid_index.setdefault(docid, len(docid_index)))
+                    for field, value in zip(cls._fields, spans):
+                        arrays[field].append(value)
+                    count += 1
+            arrays['evidence_counts'].append(count)
+            arrays['group_counts'].append(len(ev_groups))
+        strings['docids'] = list(docid_index.keys())
+        columns = {name: np.frombuffer(arrays[name], dtype=np.int32)
+                   for name in ['group_counts', 'evidence_group', 'evidence_docid', 'query_tokens', 'text_tokens']
+                   + cls._fields}
+        columns['query_offsets'] = _offsets(arrays['query_lengths'])
+        columns['evidence_offsets'] = _offsets(arrays['evidence_counts'])
+        columns['text_offsets'] = _offsets(arrays['text_lengths'])
+        return cls(**strings, **columns)
+
+    def __len__(self) -> int:
+        return len(self.annotation_ids)
+
+    def __getitem__(self, i: int) -> Annotation:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        ev_groups = [[] for _ in range(self.group_counts[i])]
+        for row in range(self.evidence_offsets[i], self.evidence_offsets[i + 1]):
+            text = self.text_tokens[self.text_offsets[row]:self.text_offsets[row + 1]]
+            ev_groups[int(self.evidence_group[row])].append(Evidence(
+                text=tuple(text.tolist()),
+                docid=self.docids[self.evidence_docid[row]],
+                start_token=int(self.start_token[row]),
+                end_token=int(self.end_token[row]),
+                start_sentence=int(self.start_sentence[row]),
+                end_sentence=int(self.end_sentence[row])))
+        query = self.query_tokens[self.query_offsets[i]:self.query_offsets[i + 1]]
+        return Annotation(annotation_id=self.annotation_ids[i],
+                          query=tuple(query.tolist()),
+                          evidences=frozenset(tuple(evs) for evs in ev_groups),
+                          classification=self.classifications[i],
+                          query_type=self.query_types[i])
+
+    def save(self, directory: str):
+        _save_columns(directory, {name: getattr(self, name) for name in self._columns},
+                      {name: getattr(self, name) for name in self._strings})
+
+    @classmethod
+    def load(cls, directory: str, mmap_mode: str = 'r') -> 'AnnotationTable':
+        columns, strings = _load_columns(directory, cls._columns, mmap_mode)
+        return cls(**strings, **columns)
+
+
 def load_documents_from_file(data_dir: str, docids: Set[str] = None) -> Dict[str, List[List[str]]]:
     """Loads a subset of available documents from 'docs.jsonl' file on disk.
 
@@ -1,4 +1,3 @@
-import itertools
 from typing import Tuple
 
 import torch
@@ -12,6 +11,7 @@ from timm.models.helpers import build_model_with_cfg
 
 from einops import rearrange
 
+from transformer_explainability.baselines.ViT.helpers import load_pretrained
 from transformer_explainability.modules.layers_ours import Add, AdaptiveAvgPool1d, BatchNorm2d, Clone, Conv2d, DropPath, Dropout, \
     einsum, GELU, Identity, LayerNorm, Linear, Softmax
 
@@ -28,6 +28,30 @@ class Conv2d_BN(nn.Sequential):
         torch.nn.init.constant_(bn.weight, bn_weight_init)
         torch.nn.init.constant_(bn.bias, 0)
         self.add_module('bn', bn)
+        # see set_fused
+        self.fused = False
+        self._fused_cache = None
+
+    def set_fused(self, fused=True):
+        """In eval mode, run the forward on the BN-folded convolution returned by fuse().
+
+        relprop stays that of the BN then the conv, see relprop.
+        """
+        self.fused = fused
+        self._fused_cache = None
+
+    def _fused_conv(self):
+        # rebuilt whenever a parameter or running statistic is modified or moved
+        tensors = (self.c.weight, self.bn.weight, self.bn.bias, self.bn.running_mean, self.bn.running_var)
+        key = tuple((t.data_ptr(), t._version, t.device, t.dtype) for t in tensors)
+        if self._fused_cache is None or self._fused_cache[0] != key:
+            self._fused_cache = (key, self.fuse())
+        return self._fused_cache[1]
+
+    def forward(self, x):
+        if self.fused and not self.training:
+            return self._fused_conv()(x)
+        return super().forward(x)
 
     @torch.no_grad()
     def fuse(self):
@@ -38,12 +62,20 @@ class Conv2d_BN(nn.Sequential):
             (bn.running_var + bn.eps)**0.5
         m = Conv2d(w.size(1) * self.c.groups, w.size(0), w.shape[2:], 
             stride=self.c.stride, padding=self.c.padding, dilation=self.c.dilation, groups=self.c.groups
-        )
+        ).to(device=w.device, dtype=w.dtype)
         m.weight.data.copy_(w)
         m.bias.data.copy_(b)
         return m
     
     def relprop(self, cam, **kwargs):
+        if self.fused and not self.training:
+            # the input the fused conv captured is the conv's, and the conv output the BN saw is recomputed
+            # from it. Relprop on the folded weights would be a different rule (BN canonization), whose maps
+            # differ from these even when every BN weight is positive
+            c, bn = self._modules.values()
+            c.X = self._fused_conv().X
+            with torch.no_grad():
+                bn.X = F.conv2d(c.X, c.weight, None, c.stride, c.padding, c.dilation, c.groups)
         cam = self._modules['bn'].relprop(cam, **kwargs)
         cam = self._modules['c'].relprop(cam, **kwargs)
         return cam
@@ -125,6 +157,18 @@ class PatchMerging(nn.Module):
             H, W = self.input_resolution
             cam = cam.permute(0, 2, 3, 1).reshape(B, H * W, -1)
         return cam
+
+    def rollout(self, rel):
+        """Spreads the token relevance rel (B, H/2 * W/2) evenly over the receptive field of the strided conv2"""
+        B = len(rel)
+        H, W = self.input_resolution
+        conv = self.conv2.c
+        kernel = rel.new_full((1, 1) + conv.kernel_size, 1. / (conv.kernel_size[0] * conv.kernel_size[1]))
+        rel = rel.view(B, 1, (H + 1) // 2, (W + 1) // 2)
+        output_padding = (H - ((rel.shape[2] - 1) * conv.stride[0] - 2 * conv.padding[0] + conv.kernel_size[0]),
+                          W - ((rel.shape[3] - 1) * conv.stride[1] - 2 * conv.padding[1] + conv.kernel_size[1]))
+        rel = F.conv_transpose2d(rel, kernel, stride=conv.stride, padding=conv.padding, output_padding=output_padding)
+        return rel.view(B, H * W)
     
 
 class MBConv(nn.Module):
@@ -273,30 +317,50 @@ class Attention(nn.Module):
         # attn = A*V
         self.matmul2 = einsum('bhij,bhjd->bhid')
 
-        points = list(itertools.product(
-            range(resolution[0]), range(resolution[1])))
-        N = len(points)
-        attention_offsets = {}
-        idxs = []
-        for p1 in points:
-            for p2 in points:
-                offset = (abs(p1[0] - p2[0]), abs(p1[1] - p2[1]))
-                if offset not in attention_offsets:
-                    attention_offsets[offset] = len(attention_offsets)
-                idxs.append(attention_offsets[offset])
+        self.resolution = resolution
         self.attention_biases = torch.nn.Parameter(
-            torch.zeros(num_heads, len(attention_offsets)))
+            torch.zeros(num_heads, resolution[0] * resolution[1]))
         self.register_buffer('attention_bias_idxs',
-                             torch.LongTensor(idxs).view(N, N),
+                             self.bias_idxs(resolution, resolution),
                              persistent=False)
-
-    @torch.no_grad()
-    def train(self, mode=True):
-        super().train(mode)
-        if mode and hasattr(self, 'ab'):
-            del self.ab
-        else:
-            self.ab = self.attention_biases[:, self.attention_bias_idxs]
+        # eval mode biases per resolution, see get_attention_biases
+        self._ab_cache = {}
+
+    @staticmethod
+    def bias_idxs(resolution, table_resolution):
+        """(N, N) index of every query/key point pair of a resolution into the bias table.
+
+        A pair is keyed by its offset (|dy|, |dx|); offsets are numbered row major over
+        table_resolution, the order in which the table of a checkpoint is laid out.
+        """
+        rows = torch.arange(resolution[0]).repeat_interleave(resolution[1])
+        cols = torch.arange(resolution[1]).repeat(resolution[0])
+        return (rows[:, None] - rows[None, :]).abs() * table_resolution[1] + (cols[:, None] - cols[None, :]).abs()
+
+    def get_attention_biases(self, resolution=None):
+        """(num_heads, N, N) attention biases of a resolution no larger than the table's.
+
+        In training the biases are gathered on every call so that they receive gradients.
+        Otherwise the gathered tensor is cached per resolution, and only rebuilt once the
+        table has been modified (e.g. by load_state_dict), replaced or moved.
+        """
+        if resolution is None:
+            resolution = self.resolution
+        idxs = self.attention_bias_idxs
+        if resolution != self.resolution:
+            assert resolution[0] <= self.resolution[0] and resolution[1] <= self.resolution[1], \
+                'no attention biases for resolution {}'.format(resolution)
+            idxs = self.bias_idxs(resolution, self.resolution).to(idxs.device)
+        if self.training:
+            return self.attention_biases[:, idxs]
+        version = (self.attention_biases.data_ptr(), self.attention_biases._version,
+                   self.attention_biases.device, self.attention_biases.dtype)
+        cached = self._ab_cache.get(resolution)
+        if cached is None or cached[0] != version:
+            with torch.no_grad():
+                cached = (version, self.attention_biases[:, idxs])
+            self._ab_cache[resolution] = cached
+        return cached[1]
 
     def save_v(self, v):
         self.v = v
@@ -319,7 +383,7 @@ class Attention(nn.Module):
     def get_attn_gradients(self):
         return self.attn_gradients
     
-    def forward(self, x):  # x (B,N,C)
+    def forward(self, x, resolution=None):  # x (B,N,C)
         B, N, _ = x.shape
 
         # Normalization
@@ -332,9 +396,7 @@ class Attention(nn.Module):
         self.save_v(v) 
 
         attn = self.matmul1([q, k]) * self.scale
-        attn = attn + \
-            (self.attention_biases[:, self.attention_bias_idxs]
-             if self.training else self.ab)
+        attn = attn + self.get_attention_biases(resolution)
         attn = self.softmax(attn)
 
         self.save_attn(attn)
@@ -461,6 +523,50 @@ class TinyViTBlock(nn.Module):
         self.clone2 = Clone()
         self.add2 = Add()
 
+        # see _window_index
+        self._window_index_cache = {}
+
+    def _window_index(self, device):
+        """Gather maps between the (B, L) token layout and B*nH*nW windows of window_size**2 tokens.
+
+        Returns the token of every window position (padding positions point at token 0),
+        the mask of the padding positions (None if the resolution needs no padding) and
+        the window position of every token. They are built once per device.
+        """
+        cached = self._window_index_cache.get(device)
+        if cached is None:
+            H, W = self.input_resolution
+            nH = -(-H // self.window_size)
+            nW = -(-W // self.window_size)
+            offsets = torch.arange(self.window_size)
+            # (nH, nW, window_size, window_size) grid of the padded positions, window by window
+            rows = (torch.arange(nH).view(nH, 1, 1, 1) * self.window_size + offsets.view(1, 1, -1, 1)).expand(
+                nH, nW, self.window_size, self.window_size).reshape(-1)
+            cols = (torch.arange(nW).view(1, nW, 1, 1) * self.window_size + offsets.view(1, 1, 1, -1)).expand(
+                nH, nW, self.window_size, self.window_size).reshape(-1)
+            valid = (rows < H) & (cols < W)
+            index = torch.where(valid, rows * W + cols, torch.zeros_like(rows))
+            inverse = torch.empty(H * W, dtype=torch.long)
+            inverse[index[valid]] = torch.arange(len(index))[valid]
+            padding = None if bool(valid.all()) else (~valid).to(device).unsqueeze(1)
+            cached = (index.to(device), padding, inverse.to(device))
+            self._window_index_cache[device] = cached
+        return cached
+
+    def window_partition(self, x):
+        """(B, L, C) tokens to (B*nH*nW, window_size**2, C) windows, zero at the padding positions"""
+        B, L, C = x.shape
+        index, padding, _ = self._window_index(x.device)
+        x = x.index_select(1, index)
+        if padding is not None:
+            x.masked_fill_(padding, 0)
+        return x.view(-1, self.window_size * self.window_size, C)
+
+    def window_reverse(self, x, B):
+        """(B*nH*nW, window_size**2, C) windows back to (B, L, C) tokens, dropping the padding positions"""
+        _, _, inverse = self._window_index(x.device)
+        return x.reshape(B, -1, x.shape[-1]).index_select(1, inverse)
+
     def forward(self, x):
         H, W = self.input_resolution
         B, L, C = x.shape
@@ -469,32 +575,9 @@ class TinyViTBlock(nn.Module):
         if H == self.window_size and W == self.window_size:
             x = self.attn(x)
         else:
-            x = x.view(B, H, W, C)
-            pad_b = (self.window_size - H %
-                     self.window_size) % self.window_size
-            pad_r = (self.window_size - W %
-                     self.window_size) % self.window_size
-            padding = pad_b > 0 or pad_r > 0
-
-            if padding:
-                x = F.pad(x, (0, 0, 0, pad_r, 0, pad_b))
-
-            pH, pW = H + pad_b, W + pad_r
-            nH = pH // self.window_size
-            nW = pW // self.window_size
-            # window partition
-            x = x.view(B, nH, self.window_size, nW, self.window_size, C).transpose(2, 3).reshape(
-                B * nH * nW, self.window_size * self.window_size, C
-            )
+            x = self.window_partition(x)
             x = self.attn(x)
-            # window reverse
-            x = x.view(B, nH, nW, self.window_size, self.window_size,
-                       C).transpose(2, 3).reshape(B, pH, pW, C)
-
-            if padding:
-                x = x[:, :H, :W].contiguous()
-
-            x = x.view(B, L, C)
+            x = self.window_reverse(x, B)
 
         x = self.add1([res_x, self.drop_path(x)])
 
@@ -530,34 +613,28 @@ class TinyViTBlock(nn.Module):
         if H == self.window_size and W == self.window_size:
             cam = self.attn.relprop(cam, **kwargs)
         else:
-            pad_b = (self.window_size - H %
-                     self.window_size) % self.window_size
-            pad_r = (self.window_size - W %
-                     self.window_size) % self.window_size
-            padding = pad_b > 0 or pad_r > 0
-
-            pH, pW = H + pad_b, W + pad_r
-            nH = pH // self.window_size
-            nW = pW // self.window_size
-
-            cam = cam.reshape(B, H, W, C)
-
-            if padding:
-                cam = F.pad(cam, (0, 0, 0, pad_r, 0, pad_b))
-            
-            cam = cam.view(B, nH, self.window_size, nW, self.window_size, C).transpose(2, 3).reshape(
-                B * nH * nW, self.window_size * self.window_size, C
-            )
+            cam = self.window_partition(cam)
             cam = self.attn.relprop(cam, **kwargs)
-            cam = cam.view(B, nH, nW, self.window_size, self.window_size,
-                       C).transpose(2, 3).reshape(B, pH, pW, C)
-            
-            cam = cam[:, :H, :W].view(B, L, C)
+            cam = self.window_reverse(cam, B)
 
         cam = self.clone1.relprop((res_cam, cam), **kwargs)
         
         return cam
 
+    def rollout(self, rel, attn):
+        """Composes the token relevance rel (B, L) with attn + I, attn being the (B*nH*nW, N, N) window maps.
+
+        Every window only mixes its own tokens, so the block is applied as a batch of small
+        per-window products instead of a dense (L, L) matrix.
+        """
+        H, W = self.input_resolution
+        B, L = rel.shape
+        if H == self.window_size and W == self.window_size:
+            return rel + torch.bmm(rel.unsqueeze(1), attn).squeeze(1)
+        rel = self.window_partition(rel.unsqueeze(2)).transpose(1, 2)
+        rel = rel + torch.bmm(rel, attn)
+        return self.window_reverse(rel.transpose(1, 2), B).squeeze(2)
+
             
 class BasicLayer(nn.Module):
     """ 
@@ -631,7 +708,7 @@ class BasicLayer(nn.Module):
     def relprop(self, cam , **kwargs):
         if self.downsample is not None:
             cam = self.downsample.relprop(cam , **kwargs)
-        for blk in self.blocks:
+        for blk in reversed(self.blocks):
             cam = blk.relprop(cam, **kwargs)
         return cam
 
@@ -756,6 +833,12 @@ class TinyViT(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
+    def set_fused(self, fused=True):
+        """Switches every Conv2d_BN to (or back from) its BN-folded convolution, see Conv2d_BN.set_fused"""
+        for m in self.modules():
+            if isinstance(m, Conv2d_BN):
+                m.set_fused(fused)
+
     @torch.jit.ignore
     def no_weight_decay_keywords(self):
         return {'attention_biases'}
@@ -802,49 +885,42 @@ class TinyViT(nn.Module):
             cam = cam.sum(dim=1)
             return cam
         
-        elif method == "rollout":
-            # cam rollout
-            attn_cams = []
-            for layer in self.layers[1:]:
-                for blk in layer.blocks:
-                    attn_heads = blk.attn.get_attn_cam().clamp(min=0)
-                    avg_heads = (attn_heads.sum(dim=1) / attn_heads.shape[1]).detach()
-                    attn_cams.append(avg_heads)
-            cam = compute_rollout_attention(attn_cams, start_layer=start_layer)
-            cam = cam[:, 0, 1:]
-            return cam
-        
-        # our method, method name grad is legacy
-        elif method == "transformer_attribution" or method == "grad":
-            cams = []
-            for layer in self.layers[1:]:
-                for blk in layer.blocks:
-                    grad = blk.attn.get_attn_gradients()
-                    cam = blk.attn.get_attn_cam()
-                    cam = cam[0].reshape(-1, cam.shape[-1], cam.shape[-1])
-                    grad = grad[0].reshape(-1, grad.shape[-1], grad.shape[-1])
-                    cam = grad * cam
-                    cam = cam.clamp(min=0).mean(dim=0)
-                    cams.append(cam.unsqueeze(0))
-            rollout = compute_rollout_attention(cams, start_layer=start_layer)
-            cam = rollout[:, 0, 1:]
-            return cam
+        elif method in ("rollout", "transformer_attribution", "grad"):
+            # our method, method name grad is legacy
+            return self.windowed_rollout(len(cam), method=method, start_layer=start_layer)
 
         return cam
-    
-def compute_rollout_attention(all_layer_matrices, start_layer=0):
-    # adding residual consideration
-    num_tokens = all_layer_matrices[0].shape[1]
-    batch_size = all_layer_matrices[0].shape[0]
-    eye = torch.eye(num_tokens).expand(batch_size, num_tokens, num_tokens).to(all_layer_matrices[0].device)
-    all_layer_matrices = [all_layer_matrices[i] + eye for i in range(len(all_layer_matrices))]
-    # all_layer_matrices = [all_layer_matrices[i] / all_layer_matrices[i].sum(dim=-1, keepdim=True)
-    #                       for i in range(len(all_layer_matrices))]
-    joint_attention = all_layer_matrices[start_layer]
-    for i in range(start_layer+1, len(all_layer_matrices)):
-        joint_attention = all_layer_matrices[i].bmm(joint_attention)
-    return joint_attention
-    
+
+    def windowed_rollout(self, batch_size, method="transformer_attribution", start_layer=0):
+        """Rollout of the window attention maps down to a (B, patches) relevance map at the stem resolution.
+
+        The relevance of the pooled output is shared evenly by the tokens of the last stage and
+        composed, block by block from the last one, with the per-window (attention + I) maps of
+        the blocks from start_layer on; PatchMerging maps it back across stages. No global
+        token x token matrix is built.
+        """
+        blocks = [blk for layer in self.layers[1:] for blk in layer.blocks]
+        H, W = self.layers[-1].input_resolution
+        rel = self.norm_head.weight.new_full((batch_size, H * W), 1. / (H * W))
+        blk_idx = len(blocks)
+        for layer in reversed(self.layers):
+            if layer.downsample is not None:
+                rel = layer.downsample.rollout(rel)
+            if not isinstance(layer, BasicLayer):
+                continue
+            for blk in reversed(layer.blocks):
+                blk_idx -= 1
+                if blk_idx < start_layer:
+                    continue
+                attn = blk.attn.get_attn_cam()
+                if method == "rollout":
+                    attn = attn.clamp(min=0).mean(dim=1)
+                else:
+                    attn = (blk.attn.get_attn_gradients() * attn).clamp(min=0).mean(dim=1)
+                rel = blk.rollout(rel, attn.detach())
+        return rel
+
+
 _checkpoint_url_format = \
     'https://github.com/wkcn/TinyViT-model-zoo/releases/download/checkpoints/{}.pth'
 
@@ -877,11 +953,15 @@ def _create_tiny_vit(variant, pretrained=False, **kwargs):
             not k.endswith('attention_bias_idxs')}
         return state_dict
 
-    return build_model_with_cfg(
-        TinyViT, variant, pretrained,
+    # the checkpoint is loaded with load_pretrained rather than timm's, which memory maps it
+    model = build_model_with_cfg(
+        TinyViT, variant, False,
         pretrained_cfg=cfg,
-        pretrained_filter_fn=_pretrained_filter_fn,
         **kwargs)
+    if pretrained:
+        load_pretrained(model, cfg, num_classes=kwargs.get('num_classes', 1000),
+                        in_chans=kwargs.get('in_chans', 3), filter_fn=_pretrained_filter_fn)
+    return model
     
 
 @register_model
@@ -124,7 +124,11 @@ class Attention(nn.Module):
         return self.v_cam
 
     def save_attn_gradients(self, attn_gradients):
-        self.attn_gradients = attn_gradients
+        if is_relevance_backward():
+            # relevance_backward passes the relevance divided by attn
+            self.save_attn_cam(self.attn.detach() * attn_gradients)
+        else:
+            self.attn_gradients = attn_gradients
 
     def get_attn_gradients(self):
         return self.attn_gradients
@@ -142,7 +146,7 @@ class Attention(nn.Module):
         attn = self.attn_drop(attn)
 
         self.save_attn(attn)
-        attn.register_hook(self.save_attn_gradients)
+        register_tensor_hook(attn, self.save_attn_gradients)
 
         out = self.matmul2([attn, v])
         out = rearrange(out, 'b h n d -> b n (h d)')
@@ -283,7 +287,8 @@ class VisionTransformer(nn.Module):
         self.inp_grad = None
 
     def save_inp_grad(self,grad):
-        self.inp_grad = grad
+        if not is_relevance_backward():
+            self.inp_grad = grad
 
     def get_inp_grad(self):
         return self.inp_grad
@@ -310,7 +315,7 @@ class VisionTransformer(nn.Module):
         x = torch.cat((cls_tokens, x), dim=1)
         x = self.add([x, self.pos_embed])
 
-        x.register_hook(self.save_inp_grad)
+        register_tensor_hook(x, self.save_inp_grad)
 
         for blk in self.blocks:
             x = blk(x)
@@ -322,8 +327,6 @@ class VisionTransformer(nn.Module):
         return x
 
     def relprop(self, cam=None,method="transformer_attribution", is_ablation=False, start_layer=0, **kwargs):
-        # print(kwargs)
-        # print("conservation 1", cam.sum())
         cam = self.head.relprop(cam, **kwargs)
         cam = cam.unsqueeze(1)
         cam = self.pool.relprop(cam, **kwargs)
@@ -331,8 +334,6 @@ class VisionTransformer(nn.Module):
         for blk in reversed(self.blocks):
             cam = blk.relprop(cam, **kwargs)
 
-        # print("conservation 2", cam.sum())
-        # print("min", cam.min())
 
         if method == "full":
             (cam, _) = self.add.relprop(cam, **kwargs)
@@ -342,7 +343,11 @@ class VisionTransformer(nn.Module):
             cam = cam.sum(dim=1)
             return cam
 
-        elif method == "rollout":
+        return self.attn_relprop(method=method, is_ablation=is_ablation, start_layer=start_layer)
+
+    def attn_relprop(self, method="transformer_attribution", is_ablation=False, start_layer=0):
+        # the methods built from the attention maps, cams and gradients saved by the blocks
+        if method == "rollout":
             # cam rollout
             attn_cams = []
             for blk in self.blocks:
@@ -0,0 +1,201 @@
+""" The ViT_LRP explanations as a pure function of the model weights, the input and the target.
+
+explain() reads the weights of a ViT_LRP VisionTransformer, but none of the attributes its forward hooks
+and relprop methods set (X, Y, attn_cam, attn_gradients). The forward returns the tensors the rules need,
+the attention gradients come from torch.func and relprop takes everything explicitly, so the whole
+explanation traces into a single graph and can be wrapped in torch.compile:
+
+    explain_fn = torch.compile(explain)
+    cam = explain_fn(model, image, target)
+
+The Linear and Conv2d layers go through the rules of modules.lrp_rules, those of relprop with alpha=1
+unless a policy assigns others, for models in eval mode with a Linear head.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.func import grad_and_value
+
+from baselines.ViT.ViT_LRP import Block, VisionTransformer, compute_rollout_attention
+from modules.lrp_rules import (AlphaBetaRule, ZBRule, compute_dtype_of, einsum_grad_equations, einsum_gradients,
+                               rule_for, safe_divide)
+
+
+def _linear(x, layer):
+    return F.linear(x, layer.weight, layer.bias)
+
+
+def _layer_norm(x, layer):
+    return F.layer_norm(x, layer.normalized_shape, layer.weight, layer.bias, layer.eps)
+
+
+class _LayerInput:
+    """layer as the lrp_rules see it, with the input X given instead of captured by its forward_hook"""
+
+    def __init__(self, layer, X):
+        self.layer = layer
+        self.X = X
+        # the weight transforms of the rules are cached on the layer, shared with its relprop
+        self._rule_weights = layer.__dict__.setdefault('_rule_weights', {})
+
+    def __getattr__(self, name):
+        if name in ('rule_forward', 'rule_gradprop'):
+            # bound to the view, so that they read its X
+            return getattr(type(self.layer), name).__get__(self)
+        return getattr(self.layer, name)
+
+
+def _layer_relprop(layer, R, X, policy, default):
+    # the relprop of a Linear or Conv2d of ViT_LRP for the input X
+    return rule_for(layer, policy, default)(_LayerInput(layer, X), R, compute_dtype_of(policy))
+
+
+# the matmuls of Attention, q @ k^T and attn @ v
+_QK_GRAD = einsum_grad_equations('bhid,bhjd->bhij')
+_AV_GRAD = einsum_grad_equations('bhij,bhjd->bhid')
+
+
+def _matmul_relprop(R, a, b, Y, grad_equations):
+    # layers_ours.einsum, halving both relevances as Attention.relprop does
+    Ca, Cb = einsum_gradients(grad_equations, a, b, safe_divide(R, Y))
+    return a * Ca / 2, b * Cb / 2
+
+
+def _add_relprop(R, a, b):
+    # layers_ours.Add, with the relevance shared out per sample
+    S = safe_divide(R, a + b)
+    Ra = a * S
+    Rb = b * S
+    dims = tuple(range(1, R.dim()))
+    a_sum = Ra.sum(dims, keepdim=True)
+    b_sum = Rb.sum(dims, keepdim=True)
+    R_sum = R.sum(dims, keepdim=True)
+    total = a_sum.abs() + b_sum.abs()
+    Ra = Ra * safe_divide(safe_divide(a_sum.abs(), total) * R_sum, a_sum)
+    Rb = Rb * safe_divide(safe_divide(b_sum.abs(), total) * R_sum, b_sum)
+    return Ra, Rb
+
+
+def _clone_relprop(x, R1, R2):
+    return x * (safe_divide(R1, x) + safe_divide(R2, x))
+
+
+def _block_forward(blk, x, tap):
+    # Block.forward, returning what _block_relprop needs; tap is added to the attention map so that
+    # its gradient is the attention gradient
+    attn = blk.attn
+    B, N, C = x.shape
+    h = attn.num_heads
+    n1 = _layer_norm(x, blk.norm1)
+    q, k, v = _linear(n1, attn.qkv).reshape(B, N, 3, h, C // h).permute(2, 0, 3, 1, 4)
+    dots = torch.matmul(q, k.transpose(-2, -1))
+    attn_map = (dots * attn.scale).softmax(dim=-1) + tap
+    attn_v = torch.matmul(attn_map, v)
+    out = attn_v.transpose(1, 2).reshape(B, N, C)
+    attn_out = _linear(out, attn.proj)
+    x_mid = x + attn_out
+    n2 = _layer_norm(x_mid, blk.norm2)
+    g = F.gelu(_linear(n2, blk.mlp.fc1))
+    mlp_out = _linear(g, blk.mlp.fc2)
+    saved = (x, n1, q, k, v, dots, attn_map, attn_v, out, attn_out, x_mid, n2, g, mlp_out)
+    return x_mid + mlp_out, saved
+
+
+def _block_relprop(blk, R, saved, policy):
+    # Block.relprop, returning the relevance of the input and of the attention map
+    x, n1, q, k, v, dots, attn_map, attn_v, out, attn_out, x_mid, n2, g, mlp_out = saved
+    B, N, C = x.shape
+    h = blk.attn.num_heads
+
+    R1, R2 = _add_relprop(R, x_mid, mlp_out)
+    R2 = _layer_relprop(blk.mlp.fc2, R2, g, policy, AlphaBetaRule(joint=True))
+    R2 = _layer_relprop(blk.mlp.fc1, R2, n2, policy, AlphaBetaRule(joint=True))
+    R = _clone_relprop(x_mid, R1, R2)
+
+    R1, R2 = _add_relprop(R, x, attn_out)
+    R2 = _layer_relprop(blk.attn.proj, R2, out, policy, AlphaBetaRule(joint=True))
+    R2 = R2.reshape(B, N, h, C // h).transpose(1, 2)
+    R_attn, R_v = _matmul_relprop(R2, attn_map, v, attn_v, _AV_GRAD)
+    R_q, R_k = _matmul_relprop(R_attn, q, k, dots, _QK_GRAD)
+    R2 = torch.stack([R_q, R_k, R_v], dim=2).permute(0, 3, 2, 1, 4).reshape(B, N, 3 * C)
+    R2 = _layer_relprop(blk.attn.qkv, R2, n1, policy, AlphaBetaRule(joint=True))
+    return _clone_relprop(x, R1, R2), R_attn
+
+
+def _forward(model, input, taps):
+    # VisionTransformer.forward without its hooks
+    B = input.shape[0]
+    proj = model.patch_embed.proj
+    patches = F.conv2d(input, proj.weight, proj.bias, stride=proj.stride, padding=proj.padding)
+    tokens = torch.cat((model.cls_token.expand(B, -1, -1), patches.flatten(2).transpose(1, 2)), dim=1)
+    x = tokens + model.pos_embed
+    saved = []
+    for blk, tap in zip(model.blocks, taps):
+        x, s = _block_forward(blk, x, tap)
+        saved.append(s)
+    y = _layer_norm(x, model.norm)
+    cls = y[:, 0]
+    logits = _linear(cls, model.head)
+    return logits, (tokens, y, cls, saved)
+
+
+def explain(model, input, target, method="transformer_attribution", start_layer=0, policy=None):
+    """The relevance of input for the classes target, a LongTensor with one class per sample.
+
+    method is "transformer_attribution" (the default of LRP.generate_LRP), "rollout" over the
+    attention relevance, or "full" for pixel relevance. Returns (B, num_patches) or (B, H, W).
+    policy assigns the rules of the Linear and Conv2d layers, as in relprop.
+    Unlike the relprop walk, every sample of the batch is explained.
+    """
+    # _forward replays VisionTransformer.forward and Block.forward, with exact GELUs, class token pooling and a
+    # Linear head
+    assert type(model).forward is VisionTransformer.forward, \
+        'explain replays VisionTransformer.forward, which {} overrides'.format(type(model).__name__)
+    assert isinstance(model.head, nn.Linear), 'explain needs a Linear head, not {}'.format(type(model.head).__name__)
+    for blk in model.blocks:
+        assert type(blk).forward is Block.forward, \
+            'explain replays Block.forward, which {} overrides'.format(type(blk).__name__)
+        assert isinstance(blk.mlp.act, nn.GELU) and blk.mlp.act.approximate == 'none', \
+            'explain needs exact GELU activations, not {}'.format(blk.mlp.act)
+    B = input.shape[0]
+    N = model.patch_embed.num_patches + 1
+    taps = [input.new_zeros(B, blk.attn.num_heads, N, N) for blk in model.blocks]
+
+    def score(taps):
+        logits, captured = _forward(model, input, taps)
+        one_hot = F.one_hot(target, logits.shape[-1]).to(logits.dtype)
+        return (logits * one_hot).sum(), (logits, one_hot, captured)
+
+    if method == "transformer_attribution":
+        attn_grads, (_, (logits, one_hot, captured)) = grad_and_value(score, has_aux=True)(taps)
+    else:
+        attn_grads = None
+        _, (logits, one_hot, captured) = score(taps)
+    tokens, y, cls, saved = captured
+
+    with torch.no_grad():
+        R = _layer_relprop(model.head, one_hot, cls, policy, AlphaBetaRule(joint=True))
+        # the pooling of the class token
+        R = y[:, :1] * safe_divide(R.unsqueeze(1), y[:, :1])
+        R = torch.cat([R, torch.zeros_like(y[:, 1:])], dim=1)
+        attn_cams = []
+        for blk, s in zip(reversed(model.blocks), reversed(saved)):
+            R, cam = _block_relprop(blk, R, s, policy)
+            attn_cams.insert(0, cam)
+
+        if method == "full":
+            R, _ = _add_relprop(R, tokens, model.pos_embed.expand_as(tokens))
+            R = R[:, 1:].transpose(1, 2)
+            gh, gw = model.patch_embed.img_size[0] // model.patch_embed.patch_size[0], \
+                model.patch_embed.img_size[1] // model.patch_embed.patch_size[1]
+            R = R.reshape(B, -1, gh, gw)
+            return _layer_relprop(model.patch_embed.proj, R, input, policy, ZBRule()).sum(dim=1)
+
+        if method == "rollout":
+            cams = [cam.clamp(min=0).mean(dim=1) for cam in attn_cams]
+        elif method == "transformer_attribution":
+            cams = [(grad * cam).clamp(min=0).mean(dim=1) for grad, cam in zip(attn_grads, attn_cams)]
+        else:
+            raise ValueError("Unknown method {}".format(method))
+        rollout = compute_rollout_attention(cams, start_layer=start_layer)
+    return rollout[:, 0, 1:]
@@ -3,6 +3,9 @@ import torch
 import numpy as np
 from numpy import *
 
+from modules.layers_ours import attention_backward, autograd_lrp, relevance_backward
+from modules.lrp_rules import compute_dtype_of
+
 # compute rollout between attention layers
 def compute_rollout_attention(all_layer_matrices, start_layer=0):
     # adding residual consideration- code adapted from https://github.com/samiraabnar/attention_flow
@@ -17,29 +20,87 @@ def compute_rollout_attention(all_layer_matrices, start_layer=0):
         joint_attention = matrices_aug[i].bmm(joint_attention)
     return joint_attention
 
+def plan_passes(method, is_ablation=False):
+    # what method reads beyond the forward: the slice of the blocks whose attention gradients it needs, or
+    # None for no backward, and whether it needs the relevance of relprop
+    if method in ("transformer_attribution", "grad"):
+        return slice(None), True
+    if method == "last_layer":
+        return (slice(-1, None) if is_ablation else None), True
+    if method == "second_layer":
+        return (slice(1, 2) if is_ablation else None), True
+    if method == "last_layer_attn":
+        return None, False
+    # full and rollout
+    return None, True
+
 class LRP:
     def __init__(self, model):
         self.model = model
         self.model.eval()
 
-    def generate_LRP(self, input, index=None, method="transformer_attribution", is_ablation=False, start_layer=0):
-        output = self.model(input)
+    def forward(self, input, policy=None, autocast_forward=False):
+        # with autocast_forward, a policy with a lower precision compute_dtype also runs the forward under
+        # autocast, capturing activations in that dtype. This halves their memory but changes the activations
+        # themselves, and the full maps follow them loosely, so by default the forward stays in float32
+        dtype = compute_dtype_of(policy)
+        enabled = autocast_forward and dtype is not None and dtype != torch.float32
+        with torch.autocast(input.device.type, dtype=dtype if enabled else None, enabled=enabled):
+            return self.model(input)
+
+    def generate_LRP(self, input, index=None, method="transformer_attribution", is_ablation=False, start_layer=0,
+                     policy=None, autocast_forward=False):
+        # policy is a modules.lrp_rules.Policy choosing the relprop rules and precision, see forward for
+        # autocast_forward
+        output = self.forward(input, policy, autocast_forward)
+        gradient_blocks, needs_relprop = plan_passes(method, is_ablation)
+        if not needs_relprop:
+            return self.model.attn_relprop(method=method, is_ablation=is_ablation, start_layer=start_layer)
         kwargs = {"alpha": 1}
+        if policy is not None:
+            kwargs["policy"] = policy
         if index == None:
-            index = np.argmax(output.cpu().data.numpy(), axis=-1)
+            index = np.argmax(output.float().cpu().data.numpy(), axis=-1)
 
         one_hot = np.zeros((1, output.size()[-1]), dtype=np.float32)
         one_hot[0, index] = 1
         one_hot_vector = one_hot
-        one_hot = torch.from_numpy(one_hot).requires_grad_(True)
-        one_hot = torch.sum(one_hot.cuda() * output)
-
-        self.model.zero_grad()
-        one_hot.backward(retain_graph=True)
+        if gradient_blocks is not None:
+            one_hot = torch.from_numpy(one_hot).requires_grad_(True)
+            one_hot = torch.sum(one_hot.cuda() * output)
+            attention_backward(one_hot, [blk.attn.get_attn() for blk in self.model.blocks[gradient_blocks]])
 
         return self.model.relprop(torch.tensor(one_hot_vector).to(input.device), method=method, is_ablation=is_ablation,
                                   start_layer=start_layer, **kwargs)
 
+    def generate_LRP_autograd(self, input, index=None, method="transformer_attribution", is_ablation=False,
+                              start_layer=0, policy=None, autocast_forward=False):
+        # as generate_LRP, with the relprop walk replaced by one relevance backward through the forward graph
+        input = input.detach().requires_grad_(True)
+        with autograd_lrp():
+            output = self.forward(input, policy, autocast_forward)
+        gradient_blocks, needs_relprop = plan_passes(method, is_ablation)
+        if not needs_relprop:
+            return self.model.attn_relprop(method=method, is_ablation=is_ablation, start_layer=start_layer)
+        kwargs = {"alpha": 1}
+        if policy is not None:
+            kwargs["policy"] = policy
+        if index == None:
+            index = np.argmax(output.float().cpu().data.numpy(), axis=-1)
+
+        one_hot = torch.zeros(1, output.size()[-1], device=output.device)
+        one_hot[0, index] = 1
+
+        if gradient_blocks is not None:
+            attentions = [blk.attn.get_attn() for blk in self.model.blocks[gradient_blocks]]
+            torch.autograd.grad(output, attentions, one_hot, retain_graph=True)
+
+        (cam,) = relevance_backward(output, one_hot, [input], **kwargs)
+        if method == "full":
+            # sum on channels
+            return cam.sum(dim=1)
+        return self.model.attn_relprop(method=method, is_ablation=is_ablation, start_layer=start_layer)
+
 
 
 class Baselines:
@@ -2,34 +2,76 @@
 
 Hacked together by / Copyright 2020 Ross Wightman
 """
+import inspect
 import logging
 import os
 import math
+import zipfile
 from collections import OrderedDict
 from copy import deepcopy
 from typing import Callable
+from urllib.parse import urlparse
 
 import torch
 import torch.nn as nn
-import torch.utils.model_zoo as model_zoo
 
 _logger = logging.getLogger(__name__)
 
 
+# torch.load(mmap=) and load_state_dict(assign=) are new in torch 2.1
+_LOAD_MMAP = 'mmap' in inspect.signature(torch.load).parameters
+_LOAD_ASSIGN = 'assign' in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def _torch_load(checkpoint_path):
+    """torch.load onto the CPU, memory mapping the tensor data where torch supports it (>= 2.1).
+
+    Mapped tensors are only paged in when read, and forked workers share the pages. Checkpoints
+    in the legacy (non zip) format cannot be mapped and are read as a whole.
+    """
+    if _LOAD_MMAP and zipfile.is_zipfile(checkpoint_path):
+        return torch.load(checkpoint_path, map_location='cpu', mmap=True)
+    return torch.load(checkpoint_path, map_location='cpu')
+
+
+def _load_url(url):
+    """model_zoo.load_url, loading the downloaded checkpoint with _torch_load"""
+    model_dir = os.path.join(torch.hub.get_dir(), 'checkpoints')
+    os.makedirs(model_dir, exist_ok=True)
+    cached_file = os.path.join(model_dir, os.path.basename(urlparse(url).path))
+    if not os.path.exists(cached_file):
+        _logger.info('Downloading: "{}" to {}'.format(url, cached_file))
+        torch.hub.download_url_to_file(url, cached_file, progress=False)
+    return _torch_load(cached_file)
+
+
+def assign_state_dict(model, state_dict, strict=True):
+    """model.load_state_dict, making the state_dict tensors the model's parameters and buffers.
+
+    Where torch supports it (>= 2.1) nothing is copied into the freshly initialized weights,
+    which are released instead; a tensor is only converted when its device or dtype differs
+    from the model's. Older torch falls back to copying.
+    """
+    own_state = model.state_dict()
+    state_dict = OrderedDict(
+        (k, v.to(device=own_state[k].device, dtype=own_state[k].dtype) if k in own_state else v)
+        for k, v in state_dict.items())
+    if _LOAD_ASSIGN:
+        return model.load_state_dict(state_dict, strict=strict, assign=True)
+    return model.load_state_dict(state_dict, strict=strict)
+
+
 def load_state_dict(checkpoint_path, use_ema=False):
     if checkpoint_path and os.path.isfile(checkpoint_path):
-        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        checkpoint = _torch_load(checkpoint_path)
         state_dict_key = 'state_dict'
         if isinstance(checkpoint, dict):
             if use_ema and 'state_dict_ema' in checkpoint:
                 state_dict_key = 'state_dict_ema'
         if state_dict_key and state_dict_key in checkpoint:
-            new_state_dict = OrderedDict()
-            for k, v in checkpoint[state_dict_key].items():
-                # strip `module.` prefix
-                name = k[7:] if k.startswith('module') else k
-                new_state_dict[name] = v
-            state_dict = new_state_dict
+            # strip `module.` prefix, the new dict only refers to the loaded tensors
+            state_dict = OrderedDict(
+                (k[7:] if k.startswith('module') else k, v) for k, v in checkpoint[state_dict_key].items())
         else:
             state_dict = checkpoint
         _logger.info("Loaded {} from checkpoint '{}'".format(state_dict_key, checkpoint_path))
@@ -41,7 +83,7 @@ def load_state_dict(checkpoint_path, use_ema=False):
 
 def load_checkpoint(model, checkpoint_path, use_ema=False, strict=True):
     state_dict = load_state_dict(checkpoint_path, use_ema)
-    model.load_state_dict(state_dict, strict=strict)
+    assign_state_dict(model, state_dict, strict=strict)
 
 
 def resume_checkpoint(model, checkpoint_path, optimizer=None, loss_scaler=None, log_info=True):
@@ -91,7 +133,7 @@ def load_pretrained(model, cfg=None, num_classes=1000, in_chans=3, filter_fn=Non
         _logger.warning("Pretrained model URL is invalid, using random initialization.")
         return
 
-    state_dict = model_zoo.load_url(cfg['url'], progress=False, map_location='cpu')
+    state_dict = _load_url(cfg['url'])
 
     if filter_fn is not None:
         state_dict = filter_fn(state_dict)
@@ -146,7 +188,7 @@ def load_pretrained(model, cfg=None, num_classes=1000, in_chans=3, filter_fn=Non
         del state_dict[classifier_name + '.bias']
         strict = False
 
-    model.load_state_dict(state_dict, strict=strict)
+    assign_state_dict(model, state_dict, strict=strict)
 
 
 def extract_layer(model, layer):
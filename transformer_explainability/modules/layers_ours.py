@@ -1,18 +1,16 @@
+import threading
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from contextlib import contextmanager
 
-from timm.models.layers import DropPath as TimmDropPath
+from .lrp_rules import (AlphaBetaRule, ZBRule, compute_dtype_of, einsum_grad_equations, einsum_gradients,
+                        linear_gradprop, rule_for, safe_divide, to_accumulate)
 
 __all__ = ['forward_hook', 'Clone', 'Add', 'Cat', 'ReLU', 'GELU', 'Dropout', 'BatchNorm2d', 'Linear', 'MaxPool2d',
            'AdaptiveAvgPool2d', 'AvgPool2d', 'Conv2d', 'Sequential', 'safe_divide', 'einsum', 'Softmax', 'IndexSelect',
-           'LayerNorm', 'AddEye']
-
-
-def safe_divide(a, b):
-    den = b.clamp(min=1e-9) + b.clamp(max=1e-9)
-    den = den + den.eq(0).type(den.type()) * 1e-9
-    return a / den * b.ne(0).type(b.type())
+           'LayerNorm', 'AddEye', 'autograd_lrp', 'relevance_backward', 'is_relevance_backward',
+           'attention_backward', 'register_tensor_hook']
 
 
 def forward_hook(self, input, output):
@@ -26,7 +24,8 @@ def forward_hook(self, input, output):
         self.X = input[0].detach()
         self.X.requires_grad = True
 
-    self.Y = output
+    # detached, so that Y does not keep the forward graph alive
+    self.Y = output.detach() if torch.is_tensor(output) else [y.detach() for y in output]
 
 
 def backward_hook(self, grad_input, grad_output):
@@ -34,31 +33,205 @@ def backward_hook(self, grad_input, grad_output):
     self.grad_output = grad_output
 
 
+class _AutogradLRP:
+    # record: RelProp layers called while set go through _RelPropFunction (see autograd_lrp)
+    # relprop_kwargs: set during relevance_backward, None during ordinary backward passes
+    def __init__(self):
+        self.record = False
+        self.relprop_kwargs = None
+
+
+_local = threading.local()
+# autograd_lrp contexts open in any thread, so that RelProp.__call__ only looks up _state() while one is
+_recording = 0
+_recording_lock = threading.Lock()
+
+
+def _state():
+    # the _AutogradLRP of the calling thread, or the one of the graph whose backward it is running. Autograd
+    # runs the backward of CUDA tensors in threads of its own, so the recorded Functions and the hooks
+    # registered with register_tensor_hook keep the state of the thread that ran their forward
+    state = getattr(_local, 'backward', None) or getattr(_local, 'state', None)
+    if state is None:
+        state = _local.state = _AutogradLRP()
+    return state
+
+
+@contextmanager
+def _backward_of(state):
+    # _state() answers state in this thread for the duration
+    backward = getattr(_local, 'backward', None)
+    _local.backward = state
+    try:
+        yield
+    finally:
+        _local.backward = backward
+
+
+@contextmanager
+def autograd_lrp():
+    """Records the RelProp layers called in this context as autograd Functions.
+
+    An ordinary backward through the recorded graph computes the usual gradients, while
+    relevance_backward propagates relevance through it with each layer's relprop rule.
+    The context only applies to the thread entering it.
+    """
+    global _recording
+    state = _state()
+    record = state.record
+    state.record = True
+    with _recording_lock:
+        _recording += 1
+    try:
+        yield
+    finally:
+        state.record = record
+        with _recording_lock:
+            _recording -= 1
+
+
+def is_relevance_backward():
+    return _state().relprop_kwargs is not None
+
+
+def register_tensor_hook(tensor, hook):
+    """tensor.register_hook(hook), with is_relevance_backward in hook answering for the thread registering it."""
+    state = _state()
+
+    def run(grad):
+        with _backward_of(state):
+            return hook(grad)
+
+    return tensor.register_hook(run)
+
+
+def relevance_backward(output, R, inputs, retain_graph=None, **kwargs):
+    """Propagates the relevance R of output, computed under autograd_lrp in this thread, in a single backward.
+
+    The graph carries relevance divided by the activations, so that the reshapes, scalings and
+    concatenations between RelProp layers conserve it as they do gradients. Returns the relevance
+    of each of inputs; tensor hooks see R / x for their tensor x.
+    """
+    state = _state()
+    relprop_kwargs = state.relprop_kwargs
+    state.relprop_kwargs = kwargs
+    try:
+        C = torch.autograd.grad(output, inputs, safe_divide(R, output.detach()), retain_graph=retain_graph,
+                                allow_unused=True)
+    finally:
+        state.relprop_kwargs = relprop_kwargs
+    return [None if c is None else x.detach() * c for x, c in zip(inputs, C)]
+
+
+def attention_backward(score, attentions):
+    # the backward of score only as far as the attention maps, whose hooks save their gradients
+    torch.autograd.grad(score, attentions)
+
+
+class _RelPropFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, module, spec, kwargs, n_inputs, *tensors):
+        # the forward runs on leaves, keeping its graph for the gradient backward
+        leaves = [t.detach().requires_grad_(t.requires_grad) for t in tensors[:n_inputs]]
+        args, i = [], 0
+        for arg in spec:
+            if arg is _RelPropFunction:
+                args.append(leaves[i])
+                i += 1
+            elif type(arg) is int and arg < 0:
+                args.append(leaves[i:i - arg])
+                i -= arg
+            else:
+                args.append(arg[0])
+        with torch.enable_grad():
+            outputs = nn.Module.__call__(module, *args, **kwargs)
+        # a layer can be called more than once, as Dropout in Mlp, so each call keeps its own X and Y
+        ctx.module, ctx.X, ctx.Y = module, module.X, module.Y
+        ctx.state = _state()
+        ctx.n_first = 1 if torch.is_tensor(args[0]) else len(args[0])
+        ctx.multiple = not torch.is_tensor(outputs)
+        ctx.leaves = leaves + list(tensors[n_inputs:])
+        ctx.outputs = list(outputs) if ctx.multiple else [outputs]
+        if ctx.multiple:
+            return tuple(o.detach() for o in outputs)
+        return outputs.detach()
+
+    @staticmethod
+    def backward(ctx, *grads):
+        needs = ctx.needs_input_grad[4:]
+        relprop_kwargs = ctx.state.relprop_kwargs
+        if relprop_kwargs is None:
+            wanted = [t for t, need in zip(ctx.leaves, needs) if need]
+            C = iter(torch.autograd.grad(ctx.outputs, wanted, grads, retain_graph=True, allow_unused=True))
+            return (None,) * 4 + tuple(next(C) if need else None for need in needs)
+
+        R = [y.detach() * g for y, g in zip(ctx.outputs, grads)]
+        X = ctx.module.X = ctx.X
+        ctx.module.Y = ctx.Y
+        with torch.enable_grad(), _backward_of(ctx.state):
+            R = ctx.module.autograd_relprop(R if ctx.multiple else R[0], **relprop_kwargs)
+        if torch.is_tensor(X):
+            R, X = [R], [X]
+        C = [safe_divide(r.detach(), x.detach()) for r, x in zip(R, X)]
+        return (None,) * 4 + tuple(C) + (None,) * (len(needs) - ctx.n_first)
+
+
+def _relprop_function(module, args, kwargs):
+    # tensors and lists of tensors in args become inputs of the Function, anything else is passed as is
+    spec, tensors = [], []
+    for arg in args:
+        if torch.is_tensor(arg) and arg.is_floating_point():
+            spec.append(_RelPropFunction)
+            tensors.append(arg)
+        elif type(arg) in (list, tuple) and len(arg) and all(torch.is_tensor(a) for a in arg):
+            spec.append(-len(arg))
+            tensors.extend(arg)
+        else:
+            spec.append((arg,))
+    outputs = _RelPropFunction.apply(module, spec, kwargs, len(tensors), *tensors, *module.parameters())
+    return list(outputs) if type(outputs) is tuple else outputs
+
+
 class RelProp(nn.Module):
     def __init__(self):
         super(RelProp, self).__init__()
         # if not self.training:
         self.register_forward_hook(forward_hook)
 
+    def __call__(self, *args, **kwargs):
+        if _recording and _state().record:
+            return _relprop_function(self, args, kwargs)
+        return super().__call__(*args, **kwargs)
+
+    def autograd_relprop(self, R, **kwargs):
+        # the rule relevance_backward applies to this layer
+        return self.relprop(R, **kwargs)
+
     def gradprop(self, Z, X, S):
         C = torch.autograd.grad(Z, X, S, retain_graph=True)
         return C
 
-    def relprop(self, R, alpha):
+    def relprop(self, R, alpha, policy=None):
         return R
 
 class RelPropSimple(RelProp):
-    def relprop(self, R, alpha):
+    def relevance_gradients(self, R, compute_dtype=None):
+        # gradients of <Z, R / Z> with respect to the inputs, by differentiating a recomputed forward.
+        # Layers with a closed form override this and reuse the output captured by forward_hook.
         Z = self.forward(self.X)
         S = safe_divide(R, Z)
-        C = self.gradprop(Z, self.X, S)
+        return self.gradprop(Z, self.X, S.to(Z.dtype))
+
+    def relprop(self, R, alpha, policy=None):
+        compute_dtype = compute_dtype_of(policy)
+        C = self.relevance_gradients(R, compute_dtype)
 
         if torch.is_tensor(self.X) == False:
             outputs = []
-            outputs.append(self.X[0] * C[0])
-            outputs.append(self.X[1] * C[1])
+            outputs.append(to_accumulate(self.X[0], compute_dtype) * to_accumulate(C[0], compute_dtype))
+            outputs.append(to_accumulate(self.X[1], compute_dtype) * to_accumulate(C[1], compute_dtype))
         else:
-            outputs = self.X * (C[0])
+            outputs = to_accumulate(self.X, compute_dtype) * to_accumulate(C[0], compute_dtype)
         return outputs
 
 class AddEye(RelPropSimple):
@@ -66,6 +239,9 @@ class AddEye(RelPropSimple):
     def forward(self, input):
         return input + torch.eye(input.shape[2]).expand_as(input).to(input.device)
 
+    def relevance_gradients(self, R, compute_dtype=None):
+        return (safe_divide(R, self.Y.detach()),)
+
 class ReLU(nn.ReLU, RelProp):
     pass
 
@@ -86,13 +262,29 @@ class BatchNorm2d(nn.BatchNorm2d, RelProp):
 class Dropout(nn.Dropout, RelProp):
     pass
 
-class DropPath(TimmDropPath, RelProp):
+def drop_path(x, drop_prob: float = 0., training: bool = False, scale_by_keep: bool = True):
+    """Drop paths (Stochastic Depth) per sample, as timm's drop_path, which is slow to import"""
+    if drop_prob == 0. or not training:
+        return x
+    keep_prob = 1 - drop_prob
+    shape = (x.shape[0],) + (1,) * (x.ndim - 1)
+    random_tensor = x.new_empty(shape).bernoulli_(keep_prob)
+    if keep_prob > 0.0 and scale_by_keep:
+        random_tensor.div_(keep_prob)
+    return x * random_tensor
+
+
+class DropPath(RelProp):
     """
     Готово
     """
-    def __init__(self, drop_prob=None):
-        super().__init__(drop_prob=drop_prob)
+    def __init__(self, drop_prob=None, scale_by_keep=True):
+        super().__init__()
         self.drop_prob = drop_prob
+        self.scale_by_keep = scale_by_keep
+
+    def forward(self, x):
+        return drop_path(x, self.drop_prob, self.training, self.scale_by_keep)
 
     def __repr__(self):
         msg = super().__repr__()
@@ -119,10 +311,12 @@ class Add(RelPropSimple):
     def forward(self, inputs):
         return torch.add(*inputs)
 
-    def relprop(self, R, alpha):
-        Z = self.forward(self.X)
-        S = safe_divide(R, Z)
-        C = self.gradprop(Z, self.X, S)
+    def relevance_gradients(self, R, compute_dtype=None):
+        S = safe_divide(R, self.Y.detach())
+        return S.sum_to_size(self.X[0].shape), S.sum_to_size(self.X[1].shape)
+
+    def relprop(self, R, alpha, policy=None):
+        C = self.relevance_gradients(R)
 
         a = self.X[0] * C[0]
         b = self.X[1] * C[1]
@@ -144,9 +338,23 @@ class einsum(RelPropSimple):
     def __init__(self, equation):
         super().__init__()
         self.equation = equation
+        self.grad_equations = einsum_grad_equations(equation)
     def forward(self, *operands):
         return torch.einsum(self.equation, *operands)
 
+    def autograd_relprop(self, R, **kwargs):
+        # the attention relprop walks halve the relevance of both operands, to conserve it
+        return [r / 2 for r in self.relprop(R, **kwargs)]
+
+    def relevance_gradients(self, R, compute_dtype=None):
+        if self.grad_equations is None or torch.is_tensor(self.X) or len(self.X) != 2:
+            return super().relevance_gradients(R, compute_dtype)
+        S = safe_divide(R, self.Y.detach())
+        # the transposed einsums run in compute_dtype, else in the dtype of the forward
+        dtype = compute_dtype or self.Y.dtype
+        a, b, S = self.X[0].to(dtype), self.X[1].to(dtype), S.to(dtype)
+        return einsum_gradients(self.grad_equations, a, b, S)
+
 class IndexSelect(RelProp):
     def forward(self, inputs, dim, indices):
         self.__setattr__('dim', dim)
@@ -154,10 +362,9 @@ class IndexSelect(RelProp):
 
         return torch.index_select(inputs, dim, indices)
 
-    def relprop(self, R, alpha):
-        Z = self.forward(self.X, self.dim, self.indices)
-        S = safe_divide(R, Z)
-        C = self.gradprop(Z, self.X, S)
+    def relprop(self, R, alpha, policy=None):
+        S = safe_divide(R, self.Y.detach())
+        C = (torch.zeros_like(self.X, dtype=S.dtype).index_add_(self.dim, self.indices, S),)
 
         if torch.is_tensor(self.X) == False:
             outputs = []
@@ -177,12 +384,10 @@ class Clone(RelProp):
 
         return outputs
 
-    def relprop(self, R, alpha):
-        Z = []
-        for _ in range(self.num):
-            Z.append(self.X)
-        S = [safe_divide(r, z) for r, z in zip(R, Z)]
-        C = self.gradprop(Z, self.X, S)[0]
+    def relprop(self, R, alpha, policy=None):
+        # every output is X itself, so the gradient is the sum of the S
+        S = [safe_divide(r, self.X) for r in R]
+        C = sum(S)
 
         R = self.X * C
 
@@ -194,10 +399,9 @@ class Cat(RelProp):
         self.__setattr__('dim', dim)
         return torch.cat(inputs, dim)
 
-    def relprop(self, R, alpha):
-        Z = self.forward(self.X, self.dim)
-        S = safe_divide(R, Z)
-        C = self.gradprop(Z, self.X, S)
+    def relprop(self, R, alpha, policy=None):
+        S = safe_divide(R, self.Y.detach())
+        C = S.split([x.shape[self.dim] for x in self.X], dim=self.dim)
 
         outputs = []
         for x, c in zip(self.X, C):
@@ -207,13 +411,13 @@ class Cat(RelProp):
 
 
 class Sequential(nn.Sequential):
-    def relprop(self, R, alpha):
+    def relprop(self, R, alpha, policy=None):
         for m in reversed(self._modules.values()):
-            R = m.relprop(R, alpha)
+            R = m.relprop(R, alpha, policy=policy)
         return R
 
 class BatchNorm2d(nn.BatchNorm2d, RelProp):
-    def relprop(self, R, alpha):
+    def relprop(self, R, alpha, policy=None):
         X = self.X
         beta = 1 - alpha
         weight = self.weight.unsqueeze(0).unsqueeze(2).unsqueeze(3) / (
@@ -226,76 +430,29 @@ class BatchNorm2d(nn.BatchNorm2d, RelProp):
 
 
 class Linear(nn.Linear, RelProp):
-    def relprop(self, R, alpha):
-        beta = alpha - 1
-        pw = torch.clamp(self.weight, min=0)
-        nw = torch.clamp(self.weight, max=0)
-        px = torch.clamp(self.X, min=0)
-        nx = torch.clamp(self.X, max=0)
-
-        def f(w1, w2, x1, x2):
-            Z1 = F.linear(x1, w1)
-            Z2 = F.linear(x2, w2)
-            S1 = safe_divide(R, Z1 + Z2)
-            S2 = safe_divide(R, Z1 + Z2)
-            C1 = x1 * torch.autograd.grad(Z1, x1, S1)[0]
-            C2 = x2 * torch.autograd.grad(Z2, x2, S2)[0]
+    def rule_forward(self, x, w):
+        return F.linear(x, w)
 
-            return C1 + C2
+    def rule_gradprop(self, S, w):
+        return linear_gradprop(S, w)
 
-        activator_relevances = f(pw, nw, px, nx)
-        inhibitor_relevances = f(nw, pw, px, nx)
-
-        R = alpha * activator_relevances - beta * inhibitor_relevances
-
-        return R
+    @torch.no_grad()
+    def relprop(self, R, alpha, policy=None):
+        return rule_for(self, policy, AlphaBetaRule(alpha, joint=True))(self, R, compute_dtype_of(policy))
 
 
 class Conv2d(nn.Conv2d, RelProp):
-    def gradprop2(self, DY, weight):
-        Z = self.forward(self.X)
-
-        output_padding = self.X.size()[2] - (
-                (Z.size()[2] - 1) * self.stride[0] - 2 * self.padding[0] + self.kernel_size[0])
-
-        return F.conv_transpose2d(DY, weight, stride=self.stride, padding=self.padding, output_padding=output_padding)
-
-    def relprop(self, R, alpha):        
-        if self.X.shape[1] == 3:
-            pw = torch.clamp(self.weight, min=0)
-            nw = torch.clamp(self.weight, max=0)
-            X = self.X
-            L = self.X * 0 + \
-                torch.min(torch.min(torch.min(self.X, dim=1, keepdim=True)[0], dim=2, keepdim=True)[0], dim=3,
-                          keepdim=True)[0]
-            H = self.X * 0 + \
-                torch.max(torch.max(torch.max(self.X, dim=1, keepdim=True)[0], dim=2, keepdim=True)[0], dim=3,
-                          keepdim=True)[0]
-            Za = torch.conv2d(X, self.weight, bias=None, stride=self.stride, padding=self.padding) - \
-                 torch.conv2d(L, pw, bias=None, stride=self.stride, padding=self.padding) - \
-                 torch.conv2d(H, nw, bias=None, stride=self.stride, padding=self.padding) + 1e-9
-
-            S = R / Za
-            C = X * self.gradprop2(S, self.weight) - L * self.gradprop2(S, pw) - H * self.gradprop2(S, nw)
-            R = C
-        else:
-            beta = alpha - 1
-            pw = torch.clamp(self.weight, min=0)
-            nw = torch.clamp(self.weight, max=0)
-            px = torch.clamp(self.X, min=0)
-            nx = torch.clamp(self.X, max=0)
-
-            def f(w1, w2, x1, x2):
-                Z1 = F.conv2d(x1, w1, bias=None, stride=self.stride, padding=self.padding, groups=self.groups)
-                Z2 = F.conv2d(x2, w2, bias=None, stride=self.stride, padding=self.padding, groups=self.groups)
-                S1 = safe_divide(R, Z1)
-                S2 = safe_divide(R, Z2)
-                C1 = x1 * self.gradprop(Z1, x1, S1)[0]
-                C2 = x2 * self.gradprop(Z2, x2, S2)[0]
-                return C1 + C2
-
-            activator_relevances = f(pw, nw, px, nx)
-            inhibitor_relevances = f(nw, pw, px, nx)
-
-            R = alpha * activator_relevances - beta * inhibitor_relevances
-        return R
+    def rule_forward(self, x, w):
+        return F.conv2d(x, w, bias=None, stride=self.stride, padding=self.padding, groups=self.groups)
+
+    def rule_gradprop(self, S, w):
+        # the gradient of <F.conv2d(x, w), S> with respect to x, x of the size of X with the channels of w,
+        # so that weights stacked along dim 1 give the gradients for each of them at once
+        size = (S.shape[0], w.shape[1] * self.groups) + self.X.shape[2:]
+        return torch.nn.grad.conv2d_input(size, w, S, stride=self.stride, padding=self.padding, groups=self.groups)
+
+    @torch.no_grad()
+    def relprop(self, R, alpha, policy=None):
+        # the z^B rule for the image input, alpha-beta elsewhere
+        default = ZBRule() if self.X.shape[1] == 3 else AlphaBetaRule(alpha)
+        return rule_for(self, policy, default)(self, R, compute_dtype_of(policy))
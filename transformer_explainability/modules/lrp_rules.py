@@ -0,0 +1,335 @@
+"""Relevance rules for the layers with weights, and the policies assigning them to layers.
+
+A rule sees its layer through layer.X, the input saved by forward_hook, and two methods:
+layer.rule_forward(x, w), the bias free forward with weights w, and layer.rule_gradprop(S, w),
+the gradient of <rule_forward(x, w), S> with respect to x. Linear and Conv2d of both the ViT and
+the BERT layer files provide them, so every rule applies to all of them.
+
+Given a compute_dtype such as torch.bfloat16, the rules run those two in that dtype and keep the
+relevance, the divisions and the products with the inputs in float32.
+"""
+import torch
+
+
+def stabilizer(dtype):
+    # 1e-9, unless it is below the smallest normal number of dtype, as for float16
+    return max(1e-9, torch.finfo(dtype).tiny)
+
+
+def safe_divide(a, b, out=None):
+    # a / (b + eps * sign(b)), and 0 where b is 0. The stabilizer moves b away from 0, so only b == 0 needs a
+    # mask, which makes the denominator inf there; den is the only temporary the size of b
+    if not b.is_floating_point():
+        b = b.float()
+    den = b.sign().mul_(stabilizer(b.dtype)).add_(b)
+    den.masked_fill_(b.eq(0), float('inf'))
+    return torch.div(a, den, out=out)
+
+
+def to_compute(t, compute_dtype):
+    return t if compute_dtype is None else t.to(compute_dtype)
+
+
+def to_accumulate(t, compute_dtype):
+    # the dtype relevance is kept in while the matmuls run in compute_dtype
+    return t if compute_dtype is None else t.float()
+
+
+def linear_gradprop(S, w):
+    # the gradient of <F.linear(x, w), S> with respect to x
+    return torch.matmul(S, w)
+
+
+def divide_gradprop_multiply(R, Z, pairs, gradprop, compute_dtype=None):
+    """The sum over (x, w) in pairs of x * gradprop(R / Z, w), where gradprop(S, w) is the gradient
+    of <Z, S> with respect to x. Accumulates in place and overwrites Z, so run it under no_grad.
+
+    With a compute_dtype, Z, gradprop and w are in that dtype while R, x and the result are float32.
+    """
+    Z = to_accumulate(Z, compute_dtype)
+    S = to_compute(safe_divide(R, Z, out=Z), compute_dtype)
+    C = None
+    for x, w in pairs:
+        G = to_accumulate(gradprop(S, w), compute_dtype)
+        C = G.mul_(x) if C is None else C.addcmul_(G, x)
+    return C
+
+
+def einsum_grad_equations(equation):
+    """The two einsum equations giving the gradients of <einsum(equation, a, b), S> with respect to a and b.
+
+    Returns None unless equation is an explicit two operand equation whose indices all appear
+    once per operand and in one of the other terms, the cases where transposing it is exact.
+    """
+    equation = equation.replace(' ', '')
+    if '->' not in equation or '.' in equation:
+        return None
+    lhs, out = equation.split('->')
+    terms = lhs.split(',')
+    if len(terms) != 2:
+        return None
+    a, b = terms
+    if any(len(set(t)) != len(t) for t in (a, b, out)):
+        return None
+    if not set(a) <= set(b) | set(out) or not set(b) <= set(a) | set(out):
+        return None
+    return '{},{}->{}'.format(out, b, a), '{},{}->{}'.format(a, out, b)
+
+
+def einsum_gradients(grad_equations, a, b, S):
+    # the gradients of <einsum(equation, a, b), S> from einsum_grad_equations(equation), summed to the
+    # shapes of a and b over the dimensions they were broadcast along, as autograd does
+    return (torch.einsum(grad_equations[0], S, b).sum_to_size(a.shape),
+            torch.einsum(grad_equations[1], a, S).sum_to_size(b.shape))
+
+
+def _is_compiling():
+    # torch.compiler.is_compiling is missing before torch 2.3
+    is_compiling = getattr(getattr(torch, 'compiler', None), 'is_compiling', None)
+    return is_compiling is not None and is_compiling()
+
+
+def weight_transform(layer, key, fn):
+    """fn(layer.weight), kept on the layer under key until the weight changes.
+
+    The clamped and shifted weights the rules need are then computed once for all explanations
+    and shared between the rules using them.
+    """
+    weight = layer.weight
+    if _is_compiling():
+        # computed in the compiled graph instead, torch.compile cannot key a cache on data pointers
+        with torch.no_grad():
+            return fn(weight)
+    cache = layer.__dict__.setdefault('_rule_weights', {})
+    version = (weight.data_ptr(), weight._version, weight.device, weight.dtype)
+    cached = cache.get(key)
+    if cached is None or cached[0] != version:
+        with torch.no_grad():
+            cached = cache[key] = (version, fn(weight))
+    return cached[1]
+
+
+def compute_weight(layer, compute_dtype):
+    if compute_dtype is None:
+        return layer.weight
+    return weight_transform(layer, compute_dtype, lambda w: w.to(compute_dtype))
+
+
+def positive_weight(layer, compute_dtype=None):
+    return weight_transform(layer, ('positive', compute_dtype), lambda w: to_compute(w.clamp(min=0), compute_dtype))
+
+
+def negative_weight(layer, compute_dtype=None):
+    return weight_transform(layer, ('negative', compute_dtype), lambda w: to_compute(w.clamp(max=0), compute_dtype))
+
+
+class Rule:
+    """Maps the relevance R of a layer's output to the relevance of its input layer.X.
+
+    The rules below run under no_grad, as they divide and accumulate in place.
+    """
+
+    def __call__(self, layer, R, compute_dtype=None):
+        raise NotImplementedError
+
+    def __repr__(self):
+        args = ', '.join('{}={}'.format(k, v) for k, v in vars(self).items())
+        return '{}({})'.format(type(self).__name__, args)
+
+
+class IdentityRule(Rule):
+    """Passes R through unchanged, for layers whose output has the shape of their input."""
+
+    def __call__(self, layer, R, compute_dtype=None):
+        return R
+
+
+class EpsilonRule(Rule):
+    def __init__(self, epsilon=1e-6):
+        self.epsilon = epsilon
+
+    @torch.no_grad()
+    def __call__(self, layer, R, compute_dtype=None):
+        X = layer.X
+        w = compute_weight(layer, compute_dtype)
+        Z = to_accumulate(layer.rule_forward(to_compute(X, compute_dtype), w), compute_dtype)
+        Z.add_(torch.where(Z >= 0, self.epsilon, -self.epsilon))
+        return divide_gradprop_multiply(R, Z, [(to_accumulate(X, compute_dtype), w)], layer.rule_gradprop,
+                                        compute_dtype)
+
+
+class GammaRule(Rule):
+    def __init__(self, gamma=0.25):
+        self.gamma = gamma
+
+    @torch.no_grad()
+    def __call__(self, layer, R, compute_dtype=None):
+        gamma = self.gamma
+        w = weight_transform(layer, ('gamma', gamma, compute_dtype),
+                             lambda w: to_compute(w + gamma * w.clamp(min=0), compute_dtype))
+        X = layer.X
+        Z = layer.rule_forward(to_compute(X, compute_dtype), w)
+        return divide_gradprop_multiply(R, Z, [(to_accumulate(X, compute_dtype), w)], layer.rule_gradprop,
+                                        compute_dtype)
+
+
+class AlphaBetaRule(Rule):
+    """alpha times the relevance through the positive contributions minus beta times the negative ones.
+
+    beta defaults to alpha - 1. With joint, both parts of each term share one denominator, as in the
+    Linear of the layers_ours files, else each part is normalized on its own.
+    """
+
+    def __init__(self, alpha=1, beta=None, joint=False):
+        self.alpha = alpha
+        self.beta = alpha - 1 if beta is None else beta
+        self.joint = joint
+
+    @torch.no_grad()
+    def __call__(self, layer, R, compute_dtype=None):
+        forward, gradprop = layer.rule_forward, layer.rule_gradprop
+        pw = positive_weight(layer, compute_dtype)
+        nw = negative_weight(layer, compute_dtype)
+        X = to_accumulate(layer.X, compute_dtype)
+        px = torch.clamp(X, min=0)
+        nx = torch.clamp(X, max=0)
+        # the inputs of the forwards, the same tensors without a compute_dtype
+        cpx = to_compute(px, compute_dtype)
+        cnx = to_compute(nx, compute_dtype)
+
+        def f(w1, w2):
+            if self.joint:
+                Z = forward(cpx, w1).add_(forward(cnx, w2))
+                return divide_gradprop_multiply(R, Z, [(px, w1), (nx, w2)], gradprop, compute_dtype)
+            C1 = divide_gradprop_multiply(R, forward(cpx, w1), [(px, w1)], gradprop, compute_dtype)
+            C2 = divide_gradprop_multiply(R, forward(cnx, w2), [(nx, w2)], gradprop, compute_dtype)
+            return C1.add_(C2)
+
+        activator_relevances = f(pw, nw)
+        if self.beta == 0:
+            return activator_relevances if self.alpha == 1 else activator_relevances.mul_(self.alpha)
+        inhibitor_relevances = f(nw, pw)
+        return self.alpha * activator_relevances - self.beta * inhibitor_relevances
+
+
+class ZBRule(Rule):
+    """The z^B rule for inputs bounded by low and high, by default the extremes of each sample.
+
+    With bounds that are numbers or per sample, the bound terms are the bounds times the forwards of
+    an input of ones with the positive and negative weights, computed once per weight and input size,
+    and the three gradients come from a single gradprop with the weights stacked along dim 1.
+    """
+
+    def __init__(self, low=None, high=None):
+        self.low = low
+        self.high = high
+
+    @torch.no_grad()
+    def __call__(self, layer, R, compute_dtype=None):
+        X = to_accumulate(layer.X, compute_dtype)
+        dims = tuple(range(1, X.dim()))
+        low = X.amin(dim=dims, keepdim=True) if self.low is None else self.low
+        high = X.amax(dim=dims, keepdim=True) if self.high is None else self.high
+        if getattr(layer, 'groups', 1) != 1 or any(torch.is_tensor(b) and b.shape[1:].numel() > 1
+                                                   for b in (low, high)):
+            # bounds varying over the input, or groups whose weights cannot be stacked
+            return self.elementwise_bounds(layer, R, X, X * 0 + low, X * 0 + high, compute_dtype)
+
+        forward, gradprop = layer.rule_forward, layer.rule_gradprop
+        size = tuple(X.shape[1:])
+
+        def bound_forwards(w):
+            ones = X.new_ones((1,) + size, dtype=compute_dtype or X.dtype)
+            return (to_accumulate(forward(ones, to_compute(w.clamp(min=0), compute_dtype)), compute_dtype),
+                    to_accumulate(forward(ones, to_compute(w.clamp(max=0), compute_dtype)), compute_dtype))
+
+        P, N = weight_transform(layer, ('zb_bounds', size, compute_dtype), bound_forwards)
+        stacked = weight_transform(layer, ('zb_stacked', compute_dtype), lambda w: to_compute(
+            torch.cat([w, w.clamp(min=0), w.clamp(max=0)], dim=1), compute_dtype))
+
+        Za = to_accumulate(forward(to_compute(X, compute_dtype), compute_weight(layer, compute_dtype)),
+                           compute_dtype)
+        Za -= low * P + high * N
+        Za += 1e-9
+        S = to_compute(torch.div(R, Za, out=Za), compute_dtype)
+        # the gradients for w, the positive and the negative weights, along the channels of a Conv2d
+        # input or the features of a Linear one
+        G = to_accumulate(gradprop(S, stacked), compute_dtype)
+        Gw, Gp, Gn = G.chunk(3, dim=1 if stacked.dim() > 2 else -1)
+        return (X * Gw).sub_(low * Gp).sub_(high * Gn)
+
+    def elementwise_bounds(self, layer, R, X, L, H, compute_dtype=None):
+        forward, gradprop = layer.rule_forward, layer.rule_gradprop
+        w = compute_weight(layer, compute_dtype)
+        pw = positive_weight(layer, compute_dtype)
+        nw = negative_weight(layer, compute_dtype)
+
+        def fwd(x, w):
+            return to_accumulate(forward(to_compute(x, compute_dtype), w), compute_dtype)
+
+        def bwd(S, w):
+            return to_accumulate(gradprop(S, w), compute_dtype)
+
+        Za = fwd(X, w) - fwd(L, pw) - fwd(H, nw) + 1e-9
+
+        S = to_compute(R / Za, compute_dtype)
+        return X * bwd(S, w) - L * bwd(S, pw) - H * bwd(S, nw)
+
+
+RULES = {
+    'identity': IdentityRule,
+    'epsilon': EpsilonRule,
+    'gamma': GammaRule,
+    'alpha_beta': AlphaBetaRule,
+    'zb': ZBRule,
+}
+
+
+def register_rule(name, rule):
+    RULES[name] = rule
+    return rule
+
+
+def make_rule(rule):
+    # a Rule, or the name of a registered rule built with its defaults
+    if isinstance(rule, str):
+        if rule not in RULES:
+            raise ValueError("Unknown LRP rule {}, expected one of {}".format(rule, sorted(RULES)))
+        return RULES[rule]()
+    return rule
+
+
+class Policy:
+    """Assigns rules to layers, passed to relprop as policy=.
+
+    layers maps layer modules and types maps layer classes to rules or rule names. A layer gets its
+    own rule first, then the rule of its nearest class in types, then default, and when none of
+    these is set the rule its relprop uses without a policy. Linear and Conv2d consult the policy.
+
+    compute_dtype, for instance torch.bfloat16, is the dtype of the relprop matmuls, while relevance
+    and the divisions and sums over it stay in float32. None keeps everything in the model's dtype.
+    Run the forward under torch.autocast with the same dtype to capture half size activations.
+    """
+
+    def __init__(self, default=None, types=None, layers=None, compute_dtype=None):
+        self.compute_dtype = compute_dtype
+        self.default = None if default is None else make_rule(default)
+        self.types = {cls: make_rule(rule) for cls, rule in (types or {}).items()}
+        self.layers = {layer: make_rule(rule) for layer, rule in (layers or {}).items()}
+
+    def rule(self, layer):
+        if layer in self.layers:
+            return self.layers[layer]
+        for cls in type(layer).__mro__:
+            if cls in self.types:
+                return self.types[cls]
+        return self.default
+
+
+def rule_for(layer, policy, default):
+    rule = None if policy is None else policy.rule(layer)
+    return default if rule is None else rule
+
+
+def compute_dtype_of(policy):
+    return None if policy is None else policy.compute_dtype
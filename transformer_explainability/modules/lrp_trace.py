@@ -0,0 +1,156 @@
+"""Per layer conservation and timing of relprop.
+
+    with trace_relprop(model) as trace:
+        model.relprop(one_hot, method="transformer_attribution", alpha=1)
+    trace.summary()
+    trace.save("relprop.json")  # chrome://tracing or https://ui.perfetto.dev
+
+While the context is open every module of model with a relprop method, the RelProp layers as well
+as the blocks and the model itself, records one event per relprop call: the sum, min and max of the
+relevance in and out, the wall time and the change in allocated CUDA memory. Nested calls nest in
+the trace. Outside of the context the modules are untouched, so tracing costs nothing when off.
+
+The relprop of the ViT models returns the relevance of the image only for method="full", and for the
+other methods a map built from the attention of the blocks. Such calls are recorded with relevance
+False, and summary leaves out the relevance they would seem to lose.
+"""
+import inspect
+import json
+import time
+from contextlib import contextmanager
+
+import torch
+
+
+def _tensors(R):
+    if torch.is_tensor(R):
+        return [R]
+    if type(R) in (list, tuple):
+        return [t for r in R for t in _tensors(r)]
+    return []
+
+
+def relevance_stats(R):
+    # sum, min and max over the tensors of R, or Nones when R holds no tensor
+    tensors = [t.detach() for t in _tensors(R) if t.numel()]
+    if not tensors:
+        return None, None, None
+    return (sum(t.sum().item() for t in tensors),
+            min(t.min().item() for t in tensors),
+            max(t.max().item() for t in tensors))
+
+
+def returns_relevance(relprop, args, kwargs):
+    # False for the model relprops called with a method other than "full", which return an attention map
+    try:
+        bound = inspect.signature(relprop).bind(*args, **kwargs)
+    except (TypeError, ValueError):
+        return True
+    bound.apply_defaults()
+    method = bound.arguments.get('method')
+    return method is None or method == 'full'
+
+
+def _allocated(device):
+    if device is not None and device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        return torch.cuda.memory_allocated(device)
+    return None
+
+
+class RelPropTrace:
+    """The relprop events recorded by trace_relprop, in the order the calls returned."""
+
+    def __init__(self):
+        self.events = []
+        self.depth = 0
+        self.start = time.perf_counter()
+
+    def record(self, name, module, relprop, args, kwargs):
+        R = args[0] if args else kwargs.get('cam', kwargs.get('R'))
+        inputs = _tensors(R)
+        device = inputs[0].device if inputs else None
+        sum_in, min_in, max_in = relevance_stats(R)
+        allocated = _allocated(device)
+        self.depth += 1
+        begin = time.perf_counter()
+        try:
+            out = relprop(*args, **kwargs)
+        finally:
+            self.depth -= 1
+        if device is not None and device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        end = time.perf_counter()
+        sum_out, min_out, max_out = relevance_stats(out)
+        self.events.append({
+            'name': name,
+            'type': type(module).__name__,
+            'relevance': returns_relevance(relprop, args, kwargs),
+            'depth': self.depth,
+            'start': begin - self.start,
+            'time': end - begin,
+            'sum_in': sum_in,
+            'sum_out': sum_out,
+            'min_in': min_in,
+            'max_in': max_in,
+            'min_out': min_out,
+            'max_out': max_out,
+            'allocated': None if allocated is None else _allocated(device) - allocated,
+        })
+        return out
+
+    def chrome_trace(self):
+        # the events in the Chrome trace event format, as complete events in microseconds
+        events = []
+        for e in self.events:
+            args = {k: v for k, v in e.items() if k not in ('name', 'start', 'time')}
+            events.append({'name': e['name'] or e['type'], 'cat': 'relprop', 'ph': 'X', 'pid': 0, 'tid': 0,
+                           'ts': e['start'] * 1e6, 'dur': e['time'] * 1e6, 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def summary(self, top=None):
+        # one line per event, outermost first, with the relevance lost or gained by each call that
+        # returns relevance
+        lines = ['{:<40} {:<14} {:>10} {:>14} {:>14} {:>14}'.format(
+            'layer', 'type', 'ms', 'sum in', 'sum out', 'lost')]
+        events = sorted(self.events, key=lambda e: e['start'])
+        if top is not None:
+            events = sorted(events, key=lambda e: -e['time'])[:top]
+        for e in events:
+            sum_out = e['sum_out'] if e['relevance'] else None
+            lost = None if e['sum_in'] is None or sum_out is None else e['sum_in'] - sum_out
+            lines.append('{:<40} {:<14} {:>10.3f} {:>14} {:>14} {:>14}'.format(
+                '  ' * (e['depth'] if top is None else 0) + (e['name'] or '(model)'), e['type'],
+                e['time'] * 1e3, _format(e['sum_in']), _format(sum_out), _format(lost)))
+        return '\n'.join(lines)
+
+
+def _format(value):
+    return '-' if value is None else '{:.6g}'.format(value)
+
+
+@contextmanager
+def trace_relprop(model):
+    """Records the relprop calls of model and its submodules into the RelPropTrace it yields."""
+    trace = RelPropTrace()
+    traced = []
+    for name, module in model.named_modules():
+        relprop = getattr(module, 'relprop', None)
+        if relprop is None or 'relprop' in module.__dict__:
+            continue
+
+        def traced_relprop(*args, _name=name, _module=module, _relprop=relprop, **kwargs):
+            return trace.record(_name, _module, _relprop, args, kwargs)
+
+        # an instance attribute shadows the class method until it is deleted again
+        module.__dict__['relprop'] = traced_relprop
+        traced.append(module)
+    try:
+        yield trace
+    finally:
+        for module in traced:
+            del module.__dict__['relprop']
@@ -1,7 +1,5 @@
 import numpy as np
 import torch
-from sklearn.metrics import f1_score, average_precision_score
-from sklearn.metrics import precision_recall_curve, roc_curve
 
 SMOOTH = 1e-6
 __all__ = ['get_f1_scores', 'get_ap_scores', 'batch_pix_accuracy', 'batch_intersection_union', 'get_iou', 'get_pr',
@@ -24,6 +22,8 @@ def get_iou(outputs: torch.Tensor, labels: torch.Tensor):
 
 
 def get_f1_scores(predict, target, ignore_index=-1):
+    from sklearn.metrics import f1_score
+
     # Tensor process
     batch_size = predict.shape[0]
     predict = predict.data.cpu().numpy().reshape(-1)
@@ -39,6 +39,8 @@ def get_f1_scores(predict, target, ignore_index=-1):
 
 
 def get_roc(predict, target, ignore_index=-1):
+    from sklearn.metrics import roc_curve
+
     target_expand = target.unsqueeze(1).expand_as(predict)
     target_expand_numpy = target_expand.data.cpu().numpy().reshape(-1)
     # Tensor process
@@ -59,6 +61,8 @@ def get_roc(predict, target, ignore_index=-1):
 
 
 def get_pr(predict, target, ignore_index=-1):
+    from sklearn.metrics import precision_recall_curve
+
     target_expand = target.unsqueeze(1).expand_as(predict)
     target_expand_numpy = target_expand.data.cpu().numpy().reshape(-1)
     # Tensor process
@@ -79,6 +83,8 @@ def get_pr(predict, target, ignore_index=-1):
 
 
 def get_ap_scores(predict, target, ignore_index=-1):
+    from sklearn.metrics import average_precision_score
+
     total = []
     for pred, tgt in zip(predict, target):
         target_expand = tgt.unsqueeze(0).expand_as(pred)
@@ -100,6 +106,8 @@ def get_ap_scores(predict, target, ignore_index=-1):
 
 
 def get_ap_multiclass(predict, target):
+    from sklearn.metrics import average_precision_score
+
     total = []
     for pred, tgt in zip(predict, target):
         predict_flat = pred.data.cpu().numpy().reshape(-1)
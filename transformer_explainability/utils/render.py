@@ -1,8 +1,6 @@
 import numpy as np
-import matplotlib.cm
-import skimage.io
-import skimage.feature
-import skimage.filters
+
+# matplotlib and skimage are imported by the functions that use them, they are slow to import
 
 
 def vec2im(V, shape=()):
@@ -142,6 +140,7 @@ def digit_to_rgb(X, scaling=3, shape=(), cmap='binary'):
     '''
 
     # create color map object from name string
+    import matplotlib.cm
     cmap = eval('matplotlib.cm.{}'.format(cmap))
 
     image = enlarge_image(vec2im(X, shape), scaling)  # enlarge
@@ -190,6 +189,7 @@ def hm_to_rgb(R, X=None, scaling=3, shape=(), sigma=2, cmap='bwr', normalize=Tru
     '''
 
     # create color map object from name string
+    import matplotlib.cm
     cmap = eval('matplotlib.cm.{}'.format(cmap))
 
     if normalize:
@@ -262,5 +262,6 @@ def save_image(rgb_images, path, gap=2):
     image = image.astype(np.uint8)
 
     print('saving image to ', path)
+    import skimage.io
     skimage.io.imsave(path, image)
     return image
@@ -1,10 +1,10 @@
 import os
-from torch.utils.tensorboard import SummaryWriter
 
 
 class TensorboardSummary(object):
     def __init__(self, directory):
         self.directory = directory
+        from torch.utils.tensorboard import SummaryWriter
         self.writer = SummaryWriter(log_dir=os.path.join(self.directory))
 
     def add_scalar(self, *args):